@@ -1,7 +1,7 @@
 #coding: utf-8
 #----- Standard Library -----#
 import os
-import glob
+import argparse
 
 #----- Public Package -----#
 from tqdm import tqdm
@@ -9,80 +9,134 @@ import numpy as np
 import torch
 import torchvision
 import h5py
-from PIL import Image
 import torch.nn as nn
+from omegaconf import OmegaConf
 
 #----- Module -----#
-# None
-
-
-class distance_gaussian_filter(nn.Module):
-    def __init__(self, device, size, sigma):
-        super().__init__()
-        self.sigma = sigma
-        self.kernel_size = 4 * sigma + 9
-        # make coordinate map
-        coord_x_map = torch.arange(size[0], device=device, dtype=torch.float).view(1, -1, 1, 1).repeat(1, 1, size[1], 1)
-        coord_y_map = torch.arange(size[1], device=device, dtype=torch.float).view(1, 1, -1, 1).repeat(1, size[0], 1, 1)
-        self.coord_map = torch.cat([coord_x_map, coord_y_map], dim=0)
-
-    def forward(self, x):
-        # get point coordinate
-        coordinate = torch.nonzero(x.mean(dim=0)).view(1, 1, -1, 2).permute(3, 0, 1, 2)
-        if coordinate.size(-1) == 0:
-            return x.new_zeros(x.size())
-        
-        gaussian = torch.norm(self.coord_map - coordinate.float(), dim=0)
-        gaussian = torch.exp(-0.5 * (gaussian / self.sigma).pow(2))
-        
-        value, _ = gaussian.max(dim=-1)
-        img = value.unsqueeze(0)
-        return img
-
-def Generator():
-    gaussian_filter = distance_gaussian_filter("cuda:0", (512, 512), 2)
-    
+from utils.EP_map import gaussian_splat
+from utils.dataset import registry_videos, video_sources, open_video
+from utils.storage import read_annotation
+
+
+def Generator(device="cpu", batch=16, sigma=2., compression="lzf", tile=256, registry=None, video="png"):
+    """Generate EP map of every sequence of a dataset registry.
+    The EP maps of a sequence are saved as one [frame,H,W] dataset chunked every batch frames and tile pixels.
+
+    Args:
+        device (str, optional): device used for rendering. Defaults to "cpu".
+        batch (int, optional): number of frames rendered at once and chunk length. Defaults to 16.
+        sigma (float, optional): Gaussian sigma. Defaults to 2.
+        compression (str, optional): "lzf", "gzip" or None. Defaults to "lzf".
+        tile (int, optional): chunk height and width. Defaults to 256.
+        registry (dict, optional): sequences of config/dataset/*.yaml. Defaults to the OIST GFP data.
+        video (str, optional): png or tiff, the video the frame number and size are read from. Defaults to "png".
+    """
+    # the same sequences and videos as the dataset
+    root_dir, names, use_paths = registry_videos(registry)
+
     # [frame,id,x,y]
-    f = h5py.File("./data/Cell_Point_Annotation.hdf5", mode='r')
-    Density_paths = sorted(glob.glob(f"./data/Density*"))
-
-    f_save = h5py.File("./data/Molecule_EP.hdf5", mode='a')
-
-    for item_den_path in Density_paths:
-        print("{}:\n".format(item_den_path.split("/")[-1]))
-        data = f[item_den_path.split("/")[-1]][...]
-        # make group
-        try:
-            group_save = f_save.create_group(item_den_path.split("/")[-1])
-        except:
-            group_save = f_save[item_den_path.split("/")[-1]]
-        
-        frame_len = len(glob.glob(item_den_path + "/video/*.png"))
-        
-        #swap x and y [x,y] => [y,x]
-        track_let = torch.from_numpy(data[:, [0, 3, 2]])
-        
-        track_let = torch.round(track_let).to(torch.int32).transpose(0, 1)
-        image_size = [512,512]
-        sparse = torch.sparse_coo_tensor(track_let, torch.ones(track_let.shape[1]), (frame_len, image_size[0], image_size[1]))
-        
-        video = sparse.to_dense()
-        video = video.unsqueeze(1)
-        
+    f = h5py.File(f"/{root_dir}/Cell_Point_Annotation.hdf5", mode='r')
+
+    f_save = h5py.File(f"/{root_dir}/Molecule_EP.hdf5", mode='a')
+
+    for name, use_path in zip(names, use_paths):
+        print("{}:\n".format(name))
+        # sorted at frame
+        data, _ = read_annotation(f, name)
+
+        # [frame,H,W] of the video
+        frame_len, *image_size = open_video(use_path, video_sources([use_path], video)[0], video).shape
+
+        # make dataset
+        if name in f_save:
+            del f_save[name]
+        dataset = create_EP_dataset(f_save, name, [frame_len, *image_size], batch, compression, tile)
+        dataset.attrs["sigma"] = sigma
+
+        #[num,3(frame,x,y)], sorted at frame
+        track_let = torch.from_numpy(data[:, [0, 2, 3]]).to(device)
+        frame_idx = torch.round(track_let[:, 0]).long()
+        start_idx = torch.searchsorted(frame_idx, torch.arange(0, frame_len + batch, batch, device=device))
+
         # save EP map
-        for idx,img in enumerate(video):
-            img = img.cuda("cuda:0", non_blocking=True)
-            
-            img = gaussian_filter(img)
+        for idx, start in enumerate(tqdm(range(0, frame_len, batch), leave=False)):
+            coord = track_let[start_idx[idx]: start_idx[idx + 1]].clone()
+            coord[:, 0] -= start
+            length = min(batch, frame_len - start)
+
+            EP = gaussian_splat(coord, length, image_size, sigma=sigma)
+            dataset[start: start + length] = EP.to('cpu').detach().numpy().astype(np.float32)
+
+    f_save.close()
+
+
+def create_EP_dataset(f_save, name, shape, chunk=16, compression="lzf", tile=256):
+    """Create [frame,H,W] EP dataset. A window of chunk frames is read at once,
+    and a crop only decodes the tiles it overlaps.
+
+    Args:
+        f_save (h5py.File): save file
+        name (str): sequence name
+        shape (list[3(frame,H,W)]): dataset shape
+        chunk (int, optional): number of frames in a chunk. Defaults to 16.
+        compression (str, optional): "lzf", "gzip" or None. None is stored contiguously. Defaults to "lzf".
+        tile (int, optional): chunk height and width. Defaults to 256.
+
+    Returns:
+        h5py.Dataset: EP dataset
+    """
+    if compression is None:
+        return f_save.create_dataset(name=name, shape=shape, dtype=np.float32)
+
+    chunks = (min(chunk, shape[0]), min(tile, shape[1]), min(tile, shape[2]))
+    return f_save.create_dataset(name=name, shape=shape, dtype=np.float32, chunks=chunks, compression=compression)
+
+
+def Migrate(path="./data/Molecule_EP.hdf5", chunk=16, compression="lzf", tile=256):
+    """Convert Molecule_EP.hdf5 with one dataset per frame into one dataset per sequence.
+
+    Args:
+        path (str, optional): EP file. Defaults to "./data/Molecule_EP.hdf5".
+        chunk (int, optional): number of frames in a chunk. Defaults to 16.
+        compression (str, optional): "lzf", "gzip" or None. Defaults to "lzf".
+        tile (int, optional): chunk height and width. Defaults to 256.
+    """
+    # deleted datasets are not reclaimed by HDF5, so write a new file and replace the old one
+    tmp_path = path + ".tmp"
+    with h5py.File(path, mode='r') as f, h5py.File(tmp_path, mode='w') as f_save:
+        for name, EP in f.items():
+            print("{}:\n".format(name))
+            if isinstance(EP, h5py.Dataset):
+                f.copy(EP, f_save, name=name)
+                continue
 
-            img = img.to('cpu').detach().numpy().astype(np.float32)
+            # old layout: group of [1,H,W] datasets named by frame
+            keys = sorted(EP.keys())
+            dataset = create_EP_dataset(f_save, name, [len(keys), *EP[keys[0]].shape[1:]], chunk, compression, tile)
+            for start in tqdm(range(0, len(keys), chunk), leave=False):
+                dataset[start: start + chunk] = np.concatenate([EP[key][...] for key in keys[start: start + chunk]], axis=0)
 
-            try:
-                group_save.create_dataset(name=f'{idx:04}', data=img.astype('float32'), compression='gzip', compression_opts=9)
-            except:
-                del group_save[f'{idx:04}']
-                group_save.create_dataset(name=f'{idx:04}', data=img.astype('float32'), compression='gzip', compression_opts=9)
+    os.replace(tmp_path, path)
 
 
-Generator()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch", type=int, default=16, help="number of frames rendered at once and chunk length")
+    parser.add_argument("--sigma", type=float, default=2.)
+    parser.add_argument("--compression", default="lzf", choices=["lzf", "gzip", "none"])
+    parser.add_argument("--tile", type=int, default=256, help="chunk height and width")
+    parser.add_argument("--migrate", action="store_true", help="convert an existing per-frame Molecule_EP.hdf5")
+    parser.add_argument("--dataset", default=None, help="registry in config/dataset, the OIST GFP data when omitted")
+    parser.add_argument("--video", default="png", choices=["png", "tiff"])
+    args = parser.parse_args()
 
+    compression = None if args.compression == "none" else args.compression
+    if args.migrate:
+        Migrate(chunk=args.batch, compression=compression, tile=args.tile)
+    else:
+        registry = None
+        if args.dataset is not None:
+            registry = OmegaConf.to_container(OmegaConf.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "dataset", f"{args.dataset}.yaml")))
+        Generator(device=args.device, batch=args.batch, sigma=args.sigma, compression=compression, tile=args.tile,
+                    registry=registry, video=args.video)
@@ -6,6 +6,7 @@ import sys
 
 #----- Public Package -----#
 import hydra
+from omegaconf import OmegaConf
 from tqdm import tqdm
 import numpy as np
 import torch
@@ -18,9 +19,9 @@ from tqdm import tqdm
 #----- Module -----#
 from utils.scheduler import CosineAnnealingWarmupRestarts
 from utils.loss import connected_loss
-from utils.dataset import OISTLoader, OISTLoader_add, collate_delete_PAD
+from utils.dataset import OISTLoader, OISTLoader_add, collate_delete_PAD, Density_BatchSampler, Shard_Sampler
 import utils.transforms as tf
-from utils.utils import get_movelimit
+from utils.utils import get_movelimit, autocast, grad_scaler, checkpoint_report
 from utils.Transformer_to_track import Transformer_to_Track
 from utils.evaluation import Object_Tracking
 from models.PTGT import PTGT
@@ -30,22 +31,57 @@ from models.PTGT import PTGT
 ############## dataloader function ##############
 def dataload(cfg):
     ### data augmentation + preprocceing ###
-    train_transform = tf.Compose([tf.RandomCrop(size=(256, 256)),
-                                tf.RandomHorizontalFlip(p=0.5),
-                                tf.RandomVerticalFlip(p=0.5),
-                                ])
+    if cfg.parameter.augment == "sample":
+        # in the workers, per sample
+        train_transform = tf.Compose([tf.RandomCrop(size=(256, 256)),
+                                    tf.RandomHorizontalFlip(p=0.5),
+                                    tf.RandomVerticalFlip(p=0.5),
+                                    ])
+        batch_transform = None
+    elif cfg.parameter.augment == "batch":
+        # workers send raw uint8 windows, augmented after collate on the device
+        train_transform = None
+        batch_transform = tf.Batch_Compose([tf.Batch_RandomCrop(size=(256, 256)),
+                                    tf.Batch_RandomHorizontalFlip(p=0.5),
+                                    tf.Batch_RandomVerticalFlip(p=0.5),
+                                    ])
+    else:
+        raise ValueError("augment has values other than sample and batch.")
 
     val_transform = tf.Compose([])
-    train_dataset = OISTLoader(mode="train", split=0, length=16, transform=train_transform)
-    val_dataset = OISTLoader_add(mode="val", split=0, length=16, transform=val_transform)
-
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset,
-        collate_fn=collate_delete_PAD,
-        batch_size=cfg.parameter.batch_size,
-        shuffle=True,
-        num_workers=2,
-        drop_last=True)
+    # sequences and splits, config/dataset/*.yaml
+    registry = OmegaConf.to_container(cfg.dataset)
+    train_dataset = OISTLoader(mode="train", split=cfg.parameter.split, length=16, transform=train_transform, EP_mode=cfg.parameter.EP_mode,
+                                video=cfg.parameter.video, normalize=cfg.parameter.normalize,
+                                registry=registry, max_videos=cfg.parameter.max_videos)
+    val_dataset = OISTLoader_add(mode="val", split=cfg.parameter.split, length=16, transform=val_transform, EP_mode=cfg.parameter.EP_mode,
+                                    video=cfg.parameter.video, normalize=cfg.parameter.normalize,
+                                    registry=registry, max_videos=cfg.parameter.max_videos)
+
+    if cfg.parameter.sampler == "random":
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            collate_fn=collate_delete_PAD,
+            batch_size=cfg.parameter.batch_size,
+            # plain shuffle, or shuffled shard by shard with shard_size
+            shuffle=not cfg.parameter.shard_size,
+            sampler=Shard_Sampler(train_dataset, shard_size=cfg.parameter.shard_size) if cfg.parameter.shard_size else None,
+            num_workers=2,
+            drop_last=True)
+    elif cfg.parameter.sampler == "density":
+        # windows of similar particle number in a batch
+        batch_sampler = Density_BatchSampler(train_dataset,
+                                batch_size=cfg.parameter.batch_size,
+                                max_tokens=cfg.parameter.max_tokens,
+                                crop_size=None if batch_transform is None else (256, 256),
+                                shard_size=cfg.parameter.shard_size)
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            collate_fn=collate_delete_PAD,
+            batch_sampler=batch_sampler,
+            num_workers=2)
+    else:
+        raise ValueError("sampler has values other than random and density.")
     val_loader = torch.utils.data.DataLoader(
         val_dataset,
         collate_fn=collate_delete_PAD,
@@ -54,11 +90,13 @@ def dataload(cfg):
         num_workers=2,
         drop_last=False)
     
-    return train_loader, val_loader
+    return train_loader, val_loader, batch_transform
 
 ############## train function ##############
-def train(model, train_loader, criterion, optimizer, device):
+def train(model, train_loader, criterion, optimizer, device, batch_transform=None, precision="fp32", scaler=None):
     model.train()
+    if scaler is None:
+        scaler = grad_scaler(precision)
     # Nondeterminism
     torch.backends.cudnn.deterministic = False
 
@@ -69,29 +107,49 @@ def train(model, train_loader, criterion, optimizer, device):
     for batch_idx, (inputs, targets, point) in tqdm(enumerate(train_loader), total=len(train_loader), leave=False):
         #image: input.size() => [batch,channel,length,H,W]
         #EP map: targets.size() => [batch,length,H,W]
-        #object coordinate: point.size() => [batch,length,num,4(frame,id,x,y)]
+        #object coordinate: point.size() => [num,4(frame,id,x,y)], packed points
 
         inputs = inputs.cuda(device, non_blocking=True)
         point = point.cuda(device, non_blocking=True)
         point = point.long()
+        if batch_transform is not None:
+            inputs, _, point = batch_transform(inputs, None, point)
 
-        vector, coordinate = model(inputs, point[:, :, :, [2, 3]])
-        loss = criterion(vector, point[:, :, :, 1], coordinate)
+        with autocast(device, precision):
+            vector, coordinate = model(inputs, point)
+        loss = criterion(vector, point, coordinate)
 
         optimizer.zero_grad()
-        loss.backward()
+        scaler.scale(loss).backward()
 
         sum_loss += loss.item()
 
         del loss    # free memory
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
     
     # Determinism
     torch.backends.cudnn.deterministic = True
     return sum_loss / (batch_idx + 1)
 
+############## checkpoint report ##############
+def checkpoint_cost(model, train_loader, criterion, device, batch_transform=None, precision="fp32"):
+    # training step of the first batch without and with activation checkpointing
+    inputs, _, point = next(iter(train_loader))
+    inputs = inputs.cuda(device, non_blocking=True)
+    point = point.cuda(device, non_blocking=True).long()
+    if batch_transform is not None:
+        inputs, _, point = batch_transform(inputs, None, point)
+
+    def step(net):
+        with autocast(device, precision):
+            vector, coordinate = net(inputs, point)
+        criterion(vector, point, coordinate).backward()
+
+    return checkpoint_report(model, step, device)
+
 ############## validation function ##############
-def val(model, val_loader, criterion, Track_transfor, Tracking_Eva, device):
+def val(model, val_loader, criterion, Track_transfor, Tracking_Eva, device, precision="fp32"):
     model.eval()
     coord_F = None
     # Determinism
@@ -101,14 +159,15 @@ def val(model, val_loader, criterion, Track_transfor, Tracking_Eva, device):
         for batch_idx, (inputs, targets, point) in tqdm(enumerate(val_loader), total=len(val_loader), leave=False):
             #image: input.size() => [batch,channel,length,H,W]
             #EP map: targets.size() => [batch,length,H,W]
-            #object coordinate: point.size() => [batch,length,num,4(frame,id,x,y)]
+            #object coordinate: point.size() => [num,4(frame,id,x,y)], packed points
             
             inputs = inputs.cuda(device, non_blocking=True)
             point = point.cuda(device, non_blocking=True)
             point = point.long()
 
             # use label coordinate
-            vector, coord, coord_F = model.tracking_process(inputs, point[:, :, :, [2, 3]], add_F_dict=coord_F)
+            with autocast(device, precision):
+                vector, coord, coord_F = model.tracking_process(inputs, point, add_F_dict=coord_F)
 
             Track_transfor.update(vector, coord)
     
@@ -133,6 +192,18 @@ def main(cfg):
     print("Positonal encoding".ljust(20) + f":{cfg.parameter.pos}")
     print("Attention".ljust(20) + f":{cfg.parameter.encoder}")
     print("Detection threshold".ljust(20) + f":{cfg.parameter.noise_strength}")
+    print("Split".ljust(20) + f":{cfg.parameter.split}")
+    print("Sequences".ljust(20) + f":{len(cfg.dataset.sequences)}")
+    print("EP map".ljust(20) + f":{cfg.parameter.EP_mode}")
+    print("Video".ljust(20) + f":{cfg.parameter.video}")
+    print("Normalize".ljust(20) + f":{cfg.parameter.normalize}")
+    print("Max videos".ljust(20) + f":{cfg.parameter.max_videos}")
+    print("Augmentation".ljust(20) + f":{cfg.parameter.augment}")
+    print("Sampler".ljust(20) + f":{cfg.parameter.sampler}")
+    print("Max tokens".ljust(20) + f":{cfg.parameter.max_tokens}")
+    print("Shard size".ljust(20) + f":{cfg.parameter.shard_size}")
+    print("Precision".ljust(20) + f":{cfg.parameter.precision}")
+    print("Checkpoint".ljust(20) + f":{cfg.parameter.checkpoint}")
     print("Backbone path".ljust(20) + f":{cfg.parameter.back_bone}")
     
     ##### GPU setting #####
@@ -150,7 +221,7 @@ def main(cfg):
         f.write("epoch\tPrecision\tRecall\tF1 Score\tID Switch\n")
     
     # data load
-    train_loader, val_loader = dataload(cfg)
+    train_loader, val_loader, batch_transform = dataload(cfg)
 
     move_limit = get_movelimit(train_loader.dataset, factor=1.1)
 
@@ -162,7 +233,17 @@ def main(cfg):
                             overlap_range=cfg.parameter.overlap_range,
                             pos_mode=cfg.parameter.pos,
                             encode_mode=cfg.parameter.encoder,
-                            move_limit=move_limit[0]).cuda(device)
+                            move_limit=move_limit[0],
+                            checkpoint=cfg.parameter.checkpoint).cuda(device)
+    # saved with the model, test.py does not recompute it
+    model.move_limit.copy_(torch.tensor(move_limit, dtype=torch.float64))
+
+    criterion = connected_loss(move_limit)
+
+    if cfg.parameter.checkpoint:
+        # memory saved by the recomputation and its cost, before the random numbers are fixed
+        for mode, (memory, seconds) in checkpoint_cost(model, train_loader, criterion, device, batch_transform, cfg.parameter.precision).items():
+            print(f"Checkpoint {mode}".ljust(20) + f":{memory / 2 ** 20:.1f} MB, {seconds:.3f} s/step")
 
     # random number fixing
     rand_seed = 0
@@ -174,9 +255,9 @@ def main(cfg):
     Track_transfor = Transformer_to_Track(tracking_mode="P", move_limit=move_limit)
     tracking_fnc = Object_Tracking()
 
-    criterion = connected_loss(move_limit)
-
     optimizer = torch.optim.Adam(model.parameters(), lr=cfg.scheduler.max)  # Adam
+    # loss scaling of fp16
+    scaler = grad_scaler(cfg.parameter.precision)
 
     scheduler = CosineAnnealingWarmupRestarts(optimizer,
             first_cycle_steps=cfg.scheduler.first,
@@ -194,10 +275,11 @@ def main(cfg):
         scheduler.step()
 
         # train
-        train_loss = train(model, train_loader, criterion, optimizer, device)
+        train_loss = train(model, train_loader, criterion, optimizer, device, batch_transform,
+                            precision=cfg.parameter.precision, scaler=scaler)
         # validation
         if epoch >= 10:
-            Tracking_acc = val(model, val_loader, criterion, Track_transfor, tracking_fnc, device)
+            Tracking_acc = val(model, val_loader, criterion, Track_transfor, tracking_fnc, device, precision=cfg.parameter.precision)
         else:
             Tracking_acc = {'mota': 0.0, 'idp': 0.0, 'idr': 0.0, 'idf1': 0.0, 'num_switches': 0}
 
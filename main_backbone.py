@@ -1,6 +1,7 @@
 #coding: utf-8
 #----- Standard Library -----#
 import hydra
+from omegaconf import OmegaConf
 import os
 import argparse
 import random
@@ -17,9 +18,9 @@ from tqdm import tqdm
 
 #----- Module -----#
 from utils.scheduler import CosineAnnealingWarmupRestarts
-from utils.dataset import OISTLoader, collate_delete_PAD
+from utils.dataset import OISTLoader, collate_delete_PAD, Density_BatchSampler, Shard_Sampler
 import utils.transforms as tf
-from utils.utils import get_movelimit
+from utils.utils import get_movelimit, pad_points, autocast, grad_scaler, checkpoint_report
 from utils.evaluation import Object_Detection
 from models.Unet_3D import UNet_3D, UNet_3D_FA
 from utils.loss import Contrastive_Loss
@@ -30,23 +31,58 @@ torch.autograd.set_detect_anomaly(True)
 ############## dataloader function ##############
 def dataload(cfg):
     ### data augmentation + preprocceing ###
-    train_transform = tf.Compose([tf.RandomCrop(size=(256, 256)),
-                                tf.RandomHorizontalFlip(p=0.5),
-                                tf.RandomVerticalFlip(p=0.5),
-                                ])
+    if cfg.parameter.augment == "sample":
+        # in the workers, per sample
+        train_transform = tf.Compose([tf.RandomCrop(size=(256, 256)),
+                                    tf.RandomHorizontalFlip(p=0.5),
+                                    tf.RandomVerticalFlip(p=0.5),
+                                    ])
+        batch_transform = None
+    elif cfg.parameter.augment == "batch":
+        # workers send raw uint8 windows, augmented after collate on the device
+        train_transform = None
+        batch_transform = tf.Batch_Compose([tf.Batch_RandomCrop(size=(256, 256)),
+                                    tf.Batch_RandomHorizontalFlip(p=0.5),
+                                    tf.Batch_RandomVerticalFlip(p=0.5),
+                                    ])
+    else:
+        raise ValueError("augment has values other than sample and batch.")
 
     val_transform = tf.Compose([])
+    # sequences and splits, config/dataset/*.yaml
+    registry = OmegaConf.to_container(cfg.dataset)
     
-    train_dataset = OISTLoader(mode="train", split=0, length=16, transform=train_transform)
-    val_dataset = OISTLoader(mode="val", split=0, length=16, transform=val_transform)
-
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset,
-        collate_fn=collate_delete_PAD,
-        batch_size=cfg.parameter.batch_size,
-        shuffle=True,
-        num_workers=2,
-        drop_last=True)
+    train_dataset = OISTLoader(mode="train", split=cfg.parameter.split, length=16, transform=train_transform, EP_mode=cfg.parameter.EP_mode,
+                                video=cfg.parameter.video, normalize=cfg.parameter.normalize,
+                                registry=registry, max_videos=cfg.parameter.max_videos)
+    val_dataset = OISTLoader(mode="val", split=cfg.parameter.split, length=16, transform=val_transform, EP_mode=cfg.parameter.EP_mode,
+                                video=cfg.parameter.video, normalize=cfg.parameter.normalize,
+                                registry=registry, max_videos=cfg.parameter.max_videos)
+
+    if cfg.parameter.sampler == "random":
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            collate_fn=collate_delete_PAD,
+            batch_size=cfg.parameter.batch_size,
+            # plain shuffle, or shuffled shard by shard with shard_size
+            shuffle=not cfg.parameter.shard_size,
+            sampler=Shard_Sampler(train_dataset, shard_size=cfg.parameter.shard_size) if cfg.parameter.shard_size else None,
+            num_workers=2,
+            drop_last=True)
+    elif cfg.parameter.sampler == "density":
+        # windows of similar particle number in a batch
+        batch_sampler = Density_BatchSampler(train_dataset,
+                                batch_size=cfg.parameter.batch_size,
+                                max_tokens=cfg.parameter.max_tokens,
+                                crop_size=None if batch_transform is None else (256, 256),
+                                shard_size=cfg.parameter.shard_size)
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            collate_fn=collate_delete_PAD,
+            batch_sampler=batch_sampler,
+            num_workers=2)
+    else:
+        raise ValueError("sampler has values other than random and density.")
     val_loader = torch.utils.data.DataLoader(
         val_dataset,
         collate_fn=collate_delete_PAD,
@@ -55,11 +91,13 @@ def dataload(cfg):
         num_workers=2,
         drop_last=False)
     
-    return train_loader, val_loader
+    return train_loader, val_loader, batch_transform
 
 ############## train function ##############
-def train(model, train_loader, criterion, optimizer, device):
+def train(model, train_loader, criterion, optimizer, device, batch_transform=None, precision="fp32", scaler=None):
     model.train()
+    if scaler is None:
+        scaler = grad_scaler(precision)
 
     # init setteing
     sum_loss = 0
@@ -68,60 +106,79 @@ def train(model, train_loader, criterion, optimizer, device):
     for batch_idx, (inputs, targets, point) in enumerate(tqdm(train_loader, leave=False)):
         #image: input.size() => [batch,channel,length,H,W]
         #EP map: targets.size() => [batch,length,H,W]
-        #object coordinate: point.size() => [batch,length,num,4(frame,id,x,y)]
+        #object coordinate: point.size() => [num,4(frame,id,x,y)], packed points
 
         inputs = inputs.cuda(device, non_blocking=True)
         targets = targets.cuda(device, non_blocking=True)
         point = point.cuda(device, non_blocking=True)
         point = point.long()
+        if batch_transform is not None:
+            inputs, targets, point = batch_transform(inputs, targets, point)
+        # the feature assignment needs a dense block, the contrastive loss pads window by window
+        coord = pad_points(point, inputs.shape[0], inputs.shape[2])[:, :, :, 2:]
 
-        predicts, feature, coord = model(inputs, point[:, :, :, 2:])
-        loss = criterion(predicts, feature, coord, targets, point[:, :, :, 1])
+        with autocast(device, precision):
+            predicts, feature, _ = model(inputs, coord)
+        loss = criterion(predicts, feature, point, targets)
 
         optimizer.zero_grad()
-        loss.backward()
+        scaler.scale(loss).backward()
 
         sum_loss += loss.item()
 
         del loss  # free memory
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
     
     return sum_loss / (batch_idx + 1)
 
+############## checkpoint report ##############
+def checkpoint_cost(model, train_loader, criterion, device, batch_transform=None, precision="fp32"):
+    # training step of the first batch without and with activation checkpointing
+    inputs, targets, point = next(iter(train_loader))
+    inputs = inputs.cuda(device, non_blocking=True)
+    targets = targets.cuda(device, non_blocking=True)
+    point = point.cuda(device, non_blocking=True).long()
+    if batch_transform is not None:
+        inputs, targets, point = batch_transform(inputs, targets, point)
+    coord = pad_points(point, inputs.shape[0], inputs.shape[2])[:, :, :, 2:]
+
+    def step(net):
+        with autocast(device, precision):
+            predicts, feature, _ = net(inputs, coord)
+        criterion(predicts, feature, point, targets).backward()
+
+    return checkpoint_report(model, step, device)
+
 ############## validation function ##############
-def val(model, val_loader, criterion, val_function, device):
+def val(model, val_loader, criterion, val_function, device, precision="fp32"):
     model.eval()
     
     with torch.no_grad():
         for batch_idx, (inputs, targets, point) in enumerate(tqdm(val_loader, leave=False)):
             #image: input.size() => [batch,channel,length,H,W]
             #EP map: targets.size() => [batch,length,H,W]
-            #object coordinate: point.size() => [batch,length,num,4(frame,id,x,y)]
+            #object coordinate: point.size() => [num,4(frame,id,x,y)], packed points
             inputs = inputs.cuda(device, non_blocking=True)
+            point = pad_points(point, inputs.shape[0], inputs.shape[2])
             point = point[:, :, :, 2:].cuda(device, non_blocking=True)
             point = point.long()
 
-            predicts, feature,coord = model(inputs)
+            with autocast(device, precision):
+                predicts, feature,coord = model(inputs)
 
             # Reduce impact of padding
+            frames = slice(0, predicts.shape[2] // 2) if batch_idx == 0 else slice(7, 8)
             for detection_val in val_function:
-                if batch_idx == 0:
-                    for frame_idx in range(predicts.shape[2] // 2):
-                        coordinate = detection_val.coordinater(predicts[:, :, frame_idx])  #[batch,1,H,W]
-                        label_point = point[:, frame_idx]
-                        detection_val.calculate(coordinate, label_point)
-                else:
-                    coordinate = detection_val.coordinater(predicts[:, :, 7])
-                    label_point = point[:, 7]
-                    detection_val.calculate(coordinate, label_point)
+                # frames at once, [batch,frame,num,2(x,y)]
+                coordinate = detection_val.coordinater(predicts[:, :, frames])
+                detection_val.calculate(coordinate.flatten(0, 1), point[:, frames].flatten(0, 1))
         
         
         for detection_val in val_function:
-            for frame_idx in range(predicts.shape[2] // 2):
-                coordinate = detection_val.coordinater(predicts[:, :, frame_idx + 8])  #[batch,1,H,W]
-                label_point = point[:, frame_idx + 8]
-                detection_val.calculate(coordinate, label_point)
+            coordinate = detection_val.coordinater(predicts[:, :, 8:])
+            detection_val.calculate(coordinate.flatten(0, 1), point[:, 8:].flatten(0, 1))
 
         detection_accuracy = [detection_val() for detection_val in val_function]
         
@@ -136,6 +193,18 @@ def main(cfg):
     print("Number of feature".ljust(20) + f":{cfg.parameter.feature_num}")
     print("Overlap range".ljust(20) + f":{cfg.parameter.overlap_range}")
     print("Detection threshold".ljust(20) + f":{cfg.parameter.noise_strength}")
+    print("Split".ljust(20) + f":{cfg.parameter.split}")
+    print("Sequences".ljust(20) + f":{len(cfg.dataset.sequences)}")
+    print("EP map".ljust(20) + f":{cfg.parameter.EP_mode}")
+    print("Video".ljust(20) + f":{cfg.parameter.video}")
+    print("Normalize".ljust(20) + f":{cfg.parameter.normalize}")
+    print("Max videos".ljust(20) + f":{cfg.parameter.max_videos}")
+    print("Augmentation".ljust(20) + f":{cfg.parameter.augment}")
+    print("Sampler".ljust(20) + f":{cfg.parameter.sampler}")
+    print("Max tokens".ljust(20) + f":{cfg.parameter.max_tokens}")
+    print("Shard size".ljust(20) + f":{cfg.parameter.shard_size}")
+    print("Precision".ljust(20) + f":{cfg.parameter.precision}")
+    print("Checkpoint".ljust(20) + f":{cfg.parameter.checkpoint}")
 
     ##### GPU setting #####
     device = torch.device('cuda:{}'.format(cfg.parameter.gpu) if torch.cuda.is_available() else 'cpu')
@@ -166,7 +235,7 @@ def main(cfg):
             f.write("Epoch\tAccuracy\tPrecition\tRecall\tF1_Score\n")
     
     # data load
-    train_loader, val_loader = dataload(cfg)
+    train_loader, val_loader, batch_transform = dataload(cfg)
 
     move_limit = get_movelimit(train_loader.dataset, factor=1.1)
 
@@ -175,10 +244,19 @@ def main(cfg):
         model = UNet_3D_FA(in_channels=1, n_classes=1,
                             feature_num=cfg.parameter.feature_num,
                             overlap_range=cfg.parameter.overlap_range,
-                            noise_strength=cfg.parameter.noise_strength).cuda(device)
+                            noise_strength=cfg.parameter.noise_strength,
+                            checkpoint=cfg.parameter.checkpoint).cuda(device)
     else:
         model = UNet_3D(in_channels=1, n_classes=1,
-                        noise_strength=cfg.parameter.noise_strength).cuda(device)
+                        noise_strength=cfg.parameter.noise_strength,
+                        checkpoint=cfg.parameter.checkpoint).cuda(device)
+
+    criterion = Contrastive_Loss(overlap_range=move_limit)
+
+    if cfg.parameter.checkpoint:
+        # memory saved by the recomputation and its cost, before the random numbers are fixed
+        for mode, (memory, seconds) in checkpoint_cost(model, train_loader, criterion, device, batch_transform, cfg.parameter.precision).items():
+            print(f"Checkpoint {mode}".ljust(20) + f":{memory / 2 ** 20:.1f} MB, {seconds:.3f} s/step")
 
     # random number fixing
     rand_seed = 0
@@ -186,9 +264,9 @@ def main(cfg):
     np.random.seed(rand_seed)  # numpy
     torch.manual_seed(rand_seed)  # pytorch
 
-    criterion = Contrastive_Loss(overlap_range=move_limit)
-
     optimizer = torch.optim.Adam(model.parameters(), lr=cfg.scheduler.max)  # Adam
+    # loss scaling of fp16
+    scaler = grad_scaler(cfg.parameter.precision)
     
     scheduler = CosineAnnealingWarmupRestarts(optimizer,
             first_cycle_steps=cfg.scheduler.first,
@@ -206,9 +284,10 @@ def main(cfg):
         scheduler.step()
 
         # train
-        train_loss = train(model, train_loader, criterion, optimizer, device)
+        train_loss = train(model, train_loader, criterion, optimizer, device, batch_transform,
+                            precision=cfg.parameter.precision, scaler=scaler)
         # validation
-        val_accuracy = val(model, val_loader, criterion, val_function, device)
+        val_accuracy = val(model, val_loader, criterion, val_function, device, precision=cfg.parameter.precision)
 
         ##### result #####
         result_text = "Epoch{:3d}/{:3d} TrainLoss={:.5f}".format(
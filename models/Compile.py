@@ -0,0 +1,163 @@
+#coding: utf-8
+#----- Standard Library -----#
+import os
+import glob
+import time
+import hashlib
+
+#----- Public Package -----#
+import torch
+import torch.nn as nn
+
+#----- Module -----#
+#None
+
+
+def channels_last(x):
+    """Channels-last-3D copy of a 5D tensor, other tensors as they are.
+    The [batch,T,num,d_model] inputs of the transformer are channels-last once permuted."""
+    if x.dim() == 5:
+        return x.contiguous(memory_format=torch.channels_last_3d)
+    return x
+
+
+def optimize(script):
+    # conv fusion and MKLDNN layouts on CPU, torch<1.10 has only freezing
+    if hasattr(torch.jit, "optimize_for_inference"):
+        return torch.jit.optimize_for_inference(script)
+    return torch.jit.freeze(script)
+
+
+def source_digest():
+    """sha1 of the model sources, traced graphs are rebuilt when the code changes."""
+    sha = hashlib.sha1(torch.__version__.encode())
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))):
+        with open(path, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+class Method(nn.Module):
+    def __init__(self, module, function):
+        """A method of a module as a module to trace, list outputs are flattened into the tuple.
+
+        Args:
+            module (nn.Module): owner of the parameters
+            function (method): bound method of module, kept even if the attribute is replaced
+        """
+        super().__init__()
+        self.module = module
+        self.function = function
+
+    def forward(self, *inputs):
+        outputs = self.function(*inputs)
+        if not isinstance(outputs, (tuple, list)):
+            return outputs
+        flat = []
+        for output in outputs:
+            flat.extend(output if isinstance(output, list) else [output])
+        return tuple(flat)
+
+
+class Graph_Cache(object):
+    def __init__(self, module, name, cache_dir, dynamic=False):
+        """Traced and optimized graphs of a module, one per input shape. Traced graphs are saved
+        in cache_dir, later runs load and optimize them instead of tracing.
+
+        Args:
+            module (nn.Module): eval mode module
+            name (str): file name prefix
+            cache_dir (str): directory of the graphs
+            dynamic (bool, optional): one graph for all input shapes, for graphs whose sizes are
+                read at run time. Defaults to False, a graph per shape.
+        """
+        self.module = module
+        self.name = name
+        self.cache_dir = cache_dir
+        self.dynamic = dynamic
+        self.graphs = {}
+
+        sha = hashlib.sha1(source_digest().encode())
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        self.digest = sha.hexdigest()
+
+    def __call__(self, *inputs):
+        inputs = [channels_last(x) for x in inputs]
+        key = tuple((x.dim() if self.dynamic else tuple(x.shape), str(x.dtype), str(x.device)) for x in inputs)
+        if key not in self.graphs:
+            self.graphs[key] = self.load(inputs, key)
+        return self.graphs[key](*inputs)
+
+    def load(self, inputs, key):
+        path = os.path.join(self.cache_dir, f"{self.name}_{hashlib.sha1(f'{self.digest}{key}'.encode()).hexdigest()}.pt")
+        if os.path.isfile(path):
+            graph = torch.jit.load(path, map_location=inputs[0].device)
+        else:
+            with torch.no_grad():
+                graph = torch.jit.trace(self.module, tuple(inputs), check_trace=False)
+
+            # other processes never see a half written graph
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.jit.save(graph, tmp_path)
+            os.replace(tmp_path, path)
+
+        # optimized graphs hold prepacked weights that can not be saved
+        return optimize(graph.eval())
+
+
+def compile_model(model, cache_dir="compiled"):
+    """Compiled execution of a PTGT model for inference, in place.
+    The backbone and the transformer are converted to channels-last(-3D) and their dense parts
+    are traced per window shape: the first backbone pass (inc, levels, EP map), the second pass
+    of the assignment model and the transformer, which reads the detection number at run time.
+    Detection and feature assignment stay eager.
+
+    Args:
+        model (PTGT): eval mode model
+        cache_dir (str, optional): directory of the traced graphs. Defaults to "compiled".
+
+    Returns:
+        PTGT: model
+    """
+    model.eval()
+    backbone = model.backbone.to(memory_format=torch.channels_last_3d)
+    transformer = model.transformer.to(memory_format=torch.channels_last)
+
+    # the sparse second pass needs the level outputs of the first, a graph of its own
+    name = "first_pass_sparse" if getattr(backbone, "sparse", False) else "first_pass"
+    first_pass = Graph_Cache(Method(backbone, backbone.first_pass), name, cache_dir)
+    if hasattr(backbone, "levels"):
+        # EP map, x1, level outputs
+        def compiled_first_pass(x):
+            out, x1, *cache = first_pass(x)
+            return out, x1, cache
+
+        backbone.first_pass = compiled_first_pass
+        backbone.levels = Graph_Cache(Method(backbone, backbone.levels), "levels", cache_dir)
+    else:
+        backbone.first_pass = first_pass
+
+    forward = transformer.forward
+    graph = Graph_Cache(Method(transformer, lambda inputs, pos, mask, coord:
+                                    forward({"inputs": inputs, "pos": pos, "mask": mask, "coord": coord})),
+                        "transformer", cache_dir, dynamic=True)
+    transformer.forward = lambda dict_tensor: graph(dict_tensor["inputs"], dict_tensor["pos"], dict_tensor["mask"], dict_tensor["coord"])
+    return model
+
+
+def throughput(function, *inputs, repeat=3, seed=0):
+    """Windows per second of a function after one warm-up call, with the same random numbers every call."""
+    with torch.random.fork_rng(), torch.no_grad():
+        torch.manual_seed(seed)
+        function(*inputs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeat):
+            torch.manual_seed(seed)
+            function(*inputs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    return repeat / (time.time() - start)
@@ -0,0 +1,127 @@
+#coding: utf-8
+#----- Standard Library -----#
+import copy
+
+#----- Public Package -----#
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+#----- Module -----#
+from .Unet_3D import Mish
+
+CONV = (nn.Conv1d, nn.Conv2d, nn.Conv3d)
+BATCHNORM = (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d)
+
+
+def fuse_sequential(sequential):
+    """Fold every BatchNorm into the convolution before it and make the activations after a
+    convolution in-place. The convolution output is a new tensor, nothing else reads it.
+
+    Args:
+        sequential (nn.Sequential): eval mode module
+
+    Returns:
+        nn.Sequential: fused module
+    """
+    layers = []
+    for layer in sequential:
+        if isinstance(layer, BATCHNORM) and layers and isinstance(layers[-1], CONV):
+            layers[-1] = fuse_conv_bn_eval(layers[-1], layer)
+        elif isinstance(layer, Mish) and layers and isinstance(layers[-1], CONV):
+            # one kernel instead of the softplus, tanh and product temporaries
+            layers.append(nn.Mish(inplace=True))
+        elif isinstance(layer, nn.ReLU) and layers and isinstance(layers[-1], CONV):
+            layers.append(nn.ReLU(inplace=True))
+        else:
+            layers.append(layer)
+    return nn.Sequential(*layers)
+
+
+def eval_only(self, mode=True):
+    # train() of a fused model
+    if mode:
+        raise RuntimeError("fused models are for inference only.")
+    return nn.Module.train(self, False)
+
+
+def fuse_model(model):
+    """Frozen inference copy of a model. BatchNorm is folded into the convolutions of every
+    nn.Sequential (DoubleConv of the U-Nets, MLP of Linear_Positional_Encoding) and Mish runs
+    in-place, so every block makes one pass less over its activations.
+    The copy has no gradients and can not return to train mode.
+
+    Args:
+        model (nn.Module): model, not changed
+
+    Returns:
+        nn.Module: fused model in eval mode
+    """
+    fused = copy.deepcopy(model).eval()
+
+    # children first, a fused Sequential is not visited again
+    def fuse(module):
+        for name, child in module.named_children():
+            fuse(child)
+            if isinstance(child, nn.Sequential):
+                setattr(module, name, fuse_sequential(child))
+
+    fuse(fused)
+
+    for param in fused.parameters():
+        param.requires_grad = False
+    fused.train = eval_only.__get__(fused)
+    return fused
+
+
+def max_difference(output, fused_output):
+    """Max absolute difference of nested outputs, inf when their structure, shape or integer values differ."""
+    if isinstance(output, torch.Tensor):
+        if not isinstance(fused_output, torch.Tensor) or output.shape != fused_output.shape:
+            return float("inf")
+        if not output.is_floating_point():
+            return 0. if torch.equal(output, fused_output) else float("inf")
+        return (output.float() - fused_output.float()).abs().max().item() if output.numel() != 0 else 0.
+    if isinstance(output, dict):
+        if not isinstance(fused_output, dict) or output.keys() != fused_output.keys():
+            return float("inf")
+        return max([max_difference(output[key], fused_output[key]) for key in output], default=0.)
+    if isinstance(output, (list, tuple)):
+        if not isinstance(fused_output, (list, tuple)) or len(output) != len(fused_output):
+            return float("inf")
+        return max([max_difference(value, value_fused) for value, value_fused in zip(output, fused_output)], default=0.)
+    return 0. if output == fused_output else float("inf")
+
+
+def check_parity(model, fused, *inputs, method="forward", atol=1e-3, seed=0):
+    """Numerical parity of a fused model with its original.
+    Both run method on the same inputs with the same random numbers.
+
+    Args:
+        model (nn.Module): original model
+        fused (nn.Module): output of fuse_model
+        *inputs: inputs of method
+        method (str, optional): method to compare. Defaults to "forward".
+        atol (float, optional): allowed max absolute difference. Defaults to 1e-3.
+        seed (int, optional): random seed of both runs. Defaults to 0.
+
+    Raises:
+        ValueError: outputs differ by more than atol, or detections differ
+
+    Returns:
+        float: max absolute difference
+    """
+    training = model.training
+    model.eval()
+    outputs = []
+    # the random state of the caller is restored
+    with torch.random.fork_rng(), torch.no_grad():
+        for net in [model, fused]:
+            torch.manual_seed(seed)
+            outputs.append(getattr(net, method)(*inputs))
+    model.train(training)
+
+    difference = max_difference(*outputs)
+    if difference > atol:
+        raise ValueError(f"fused model differs from the original by {difference}.")
+    return difference
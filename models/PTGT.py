@@ -9,6 +9,7 @@ import torch.nn.functional as F
 import torchvision
 
 #----- Module -----#
+from utils.utils import pad_points, pad_windows
 from .Unet_3D import UNet_3D, UNet_3D_FA
 from .Transformer import Transformer_3D
 from .Positional_Encoding import Sine_Positional_Encoding, Learned_Positional_Encoding, Linear_Positional_Encoding
@@ -48,6 +49,9 @@ class PTGT(nn.Module):
 
         self.None_token = nn.Parameter(torch.randn(1, self.d_model))
 
+        # move limit of delay 1, 2 and 3 saved with the checkpoint. 0 means unknown
+        self.register_buffer("move_limit", torch.zeros(3, dtype=torch.float64))
+
         # load pretrained model
         if back_bone_path is not None:
             root_dir = [path for path in os.path.dirname(__file__).split("/")[:-1]]
@@ -58,6 +62,12 @@ class PTGT(nn.Module):
         for param in self.backbone.parameters():
             param.requires_grad = False
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+        # checkpoints saved before the move limit was stored keep it unknown, state_dict is not changed
+        if prefix + "move_limit" in missing_keys:
+            missing_keys.remove(prefix + "move_limit")
+
     def forward_backbone(self, inputs):
         with torch.no_grad():
             _, feature, coordature = self.backbone(inputs)
@@ -90,7 +100,8 @@ class PTGT(nn.Module):
         vector = vector.squeeze(-1)
         vector = self.vector_embedding(vector).permute(0, 2, 3, 1)  #[batch,T,num+1,d_model]
 
-        vector[coord_take[:, :, :, -1] < 0, :] = 0.
+        # not in-place, ReLU keeps its output for backward
+        vector = vector.masked_fill((coord_take[:, :, :, -1] < 0)[..., None], 0.)
         vector[:, :, 0] = self.None_token
 
         mask = coordinate[:, :, :, 0] < 0
@@ -105,41 +116,54 @@ class PTGT(nn.Module):
 
         Args:
             inputs (tensor[batch,1,T,H,W]): inputs images
-            point (tensor[batch,T,num,2(x,y)], optional): specify position. Defaults to None.
+            point (tensor[rows,4(frame,id,x,y)], optional): specify position as packed points.
+                frame = batch index * T + frame in the window. Defaults to None.
 
         Returns:
-            tensor[batch,T,num,dim]: object vector
-            tensor[batch,T,num+1,2(x,y)]: object coordinate
+            list[tensor[1,T,num+1,dim]]: object vector of every window
+            list[tensor[1,T,num+1,2(x,y)]]: object coordinate of every window
         """
         batch, channel, T, H, W = inputs.size()
 
         if point is None:
             feature, coordinate = self.forward_backbone(inputs)
+            # detections come first in every frame, a window keeps its own max detection number
+            num = (coordinate[:, :, :, 0] >= 0).sum(dim=-1).amax(dim=-1).tolist()
+            coordinate = [coordinate[idx:idx + 1, :, :n] for idx, n in enumerate(num)]
 
         else:
-            coordinate = point
-            feature = self.backbone.get_feature(inputs, coordinate)
+            # the feature assignment needs a dense block of the batch
+            feature = self.backbone.get_feature(inputs, pad_points(point, batch, T)[:, :, :, [2, 3]])
+            coordinate = [block[:, :, :, [2, 3]] for block in pad_windows(point, batch, T)]
 
         #feature.size => [batch,channel,T,H,W]
-        #coordinate.size => [batch,T,num,2(x,y)]
+        #coordinate.size => [1,T,num,2(x,y)] of every window
 
-        vector, pos, mask, coordinate = self.feature_embedding(feature, coordinate)
+        # the embedding and the attention run window by window, without the PAD of denser windows
+        vectors, coordinates = [], []
+        for idx, coord in enumerate(coordinate):
+            vector, pos, mask, coord = self.feature_embedding(feature[idx:idx + 1], coord)
 
-        #vector.size() => [batch size, num cell, dim]
-        inputs = {
-            "inputs": vector,
-            "pos": pos,
-            "mask": mask,
-            "coord": coordinate
-        }
+            #vector.size() => [batch size, num cell, dim]
+            window = {
+                "inputs": vector,
+                "pos": pos,
+                "mask": mask,
+                "coord": coord
+            }
 
-        vector = self.transformer(inputs)
-        return vector, coordinate
+            vectors.append(self.transformer(window))
+            coordinates.append(coord)
+        return vectors, coordinates
 
     def tracking_process(self, inputs, coord=None, add_F_dict=None):
         # Batch size must be 1
         batch, channel, T, H, W = inputs.size()
 
+        # packed points [rows,4(frame,id,x,y)] to a dense block
+        if coord is not None:
+            coord = pad_points(coord, batch, T)[:, :, :, [2, 3]]
+
         feature, coordinate, add_F_dict = self.backbone.tracking_process(inputs, coord, add_F_dict)
 
         vector, pos, mask, coordinate = self.feature_embedding(feature, coordinate)
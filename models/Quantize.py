@@ -0,0 +1,122 @@
+#coding: utf-8
+#----- Standard Library -----#
+import copy
+
+#----- Public Package -----#
+import torch
+import torch.nn as nn
+import torch.quantization as tq
+
+#----- Module -----#
+#None
+
+
+class Pointwise_Linear(nn.Module):
+    def __init__(self, conv):
+        """1x1 Conv2d as nn.Linear over the channels, the layer dynamic quantization supports.
+
+        Args:
+            conv (nn.Conv2d): 1x1 convolution
+        """
+        super().__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight.data.copy_(conv.weight.data.flatten(1))
+        if conv.bias is not None:
+            self.linear.bias.data.copy_(conv.bias.data)
+
+    def forward(self, x):
+        # [batch,channel,T,num] => [batch,T,num,channel]
+        return self.linear(x.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+
+
+class Static_Conv(nn.Module):
+    def __init__(self, conv):
+        """1x1 Conv2d between quant and dequant stubs, static quantization observes the ranges of
+        its input and output during calibration. The attention around it stays float.
+
+        Args:
+            conv (nn.Conv2d): 1x1 convolution
+        """
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def is_pointwise(module):
+    return isinstance(module, nn.Conv2d) and module.kernel_size == (1, 1) and module.stride == (1, 1) \
+        and module.groups == 1 and module.padding == (0, 0)
+
+
+def replace_pointwise(module, wrap):
+    """Replace every 1x1 Conv2d under module with wrap(conv), in place."""
+    for name, child in module.named_children():
+        if is_pointwise(child):
+            setattr(module, name, wrap(child))
+        else:
+            replace_pointwise(child, wrap)
+
+
+def calibrate(model, windows, seed=0):
+    """Run a model on sample windows so that the observers of static quantization see the
+    activation ranges of real data.
+
+    Args:
+        model (PTGT): prepared model
+        windows (list[tensor[1,1,T,H,W]]): sample windows of consecutive frames
+        seed (int, optional): random seed of the feature assignment. Defaults to 0.
+    """
+    coord_F = None
+    with torch.random.fork_rng(), torch.no_grad():
+        torch.manual_seed(seed)
+        for inputs in windows:
+            _, _, coord_F = model.tracking_process(inputs, add_F_dict=coord_F)
+
+
+def quantize_model(model, mode="dynamic", windows=None):
+    """INT8 copy of a PTGT model for CPU inference. The 1x1 convolutions of the transformer
+    (qkv_proj, output_proj, the feed-forward layers) and of vector_embedding are quantized,
+    the backbone, the positional encoding and the attention stay float.
+
+    Args:
+        model (PTGT): model on CPU, not changed
+        mode (str, optional): dynamic (weights INT8, activations quantized per call) or static
+            (activation ranges calibrated on windows). Defaults to "dynamic".
+        windows (list[tensor[1,1,T,H,W]], optional): calibration windows of static. Defaults to None.
+
+    Returns:
+        PTGT: quantized model in eval mode
+    """
+    if mode not in ["dynamic", "static"]:
+        raise ValueError("mode has values other than dynamic and static.")
+    if mode == "static" and not windows:
+        raise ValueError("static quantization needs calibration windows.")
+    if any(param.is_cuda for param in model.parameters()):
+        raise ValueError("INT8 quantization runs on CPU.")
+
+    # x86 kernels, ARM otherwise
+    engines = torch.backends.quantized.supported_engines
+    torch.backends.quantized.engine = "fbgemm" if "fbgemm" in engines else "qnnpack"
+
+    quantized = copy.deepcopy(model).eval()
+    targets = [quantized.transformer, quantized.vector_embedding]
+
+    if mode == "dynamic":
+        for target in targets:
+            replace_pointwise(target, Pointwise_Linear)
+            tq.quantize_dynamic(target, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        return quantized
+
+    qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    for target in targets:
+        replace_pointwise(target, Static_Conv)
+    for module in quantized.modules():
+        if isinstance(module, Static_Conv):
+            module.qconfig = qconfig
+    tq.prepare(quantized, inplace=True)
+    calibrate(quantized, windows)
+    tq.convert(quantized, inplace=True)
+    return quantized
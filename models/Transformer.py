@@ -11,7 +11,12 @@ from torch.nn.init import xavier_uniform_, constant_, xavier_normal_
 from torch.nn.parameter import Parameter
 
 #----- Module -----#
-# None
+from utils.utils import checkpoint
+
+
+def mask_value(x):
+    """Logit of masked entries, -9e15 or the lowest float16 value under autocast."""
+    return -min(9e15, torch.finfo(x.dtype).max)
 
 # linner -> conv1*1
 class Transformer_3D(nn.Module):
@@ -21,6 +26,7 @@ class Transformer_3D(nn.Module):
                  activation=F.relu,
                  move_limit=25.,
                  Encoder="Normal",
+                 checkpoint=False,
                  **kwargs):
         super().__init__()
         
@@ -58,7 +64,7 @@ class Transformer_3D(nn.Module):
         else:
             raise ValueError("Encoder has values other than Normal, Distance, Time, and Both.")
 
-        self.encoder = TransformerEncoder(encoder_layer, num_encoder_layers)
+        self.encoder = TransformerEncoder(encoder_layer, num_encoder_layers, checkpoint)
 
         self._reset_parameters()
 
@@ -95,17 +101,28 @@ class Transformer_3D(nn.Module):
 
 
 class TransformerEncoder(nn.Module):
-    def __init__(self, encoder_layer, num_layers):
+    def __init__(self, encoder_layer, num_layers, checkpoint=False):
         super().__init__()
         self.layers = _get_clones(encoder_layer, num_layers)
         self.num_layers = num_layers
+        # activation checkpointing of every layer in training, the attention maps are recomputed in backward
+        self.checkpoint = checkpoint
 
     def forward(self, dict_tensor):
         for layer in self.layers:
-            dict_tensor["inputs"] = layer(dict_tensor)
+            if self.checkpoint and self.training and torch.is_grad_enabled():
+                dict_tensor["inputs"] = checkpoint(layer, dict_tensor["inputs"], dict_tensor["pos"],
+                                                    dict_tensor["mask"], dict_tensor["coord"], function=layer_function(layer))
+            else:
+                dict_tensor["inputs"] = layer(dict_tensor)
         return dict_tensor["inputs"]
 
 
+def layer_function(layer):
+    # encoder layer on tensors, a layer rewrites "inputs" of its dict and is recomputed from its own
+    return lambda inputs, pos, mask, coord: layer({"inputs": inputs, "pos": pos, "mask": mask, "coord": coord})
+
+
 class TransformerEncoderLayer_Normal(nn.Module):
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
                  activation=F.relu,
@@ -296,7 +313,7 @@ class MultiheadAttention(nn.Module):
         attn_logits = attn_logits / d_k ** 0.5
 
         if key_padding_mask is not None:
-            attn_logits = attn_logits.masked_fill(key_padding_mask[:, None, :, None], -9e15)
+            attn_logits = attn_logits.masked_fill(key_padding_mask[:, None, :, None], mask_value(attn_logits))
         attention = F.softmax(attn_logits, dim=-1)
 
         # Attention Map Drop out
@@ -376,7 +393,7 @@ class Dist_MultiheadAttention(nn.Module):
 
         if key_padding_mask is not None:
             attn_logits = attn_logits.masked_fill(
-                key_padding_mask[:, None, :, None], -9e15)
+                key_padding_mask[:, None, :, None], mask_value(attn_logits))
         attention = F.softmax(attn_logits, dim=-1)
 
         # Attention Map Drop out
@@ -474,7 +491,7 @@ class Time_MultiheadAttention(nn.Module):
         attn_logits = attn_logits * distance[:, None]
 
         if key_padding_mask is not None:
-            attn_logits = attn_logits.masked_fill(P_mask[:, None, :, None], -9e15)
+            attn_logits = attn_logits.masked_fill(P_mask[:, None, :, None], mask_value(attn_logits))
         attention = F.softmax(attn_logits, dim=-1)
 
         # Attention Map Drop out
@@ -493,7 +510,7 @@ class Time_MultiheadAttention(nn.Module):
         attn_logits = attn_logits * distance[:, None]
 
         if key_padding_mask is not None:
-            attn_logits = attn_logits.masked_fill(N_mask[:, None, :, None], -9e15)
+            attn_logits = attn_logits.masked_fill(N_mask[:, None, :, None], mask_value(attn_logits))
         attention = F.softmax(attn_logits, dim=-1)
 
         # Attention Map Drop out
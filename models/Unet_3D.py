@@ -10,7 +10,268 @@ import torchvision
 from torch.nn.init import xavier_uniform_, constant_, xavier_normal_
 
 #----- Module -----#
-#None
+from utils.detection import Peak_Detector, window_max
+from utils.assignment import assign_features
+from utils.utils import checkpoint
+
+
+def interpolate_axis(x, position, dim):
+    """Linear interpolation of x along dim at float positions.
+
+    Args:
+        x (tensor): input
+        position (tensor[num]): positions in [0, size-1], in pixels of x
+        dim (int): axis
+
+    Returns:
+        tensor: x with num elements along dim
+    """
+    size = x.shape[dim]
+    position = position.clamp(0, size - 1)
+    index = position.floor().long().clamp(max=max(size - 2, 0))
+    shape = [1] * x.dim()
+    shape[dim] = -1
+    weight = (position - index).to(x.dtype).view(shape)
+
+    x0 = x.index_select(dim, index)
+    x1 = x.index_select(dim, (index + 1).clamp(max=size - 1))
+    return x0 + (x1 - x0) * weight
+
+
+def upsample_region(x, region):
+    """x2 trilinear upsampling (align_corners=True) of a spatial tile, sampled at the positions where
+    upsampling the whole frame samples. align_corners scales by (size-1)/(2*size-1), so a tile upsampled
+    on its own would drift from the whole frame.
+
+    Args:
+        x (tensor[batch,channel,T,h,w]): tile
+        region (list[4(y,x,H,W)]): offset of the tile and the frame size at the level of x
+
+    Returns:
+        tensor[batch,channel,2T,2h,2w]: upsampled tile
+    """
+    offset_y, offset_x, H, W = region
+    T, h, w = x.shape[2:]
+
+    def position(offset, full, num):
+        # output pixel of the whole frame => input pixel of the whole frame => input pixel of the tile
+        out = torch.arange(2 * offset, 2 * offset + num, dtype=torch.float64, device=x.device)
+        return out * (full - 1) / max(2 * full - 1, 1) - offset
+
+    x = interpolate_axis(x, position(0, T, 2 * T), 2)
+    x = interpolate_axis(x, position(offset_y, H, 2 * h), 3)
+    return interpolate_axis(x, position(offset_x, W, 2 * w), 4)
+
+
+def tile_ranges(size, tile, halo):
+    """(read start, read stop, tile start, tile stop) of the tiles along an axis."""
+    return [(max(start - halo, 0), min(start + tile + halo, size), start, min(start + tile, size))
+            for start in range(0, size, tile)]
+
+
+def blend_weight(read_start, read_stop, start, stop, size, blend, device):
+    """Weight of a tile along an axis. 1 in the tile, linear ramps over blend pixels on both sides of
+    an inner tile border, so that the weights of neighbouring tiles sum to 1."""
+    position = torch.arange(read_start, read_stop, dtype=torch.float32, device=device) + 0.5
+    if blend == 0:
+        return ((position >= start) & (position < stop)).float()
+    rise = (position - start + blend) / (2 * blend) if start > 0 else torch.ones_like(position)
+    fall = (stop + blend - position) / (2 * blend) if stop < size else torch.ones_like(position)
+    return torch.min(rise, fall).clamp(0., 1.)
+
+
+def run_tiled(fn, x, tile, halo, blend=0):
+    """Run fn over overlapping spatial tiles of x and stitch its outputs.
+    Every tile is read with halo pixels around it. When halo covers the receptive field, the tile
+    is the same as in the whole frame run. Outputs are blended over blend pixels around inner tile
+    borders, blend=0 keeps the tile only.
+
+    Args:
+        fn (function): fn(x_tile, offset(list[2(y,x)])) => tuple of tensor[batch,C,T,h,w] of the tile size
+        x (tensor[batch,channel,T,H,W]): input
+        tile (int): tile size, multiple of 16
+        halo (int): pixels read around a tile, multiple of 16
+        blend (int, optional): blended pixels on both sides of an inner tile border. Defaults to 0.
+
+    Returns:
+        tuple of tensor[batch,C,T,H,W]: stitched outputs
+    """
+    if tile % 16 != 0 or halo % 16 != 0 or blend > halo:
+        raise ValueError("tile and halo have values other than multiples of 16, or blend is larger than halo.")
+
+    H, W = x.shape[-2:]
+    outputs = None
+    weight_sum = x.new_zeros([H, W])
+    for read_y0, read_y1, y0, y1 in tile_ranges(H, tile, halo):
+        for read_x0, read_x1, x0, x1 in tile_ranges(W, tile, halo):
+            results = fn(x[..., read_y0: read_y1, read_x0: read_x1], [read_y0, read_x0])
+            if outputs is None:
+                outputs = [result.new_zeros([*result.shape[:-2], H, W]) for result in results]
+
+            # only the tile and its blended border are written
+            write_y0, write_y1 = max(y0 - blend, read_y0), min(y1 + blend, read_y1)
+            write_x0, write_x1 = max(x0 - blend, read_x0), min(x1 + blend, read_x1)
+            weight = blend_weight(write_y0, write_y1, y0, y1, H, blend, x.device)[:, None] \
+                    * blend_weight(write_x0, write_x1, x0, x1, W, blend, x.device)[None]
+
+            for output, result in zip(outputs, results):
+                output[..., write_y0: write_y1, write_x0: write_x1] += weight.to(result.dtype) \
+                    * result[..., write_y0 - read_y0: write_y1 - read_y0, write_x0 - read_x0: write_x1 - read_x0]
+            weight_sum[write_y0: write_y1, write_x0: write_x1] += weight
+
+    return tuple(output / weight_sum.to(output.dtype) for output in outputs)
+
+
+def tile_coord(coord, offset, size):
+    """Detection coordinates in a tile, PAD=-1 outside.
+
+    Args:
+        coord (tensor[batch,num,2(x,y)]): detection coordinate, PAD=-1
+        offset (list[2(y,x)]): offset of the tile
+        size (list[2(h,w)]): tile size
+
+    Returns:
+        tensor[batch,num,2(x,y)]: coordinate in the tile
+    """
+    local = coord - coord.new_tensor([offset[1], offset[0]])
+    inside = (coord[..., 0] >= 0) & (local[..., 0] >= 0) & (local[..., 1] >= 0) \
+            & (local[..., 0] < size[1]) & (local[..., 1] < size[0])
+    return torch.where(inside[..., None], local, torch.full_like(local, -1))
+
+
+def unet_levels(model, x1, region=None, cache=None):
+    """down1..down4 and up1..up4 of a U-Net from the output of inc.
+
+    Args:
+        model (UNet_3D or UNet_3D_FA): model
+        x1 (tensor[batch,channel,T,H,W]): output of inc
+        region (list[4(y,x,H,W)], optional): offset of a tile and the frame size. Defaults to None, whole frames.
+        cache (list, optional): outputs of down1..down4 and up1..up4 are appended. Defaults to None.
+
+    Returns:
+        tensor[batch,channel,T,H,W]: feature map
+    """
+    def level(k):
+        return None if region is None else [value // 2 ** k for value in region]
+
+    def block(module, *inputs):
+        # checkpoint training keeps only the block inputs, the rest is recomputed in backward
+        if model.checkpoint and model.training and torch.is_grad_enabled():
+            return checkpoint(module, *inputs)
+        return module(*inputs)
+
+    x2 = block(model.down1, x1)
+    x3 = block(model.down2, x2)
+    x4 = block(model.down3, x3)
+    x5 = block(model.down4, x4)
+
+    x6 = block(model.up1, x5, x4, level(4))
+    x7 = block(model.up2, x6, x3, level(3))
+    x8 = block(model.up3, x7, x2, level(2))
+    x = block(model.up4, x8, x1, level(1))
+
+    if cache is not None:
+        cache.extend([x2, x3, x4, x5, x6, x7, x8, x])
+    return x
+
+
+# above this ratio of changed blocks a convolution runs on the whole map
+SPARSE_RATIO = 0.5
+
+
+def dilate(mask, size):
+    """Dilate mask[batch,H,W] by size pixels along y and x."""
+    if size == 0:
+        return mask
+    h = mask.float()
+    for dim in [-1, -2]:
+        h = window_max(h, 2 * size + 1, dim)
+    return h > 0
+
+
+def sparse_conv(conv, x, old, changed, block):
+    """DoubleConv of x recomputed only in the spatial blocks whose output changed, the rest is
+    taken from the output of the old input. Blocks are read with the halo of the convolutions and
+    convolved as one batch, out of frame voxels are zeroed between the convolutions like padding.
+    BatchNorm must be in eval mode.
+
+    Args:
+        conv (DoubleConv): module
+        x (tensor[batch,channel,T,H,W]): new input
+        old (tensor[batch,out_channel,T,H,W]): conv of the old input
+        changed (tensor[batch,H,W]): True where x differs from the old input in any frame
+        block (int): block size
+
+    Returns:
+        tensor[batch,out_channel,T,H,W]: conv of x
+        tensor[batch,H,W]: True where the output may differ from old
+    """
+    layers = list(conv.double_conv)
+    halo = sum(layer.kernel_size[-1] // 2 for layer in layers if isinstance(layer, nn.Conv3d))
+    changed = dilate(changed, halo)
+
+    H, W = x.shape[-2:]
+    grid = F.max_pool2d(changed.float(), block, ceil_mode=True) > 0
+    batch, block_y, block_x = torch.nonzero(grid, as_tuple=True)
+    if batch.shape[0] == 0:
+        return old, changed
+    if batch.shape[0] > SPARSE_RATIO * grid.numel():
+        return conv(x), changed
+
+    # [batch,channel,T,H,W] => blocks with halo [block,channel,T,size,size]
+    pad_y, pad_x = grid.shape[-2] * block - H, grid.shape[-1] * block - W
+    size = block + 2 * halo
+    read_y = (block_y * block)[:, None, None] + torch.arange(size, device=x.device)[None, :, None]
+    read_x = (block_x * block)[:, None, None] + torch.arange(size, device=x.device)[None, None, :]
+    h = F.pad(x, [halo, halo + pad_x, halo, halo + pad_y])[batch[:, None, None], :, :, read_y, read_x]
+    h = h.permute(0, 3, 4, 1, 2)
+    inside = F.pad(x.new_ones([H, W]), [halo, halo + pad_x, halo, halo + pad_y])[read_y, read_x][:, None, None]
+
+    for layer in layers:
+        if isinstance(layer, nn.Conv3d):
+            h = h * inside
+        h = layer(h)
+    h = h[..., halo: halo + block, halo: halo + block]
+
+    out = F.pad(old, [0, pad_x, 0, pad_y]) if pad_x or pad_y else old.clone()
+    out[batch[:, None, None], :, :, read_y[:, :block, :block], read_x[:, :block, :block]] = h.permute(0, 3, 4, 1, 2)
+    return out[..., :H, :W], changed
+
+
+def sparse_unet_levels(model, x1, changed, cache, block=32):
+    """unet_levels of a new x1 that recomputes only what changed since the cache was made.
+    Changed pixels are followed through the levels, every DoubleConv is recomputed in the blocks
+    its receptive field reaches (see sparse_conv), the rest is taken from the cache. Blocks span
+    all frames, the 4 time poolings reach every frame anyway.
+
+    Args:
+        model (UNet_3D_FA): model in eval mode
+        x1 (tensor[batch,channel,T,H,W]): new output of inc
+        changed (tensor[batch,H,W]): True where x1 differs from the x1 of the cache in any frame
+        cache (list): outputs of unet_levels for the old x1
+        block (int, optional): block size at the resolution of x1, halved at every level. Defaults to 32.
+
+    Returns:
+        tensor[batch,channel,T,H,W]: feature map
+    """
+    def pool(mask):
+        return F.max_pool2d(mask.float(), 2) > 0
+
+    x, skips = x1, [(x1, changed)]
+    for level, down in enumerate([model.down1, model.down2, model.down3, model.down4], 1):
+        maxpool, conv = down.maxpool_conv
+        x, changed = sparse_conv(conv, maxpool(x), cache[level - 1], pool(changed), max(block >> level, 4))
+        skips.append((x, changed))
+
+    for level, up in zip([3, 2, 1, 0], [model.up1, model.up2, model.up3, model.up4]):
+        skip, skip_changed = skips[level]
+        # trilinear upsampling reads the two nearest pixels, a transposed convolution one
+        changed = dilate(changed, 1) if up.bilinear else changed
+        changed = F.interpolate(changed[:, None].float(), scale_factor=2, mode="nearest")[:, 0] > 0
+        x = torch.cat([skip, up.up(x)], dim=1)
+        x, changed = sparse_conv(up.conv, x, cache[7 - level], changed | skip_changed, max(block >> level, 4))
+
+    return x
 
 
 class DoubleConv(nn.Module):
@@ -47,6 +308,7 @@ class Up(nn.Module):
     """Upscaling then double conv"""
     def __init__(self, in_channels, out_channels, bilinear=True):
         super().__init__()
+        self.bilinear = bilinear
         # if bilinear, use the normal convolutions to reduce the number of channels
         if bilinear:
             self.up = nn.Upsample(
@@ -57,8 +319,12 @@ class Up(nn.Module):
                 in_channels, in_channels // 2, kernel_size=2, stride=2)
             self.conv = DoubleConv(in_channels, out_channels)
 
-    def forward(self, x1, x2):
-        x1 = self.up(x1)
+    def forward(self, x1, x2, region=None):
+        # region: offset of a tile and the frame size at the level of x1, see upsample_region
+        if region is not None and self.bilinear:
+            x1 = upsample_region(x1, region)
+        else:
+            x1 = self.up(x1)
 
         x = torch.cat([x2, x1], dim=1)
         return self.conv(x)
@@ -91,6 +357,10 @@ class UNet_3D(nn.Module):
     def __init__(self, in_channels, n_classes, channel=32,
                 noise_strength=0.4,
                 bilinear=True,
+                tile=0,
+                halo=112,
+                blend=0,
+                checkpoint=False,
                 **kwargs):
         super().__init__()
         self.in_channels = in_channels
@@ -110,10 +380,16 @@ class UNet_3D(nn.Module):
         self.outc = nn.Conv3d(channel, n_classes, kernel_size=1, bias=True)
         
         # kernel_size = 4*sigma+0.5
-        self.gaussian_filter = torchvision.transforms.GaussianBlur((13, 13), sigma=3)
-        self.maxpool = nn.MaxPool2d(11, stride=1, padding=(11 - 1) // 2)
+        self.detector = Peak_Detector(pool_range=11, kernel_size=13, sigma=3.)
         self.noise_strength = noise_strength
 
+        # tiled inference, tile=0 runs whole frames. the receptive field is 110 pixels
+        self.tile = tile
+        self.halo = halo
+        self.blend = blend
+        # activation checkpointing of the Down and Up blocks in training
+        self.checkpoint = checkpoint
+
     def coordinater(self, out):
         """Function to detect the position of an object from a probability map
 
@@ -121,37 +397,43 @@ class UNet_3D(nn.Module):
             out (tensor[batch,1,length,H,W]): The probability map section is [0,1]
 
         Returns:
-            tensor[batch,length,2(x,y)]: detection coordinate
+            tensor[batch,length,num,2(x,y)]: detection coordinate
         """       
-        h = out.flatten(0, 2)
-        h = (h >= self.noise_strength) * (h == self.maxpool(h)) * 1.0
-        for _ in range(3):
-            h = self.gaussian_filter(h)
-            h = (h != 0) * (h == self.maxpool(h)) * 1.0
-        
-        coordinate = torch.nonzero(h)  #[detection number, 3(batch,y,x)]
-        coordinate = [coordinate[coordinate[:, 0] == batch, 1:] for batch in range(h.size(0))]
-        coordinate = torch.nn.utils.rnn.pad_sequence(coordinate, batch_first=True, padding_value=-1)
-        #[batch*length,num,2(y,x)] => [batch*length,num,2(x,y)]
-        coordinate = coordinate[:, :, [1, 0]]
+        # every frame at once, padded to the max detection number
+        coordinate = self.detector(out[:, 0], self.noise_strength)
+        return coordinate #[batch,length,num,2(x,y)], PAD=-1
 
-        coordinate = coordinate.view(out.size(0), out.size(2), -1, 2)
-        return coordinate #[batch,length,num,2(x,y)]
+    def tiled_forward(self, x):
+        """EP map and feature map tile by tile, see run_tiled.
 
-    def forward(self, x, coord=None):
-        x1 = self.inc(x)
+        Args:
+            x (tensor[batch,channel,length,H,W]): input
 
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
+        Returns:
+            tensor[batch,1,length,H,W]: EP map
+            tensor[batch,channel,length,H,W]: feature map
+        """
+        H, W = x.shape[-2:]
 
-        x = self.up1(x5, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        x = self.up4(x, x1)
-        out = self.outc(x)
-        out = torch.sigmoid(out)
+        def process(tile, offset):
+            feature = unet_levels(self, self.inc(tile), [*offset, H, W])
+            return torch.sigmoid(self.outc(feature)), feature
+
+        return run_tiled(process, x, self.tile, self.halo, self.blend)
+
+    def first_pass(self, x):
+        """EP map and feature map of whole frames, the part of the model without detection."""
+        x = unet_levels(self, self.inc(x))
+        return torch.sigmoid(self.outc(x)), x
+
+    def forward(self, x, coord=None):
+        if self.tile:
+            out, x = self.tiled_forward(x)
+            if coord is None:
+                coord = self.coordinater(out)
+            return out, x, coord
+
+        out, x = self.first_pass(x)
 
         if coord is None:
             coord = self.coordinater(out)
@@ -173,20 +455,15 @@ class UNet_3D(nn.Module):
         return x  # feature map
 
     def tracking_process(self, x, coord=None, add_F_dict=None):
-        x1 = self.inc(x)
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
+        if self.tile:
+            out, x = self.tiled_forward(x)
+            if coord is None:
+                coord = self.coordinater(out)
+            return x, coord, add_F_dict
 
-        x = self.up1(x5, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        x = self.up4(x, x1)
+        out, x = self.first_pass(x)
 
         if coord is None:
-            out = self.outc(x)
-            out = torch.sigmoid(out)
             coord = self.coordinater(out)
 
         return x, coord, add_F_dict
@@ -198,6 +475,12 @@ class UNet_3D_FA(nn.Module):
                 overlap_range=100.,
                 noise_strength=0.5,
                 bilinear=True,
+                tile=0,
+                halo=112,
+                blend=0,
+                sparse=False,
+                block=32,
+                checkpoint=False,
                 **kwargs):
         super().__init__()
         self.in_channels = in_channels
@@ -224,10 +507,37 @@ class UNet_3D_FA(nn.Module):
 
         # def detection function
         # kernel_size = 4*sigma+0.5
-        self.gaussian_filter = torchvision.transforms.GaussianBlur((13, 13), sigma=3)
-        self.maxpool = nn.MaxPool2d(11, stride=1, padding=(11 - 1) // 2)
+        self.detector = Peak_Detector(pool_range=11, kernel_size=13, sigma=3.)
         self.noise_strength = noise_strength
 
+        # tiled inference, tile=0 runs whole frames. the receptive field is 110 pixels
+        self.tile = tile
+        self.halo = halo
+        self.blend = blend
+        # in eval mode, the second pass recomputes only the blocks the assigned features reach
+        self.sparse = sparse
+        self.block = block
+        # activation checkpointing of the Down and Up blocks in training
+        self.checkpoint = checkpoint
+
+    def first_pass(self, x):
+        """EP map, output of inc and level outputs (see unet_levels) of whole frames.
+        The level outputs are kept only for the sparse second pass, otherwise the list is empty."""
+        x1 = self.inc(x)
+        cache = [] if self.sparse and not self.training else None
+        x = unet_levels(self, x1, cache=cache)
+        return torch.sigmoid(self.outc(x)), x1, cache if cache is not None else []
+
+    def levels(self, x1):
+        """Feature map of the output of inc."""
+        return unet_levels(self, x1)
+
+    def second_pass(self, new_x1, x1, cache):
+        """Feature map of the assigned x1. Recomputed sparsely from the first pass in sparse eval mode."""
+        if self.sparse and not self.training and cache:
+            return sparse_unet_levels(self, new_x1, (new_x1 != x1).any(dim=2).any(dim=1), cache, self.block)
+        return self.levels(new_x1)
+
     def random_feature_addtion(self, feature_map, coord, len_=0):
         """Random Feature Assignment Module
 
@@ -242,28 +552,11 @@ class UNet_3D_FA(nn.Module):
 
         coord = coord[:, len_]
 
-        PAD_flag = coord[:, :, 0] < 0
-        PAD_flag = PAD_flag[:, :, None] | PAD_flag[:, None, :] #[batch,num,num]
-
-        coord_feature_idx = torch.randint(self.feature_num, coord.shape[:2],device=coord.device)
-
-        for _ in range(20):
-            distance = (coord[:, :, None] - coord[:, None])**2
-            distance = distance.sum(dim=-1)
-            distance = distance <= self.overlap_range
-            distance[PAD_flag] = False
-
-            overlap_flag = coord_feature_idx[:, :, None] == coord_feature_idx[:, None, :]
-
-            overlap_flag = (overlap_flag & distance).sum(dim=-1)
-            overlap_flag = overlap_flag > 1
-
-            if overlap_flag.sum() == 0:
-                break
-            coord_feature_idx[overlap_flag] = torch.randint(self.feature_num, [overlap_flag.sum()],device=coord.device)
+        # no two detections in the overlap range share a feature, the neighbour graph is built once on a grid
+        coord_feature_idx = assign_features(coord, coord[:, :, 0] >= 0, self.feature_num, self.overlap_range)
 
         PAD_flag = coord[:, :, 0] < 0
-        add_feature = self.addtional_feature[coord_feature_idx[~PAD_flag]]
+        add_feature = self.addtional_feature[coord_feature_idx[~PAD_flag]].to(feature_map.dtype)
 
         batch_idx = torch.arange(coord.size(0)*coord.size(1),dtype=torch.long, device=coord.device).view(coord.shape[:2]) // coord.size(1)
 
@@ -288,7 +581,7 @@ class UNet_3D_FA(nn.Module):
         """        
 
         PAD_flag = coord[:, :, 0] < 0
-        add_feature = self.addtional_feature[coord_feature_idx[~PAD_flag]]
+        add_feature = self.addtional_feature[coord_feature_idx[~PAD_flag]].to(feature_map.dtype)
 
         batch_idx = torch.arange(coord.size(0) * coord.size(1), dtype=torch.long, device=coord.device).view(coord.shape[:2]) // coord.size(1)
 
@@ -306,52 +599,70 @@ class UNet_3D_FA(nn.Module):
             out (tensor[batch,1,length,H,W]): The probability map section is [0,1]
 
         Returns:
-            tensor[batch,length,2(x,y)]: detection coordinate
+            tensor[batch,length,num,2(x,y)]: detection coordinate
         """     
-        h = out.flatten(0, 2)
-        h = (h >= self.noise_strength) * (h == self.maxpool(h)) * 1.0
-        for _ in range(3):
-            h = self.gaussian_filter(h)
-            h = (h != 0) * (h == self.maxpool(h)) * 1.0
-        
-        coordinate = torch.nonzero(h)  #[detection number, 3(batch,y,x)]
-        coordinate = [coordinate[coordinate[:, 0] == batch, 1:] for batch in range(h.size(0))]
-        coordinate = torch.nn.utils.rnn.pad_sequence(coordinate, batch_first=True, padding_value=-1)
-        #[batch*length,num,2(y,x)] => [batch*length,num,2(x,y)]
-        coordinate = coordinate[:, :, [1, 0]]
+        # every frame at once, padded to the max detection number
+        coordinate = self.detector(out[:, 0], self.noise_strength)
+        return coordinate #[batch,length,num,2(x,y)], PAD=-1
+
+    def tiled_forward(self, x, coord=None, add_F_dict=None, detect=True):
+        """EP map and feature map tile by tile, see run_tiled.
+        Detections and their feature indices are found on the whole frames, then every tile
+        assigns the features of the detections inside it.
+
+        Args:
+            x (tensor[batch,channel,length,H,W]): input
+            coord (tensor[batch,length,num,2(x,y)], optional): detection coordinate. Defaults to None, detected.
+            add_F_dict (dict, optional): features of the first frame, from the previous window. Defaults to None, random.
+            detect (bool, optional): compute the EP map when coord is given. Defaults to True.
+
+        Returns:
+            tensor[batch,1,length,H,W]: EP map, None when not computed
+            tensor[batch,channel,length,H,W]: feature map
+            tensor[batch,length,num,2(x,y)]: detection coordinate
+            dict: features of the last frame
+        """
+        H, W = x.shape[-2:]
+
+        out = None
+        if coord is None or detect:
+            def detection(tile, offset):
+                return torch.sigmoid(self.outc(unet_levels(self, self.inc(tile), [*offset, H, W]))),
+
+            out, = run_tiled(detection, x, self.tile, self.halo, self.blend)
+            if coord is None:
+                coord = self.coordinater(out)
+
+        # in the same order as random_feature_addtion draws them
+        if add_F_dict is None:
+            add_F_dict = {'coord': coord[:, 0],
+                        'coord_feature_idx': assign_features(coord[:, 0], coord[:, 0, :, 0] >= 0, self.feature_num, self.overlap_range)}
+        last_F_dict = {'coord': coord[:, -1],
+                    'coord_feature_idx': assign_features(coord[:, -1], coord[:, -1, :, 0] >= 0, self.feature_num, self.overlap_range)}
+
+        def assignment(tile, offset):
+            size = tile.shape[-2:]
+            x1 = self.inc(tile)
+            x1 = self.feature_addtion(x1, tile_coord(add_F_dict['coord'], offset, size), add_F_dict['coord_feature_idx'])
+            x1 = self.feature_addtion(x1, tile_coord(last_F_dict['coord'], offset, size), last_F_dict['coord_feature_idx'], len_=-1)
+            return unet_levels(self, x1, [*offset, H, W]),
 
-        coordinate = coordinate.view(out.size(0), out.size(2), -1, 2)
-        return coordinate #[batch,length,num,2(x,y)]
+        feature, = run_tiled(assignment, x, self.tile, self.halo, self.blend)
+        return out, feature, coord, last_F_dict
 
     def forward(self, x, coord=None):
-        x1 = self.inc(x)
-        
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
+        if self.tile:
+            out, x, coord, _ = self.tiled_forward(x, coord)
+            return out, x, coord
 
-        x = self.up1(x5, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        x = self.up4(x, x1)
-        out = self.outc(x)
-        out = torch.sigmoid(out)
+        out, x1, cache = self.first_pass(x)
 
         if coord is None:
             coord = self.coordinater(out)
         new_x1, _ = self.random_feature_addtion(x1, coord)
         new_x1, _ = self.random_feature_addtion(new_x1, coord, len_=-1)
-        
-        x2 = self.down1(new_x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
 
-        x = self.up1(x5, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        x = self.up4(x, new_x1)
+        x = self.second_pass(new_x1, x1, cache)
 
         return out, x, coord  # EP map, feature map, coordinate
 
@@ -373,21 +684,15 @@ class UNet_3D_FA(nn.Module):
         return x  # feature map
 
     def tracking_process(self, x, coord=None, add_F_dict=None):
-        x1 = self.inc(x)
-        if coord is None:
-            x2 = self.down1(x1)
-            x3 = self.down2(x2)
-            x4 = self.down3(x3)
-            x5 = self.down4(x4)
-
-            x = self.up1(x5, x4)
-            x = self.up2(x, x3)
-            x = self.up3(x, x2)
-            x = self.up4(x, x1)
-            out = self.outc(x)
-            out = torch.sigmoid(out)
+        if self.tile:
+            _, x, coord, add_F_dict = self.tiled_forward(x, coord, add_F_dict, detect=False)
+            return x, coord, add_F_dict
 
+        if coord is None:
+            out, x1, cache = self.first_pass(x)
             coord = self.coordinater(out)
+        else:
+            x1, cache = self.inc(x), []
 
         if add_F_dict is None:
             new_x1, _ = self.random_feature_addtion(x1, coord)
@@ -395,15 +700,7 @@ class UNet_3D_FA(nn.Module):
             new_x1 = self.feature_addtion(x1, add_F_dict['coord'], add_F_dict['coord_feature_idx'])
         
         new_x1, add_F_dict = self.random_feature_addtion(new_x1, coord, len_=-1)
-        
-        x2 = self.down1(new_x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
 
-        x = self.up1(x5, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        x = self.up4(x, new_x1)
+        x = self.second_pass(new_x1, x1, cache)
 
         return x, coord, add_F_dict
\ No newline at end of file
@@ -1,11 +1,13 @@
 #coding: utf-8
 #----- Standard Library -----#
 import os
+import copy
 import random
 import time
 
 #----- Public Package -----#
 import hydra
+from omegaconf import OmegaConf
 import numpy as np
 import torch
 import torchvision
@@ -13,21 +15,32 @@ import torch.nn as nn
 from tqdm import tqdm
 
 #----- Module -----#
-from utils.dataset import OISTLoader, OISTLoader_add, collate_delete_PAD
+from utils.dataset import OISTLoader_add, collate_delete_PAD, read_move_statistics
 import utils.transforms as tf
-from utils.utils import get_movelimit
+from utils.utils import get_movelimit, pad_points, autocast
 from utils.Transformer_to_track import Transformer_to_Track
 from utils.evaluation import Object_Detection,Object_Tracking
 from models.PTGT import PTGT
+from models.Fusion import fuse_model, check_parity
+from models.Compile import compile_model, throughput
+from models.Quantize import quantize_model
 
 ############## dataloader function ##############
-def dataload(cfg):
+def dataload(cfg, move_limit=None):
     ### data augmentation + preprocceing ###
     test_transform = tf.Compose([])
+    # sequences and splits, config/dataset/*.yaml
+    registry = OmegaConf.to_container(cfg.dataset)
     
-    test_dataset = OISTLoader_add(mode="test", split=0, length=16, transform=test_transform)
-    mode_limit_dataset = OISTLoader(mode="train", split=0, length=16)
-    move_limit = get_movelimit(mode_limit_dataset)
+    test_dataset = OISTLoader_add(mode="test", split=cfg.parameter.split, length=16, transform=test_transform, EP_mode=cfg.parameter.EP_mode,
+                                    video=cfg.parameter.video, normalize=cfg.parameter.normalize,
+                                    registry=registry, max_videos=cfg.parameter.max_videos)
+    if move_limit is None or not move_limit.any():
+        # checkpoints without the move limit: motion statistics of the train split, read from its dataset cache
+        move_limit = get_movelimit(read_move_statistics(mode="train", split=cfg.parameter.split, length=16, EP_mode=cfg.parameter.EP_mode,
+                                                            video=cfg.parameter.video, registry=registry))
+    else:
+        move_limit = move_limit.tolist()
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset,
@@ -39,8 +52,16 @@ def dataload(cfg):
     
     return test_loader, move_limit
 
+def calibration_windows(cfg, num):
+    # first windows of the val split, activation ranges of static quantization
+    registry = OmegaConf.to_container(cfg.dataset)
+    val_dataset = OISTLoader_add(mode="val", split=cfg.parameter.split, length=16, transform=tf.Compose([]), EP_mode=cfg.parameter.EP_mode,
+                                    video=cfg.parameter.video, normalize=cfg.parameter.normalize,
+                                    registry=registry, max_videos=cfg.parameter.max_videos)
+    return [val_dataset[idx][0][None] for idx in range(min(num, len(val_dataset)))]
+
 ############## test function ##############
-def test(model, test_loader, TtT, device):
+def test(model, test_loader, TtT, device, precision="fp32"):
     model.eval()
     coord_F = None
 
@@ -52,12 +73,14 @@ def test(model, test_loader, TtT, device):
         for batch_idx, (inputs, targets, point) in tqdm(enumerate(test_loader), total=len(test_loader), leave=False):
             #image: input.size() => [batch,channel,length,H,W]
             #EP map: targets.size() => [batch,length,H,W]
-            #object coordinate: point.size() => [batch,length,num,4(frame,id,x,y)]
-            inputs = inputs.cuda(device, non_blocking=True)
-            point = point.cuda(device, non_blocking=True)
+            #object coordinate: point.size() => [num,4(frame,id,x,y)], packed points
+            inputs = inputs.to(device, non_blocking=True)
+            point = point.to(device, non_blocking=True)
             point = point.long()
+            point = pad_points(point, inputs.shape[0], inputs.shape[2])
 
-            vector, coord, coord_F = model.tracking_process(inputs, add_F_dict=coord_F)
+            with autocast(device, precision):
+                vector, coord, coord_F = model.tracking_process(inputs, add_F_dict=coord_F)
 
             # update Tracking
             TtT.update(vector, coord)
@@ -82,12 +105,31 @@ def main(cfg):
     print("Positonal encoding".ljust(20) + f":{cfg.parameter.pos}")
     print("Attention".ljust(20) + f":{cfg.parameter.encoder}")
     print("Detection threshold".ljust(20) + f":{cfg.parameter.noise_strength}")
+    print("Split".ljust(20) + f":{cfg.parameter.split}")
+    print("Sequences".ljust(20) + f":{len(cfg.dataset.sequences)}")
+    print("EP map".ljust(20) + f":{cfg.parameter.EP_mode}")
+    print("Video".ljust(20) + f":{cfg.parameter.video}")
+    print("Normalize".ljust(20) + f":{cfg.parameter.normalize}")
+    print("Max videos".ljust(20) + f":{cfg.parameter.max_videos}")
+    print("Tile".ljust(20) + f":{cfg.parameter.tile}")
+    print("Sparse update".ljust(20) + f":{cfg.parameter.sparse}")
+    print("Fuse".ljust(20) + f":{cfg.parameter.fuse}")
+    print("Compile".ljust(20) + f":{cfg.parameter.compile}")
+    print("Precision".ljust(20) + f":{cfg.parameter.precision}")
+    print("Quantize".ljust(20) + f":{cfg.parameter.quantize}")
     print("Backbone path".ljust(20) + f":{cfg.parameter.back_bone}")
 
 
 
+    if cfg.parameter.quantize not in ["none", "dynamic", "static"]:
+        raise ValueError("quantize has values other than none, dynamic and static.")
+    if cfg.parameter.quantize != "none" and cfg.parameter.precision != "fp32":
+        raise ValueError("quantize needs precision fp32.")
+
     ##### GPU setting #####
-    device = torch.device('cuda:{}'.format(cfg.parameter.gpu) if torch.cuda.is_available() else 'cpu')
+    # INT8 kernels run on CPU
+    use_gpu = torch.cuda.is_available() and cfg.parameter.quantize == "none"
+    device = torch.device('cuda:{}'.format(cfg.parameter.gpu) if use_gpu else 'cpu')
 
     if not os.path.exists("result"):
         os.mkdir("result")
@@ -97,8 +139,11 @@ def main(cfg):
     with open(PATH, mode='w') as f:
         f.write("")
     
+    model_path = "result/model.pth"
+    state_dict = torch.load(model_path, map_location=device)
+
     # data load
-    test_loader, move_limit = dataload(cfg)
+    test_loader, move_limit = dataload(cfg, state_dict.get("move_limit"))
 
     # def model
     model = PTGT(back_bone_path=cfg.parameter.back_bone,
@@ -108,22 +153,48 @@ def main(cfg):
                     feature_num=cfg.parameter.feature_num,
                     overlap_range=cfg.parameter.overlap_range,
                     encode_mode=cfg.parameter.encoder,
-                    move_limit=move_limit[0]).cuda(device)
+                    move_limit=move_limit[0],
+                    tile=cfg.parameter.tile,
+                    sparse=cfg.parameter.sparse).to(device)
+
+    model.load_state_dict(state_dict)
+
+    # fp32 model of the quantized one, its tracking is the reference of the INT8 accuracy
+    reference = None
+    if cfg.parameter.fuse or cfg.parameter.compile or cfg.parameter.quantize != "none":
+        # inference model, compared with the original on the first window
+        optimized = fuse_model(model) if cfg.parameter.fuse else copy.deepcopy(model).eval()
+        if cfg.parameter.quantize != "none":
+            windows = calibration_windows(cfg, cfg.parameter.calibration) if cfg.parameter.quantize == "static" else None
+            reference = optimized
+            optimized = quantize_model(optimized, mode=cfg.parameter.quantize, windows=windows)
+        if cfg.parameter.compile:
+            optimized = compile_model(optimized, cache_dir="result/compiled")
+        inputs = next(iter(test_loader))[0].to(device, non_blocking=True)
+        if reference is None:
+            print("Parity error".ljust(20) + f":{check_parity(model, optimized, inputs, method='tracking_process')}")
+        print("Eager".ljust(20) + f":{throughput(model.tracking_process, inputs):.3f} windows/s")
+        print("Optimized".ljust(20) + f":{throughput(optimized.tracking_process, inputs):.3f} windows/s")
+        model = optimized
 
-    model_path = "result/model.pth"
-    model.load_state_dict(torch.load(model_path))
+    torch.backends.cudnn.benchmark = True
 
-    # random number fixing
-    rand_seed = 0
-    random.seed(rand_seed)  # python
-    np.random.seed(rand_seed)  # numpy
-    torch.manual_seed(rand_seed)  # pytorch
+    # same random numbers for the reference and the model
+    def fix_seed(rand_seed=0):
+        random.seed(rand_seed)  # python
+        np.random.seed(rand_seed)  # numpy
+        torch.manual_seed(rand_seed)  # pytorch
 
-    torch.backends.cudnn.benchmark = True
+    if reference is not None:
+        fix_seed()
+        TtT = Transformer_to_Track(tracking_mode="P", move_limit=move_limit)
+        Tracking_ref, _ = test(reference, test_loader, TtT, device, precision=cfg.parameter.precision)
 
+    # tracks of the model are saved after the reference
+    fix_seed()
     TtT = Transformer_to_Track(tracking_mode="P", move_limit=move_limit)
 
-    Tracking, Detection = test(model, test_loader, TtT, device)
+    Tracking, Detection = test(model, test_loader, TtT, device, precision=cfg.parameter.precision)
 
     with open(PATH, mode='a') as f:
         for k in Detection.keys():
@@ -137,6 +208,9 @@ def main(cfg):
         f.write("\n")
         for v in Tracking.values():
             f.write(f"{v}\t")
+        if reference is not None:
+            f.write("\nIDF1 delta\tMOTA delta\n")
+            f.write(f"{Tracking['idf1'] - Tracking_ref['idf1']}\t{Tracking['mota'] - Tracking_ref['mota']}\t")
     
     #Accuracy, Precition, Recall, F1_Score
     print("Detection Evalution")
@@ -147,6 +221,12 @@ def main(cfg):
     for k, v in Tracking.items():
         print(f"{k}".ljust(20) + f":{v}")
 
+    if reference is not None:
+        # INT8 - fp32
+        print("Quantization Evalution")
+        print("IDF1 delta".ljust(20) + f":{Tracking['idf1'] - Tracking_ref['idf1']}")
+        print("MOTA delta".ljust(20) + f":{Tracking['mota'] - Tracking_ref['mota']}")
+
 
 
 ############## main ##############
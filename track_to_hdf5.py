@@ -4,64 +4,114 @@ import sys
 import os
 import glob
 import re
+import argparse
+import hashlib
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 #----- Public Package -----#
 import numpy as np
 import h5py
 
 #----- Module -----#
-#None
+from utils.utils import annotation_index
+from utils.storage import write_annotation_index
 
 
 def sort_np(data):
-    sort_index = np.argsort(data[:, 0])
+    # stable sort keeps the rows of a frame in id order
+    sort_index = np.argsort(data[:, 0], kind="stable")
     data = data[sort_index]
     return data
 
 def dir_in_path(path):
+    # sequences are the directories with tracks, data/cache and other directories are skipped
     files = os.listdir(path)
-    files_dir = [os.path.join("./data", f) for f in files if os.path.isdir(os.path.join(path, f))]
+    files_dir = [os.path.join("./data", f) for f in files if os.path.isdir(os.path.join(path, f, "tracks"))]
     return files_dir
 
-OIST_datatase_dir = sorted(dir_in_path("./data"))
-for path_1 in OIST_datatase_dir:
-    print(path_1)
-    # make save file
-    hdf5_f = h5py.File(os.path.join("./data","Cell_Point_Annotation.hdf5"), mode='a')
-    
-    dat_paths = sorted(glob.glob(os.path.join(path_1, "tracks", "*.dat")))
-
-    data_list = np.empty([0, 4])
-
-    for idx, path_2 in enumerate(dat_paths):
-        data = np.loadtxt(path_2, dtype=str)
-        
-        if data.shape[0] == 0:
-            print(path_2)
-            continue
-        
-        if data.ndim == 2:
-            data = data[:, :3].astype(np.float32)
-        elif data.ndim == 1:
-            data = data[:3].astype(np.float32).reshape(1, 3)
+def load_dat(path):
+    """Read one track file.
+
+    Args:
+        path (str): path of .dat file. Each row is [frame,x,y,...]
+
+    Returns:
+        np.ndarray[num,3(frame,x,y)]: track rows, float32
+    """
+    with warnings.catch_warnings():
+        # empty .dat files are reported by the caller
+        warnings.simplefilter("ignore")
+        data = np.loadtxt(path, usecols=(0, 1, 2), ndmin=2, dtype=np.float32)
+    return data
+
+def dat_fingerprint(dat_paths):
+    """Fingerprint of a sequence's track files (name, size, mtime)."""
+    sha = hashlib.sha1()
+    for path in dat_paths:
+        stat = os.stat(path)
+        sha.update(f"{os.path.basename(path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return sha.hexdigest()
 
+def build_table(dat_paths, tracks):
+    """Build [frame,id,x,y] table in one preallocated pass.
+
+    Args:
+        dat_paths (list[str]): sorted .dat paths. id is index + 1
+        tracks (list[np.ndarray[num,3(frame,x,y)]]): parsed track files
+
+    Returns:
+        np.ndarray[rows,4(frame,id,x,y)]: annotation table sorted at frame
+    """
+    count = np.array([track.shape[0] for track in tracks], dtype=np.int64)
+    offset = np.concatenate([[0], np.cumsum(count)])
+
+    data_list = np.empty([offset[-1], 4], dtype=np.float32)
+    for idx, (path, track) in enumerate(zip(dat_paths, tracks)):
+        if track.shape[0] == 0:
+            print(path)
+            continue
         # first id=1
-        data = np.concatenate([np.full([data.shape[0], 1], idx + 1), data], axis=1)
-        data_list = np.concatenate([data_list, data], axis=0)
-    
-    # Swap frame and id
-    temp = data_list[:, 0].copy()
-    data_list[:, 0] = data_list[:, 1]
-    data_list[:, 1] = temp
-    
+        data_list[offset[idx]: offset[idx + 1], 0] = track[:, 0]
+        data_list[offset[idx]: offset[idx + 1], 1] = idx + 1
+        data_list[offset[idx]: offset[idx + 1], 2:] = track[:, 1:]
+
     # sort at frame
-    data_list = sort_np(data_list)
+    return sort_np(data_list)
+
+def ingest(hdf5_path="./data/Cell_Point_Annotation.hdf5", workers=None, force=False):
+    OIST_datatase_dir = sorted(dir_in_path("./data"))
+
+    with h5py.File(hdf5_path, mode='a') as hdf5_f, ProcessPoolExecutor(max_workers=workers) as executor:
+        for path_1 in OIST_datatase_dir:
+            print(path_1)
+            name = os.path.basename(path_1)
+            dat_paths = sorted(glob.glob(os.path.join(path_1, "tracks", "*.dat")))
+
+            # only re-ingest sequences whose .dat files changed since the last run
+            fingerprint = dat_fingerprint(dat_paths)
+            if not force and name in hdf5_f and hdf5_f[name].attrs.get("fingerprint") == fingerprint \
+                    and "index" in hdf5_f and name in hdf5_f["index"]:
+                print("unchanged, skip")
+                continue
+
+            tracks = list(executor.map(load_dat, dat_paths, chunksize=64))
+            data_list = build_table(dat_paths, tracks)
+
+            # save hdf5 file
+            if name in hdf5_f:
+                del hdf5_f[name]
+            dataset = hdf5_f.create_dataset(name=name, data=data_list, dtype=np.float32)
+            dataset.attrs["fingerprint"] = fingerprint
+
+            # frame and id offsets for O(1) per-frame and per-track slices
+            write_annotation_index(hdf5_f, name, annotation_index(data_list))
+
 
-    # save hdf5 file
-    try:
-        dataset = hdf5_f.create_dataset(name=path_1.split("/")[-1], data=data_list, dtype=np.float32)
-    except:
-        del hdf5_f[path_1.split("/")[-1]]
-        dataset = hdf5_f.create_dataset(name=path_1.split("/")[-1], data=data_list, dtype=np.float32)
-    
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None, help="number of parser processes")
+    parser.add_argument("--force", action="store_true", help="re-ingest every sequence")
+    args = parser.parse_args()
 
+    ingest(workers=args.workers, force=args.force)
@@ -0,0 +1,177 @@
+#coding: utf-8
+#----- Standard Library -----#
+import math
+from collections import OrderedDict
+
+#----- Public Package -----#
+import numpy as np
+import torch
+
+#----- Module -----#
+#None
+
+def gaussian_splat(coord, frame_num, size, sigma=2., radius=None):
+    """Render existence probability maps by splatting a Gaussian around each particle.
+    Each particle only touches its local ±radius window, and overlapping Gaussians are
+    merged with max as in the dense distance map.
+
+    Args:
+        coord (tensor[num,3(frame,x,y)]): particle coordinate. frame must be in [0,frame_num)
+        frame_num (int): number of rendered frames
+        size (list[2(H, W)]): frame size
+        sigma (float, optional): Gaussian sigma. Defaults to 2.
+        radius (int, optional): window radius. Defaults to ceil(4*sigma).
+
+    Returns:
+        tensor[frame_num,H,W]: EP maps, float32 on the device of coord
+    """
+    H, W = size
+    device = coord.device
+    if radius is None:
+        radius = int(math.ceil(4 * sigma))
+
+    EP = torch.zeros(frame_num * H * W, dtype=torch.float32, device=device)
+    if coord.size(0) == 0:
+        return EP.view(frame_num, H, W)
+
+    # window offsets, [K]
+    offset = torch.arange(-radius, radius + 1, device=device)
+    offset_y = offset[:, None].expand(-1, offset.size(0)).flatten()
+    offset_x = offset[None, :].expand(offset.size(0), -1).flatten()
+    # squared distance is an integer, so the Gaussian is a lookup table
+    dist2 = offset_y ** 2 + offset_x ** 2
+    kernel = torch.exp(-0.5 * torch.arange(2 * radius ** 2 + 1, device=device, dtype=torch.float32) / sigma ** 2)
+
+    coord = torch.round(coord.float()).long()
+    frame = coord[:, 0, None]
+    x = coord[:, 1, None] + offset_x
+    y = coord[:, 2, None] + offset_y
+
+    #[num,K]
+    valid = (x >= 0) & (x < W) & (y >= 0) & (y < H) & (frame >= 0) & (frame < frame_num)
+    index = (frame * H + y) * W + x
+    index = index[valid]
+    dist2 = dist2.expand_as(valid)[valid]
+
+    # max of Gaussians = Gaussian of the nearest particle.
+    # sort by (pixel, distance) and keep the first entry of every pixel
+    key = index * (2 * radius ** 2 + 1) + dist2
+    key = key.sort()[0]
+    index = key // (2 * radius ** 2 + 1)
+    dist2 = key % (2 * radius ** 2 + 1)
+    first = torch.ones_like(index, dtype=torch.bool)
+    first[1:] = index[1:] != index[:-1]
+
+    EP[index[first]] = kernel[dist2[first]]
+    return EP.view(frame_num, H, W)
+
+
+class EP_Renderer():
+    def __init__(self, points, offsets, sigma=2., cache_size=256):
+        """Render EP maps of frames on demand from the annotation, keeping an LRU cache of rendered frames.
+        Whole frames are cached, so overlapping windows reuse them whatever their crop.
+
+        Args:
+            points (tensor[rows,4(frame,id,x,y)]): packed annotation of every frame
+            offsets (np.ndarray[frame+1]): rows of frame f are points[offsets[f]:offsets[f+1]]
+            sigma (float, optional): Gaussian sigma. Defaults to 2.
+            cache_size (int, optional): maximum number of cached frames. Defaults to 256.
+        """
+        self.points = points
+        self.offsets = offsets
+        self.sigma = sigma
+        self.radius = int(math.ceil(4 * sigma))
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __call__(self, frames, region, size):
+        """Render a region of frames
+
+        Args:
+            frames (list[int]): frame index
+            region (list[4(i,j,h,w)]): top, left, height and width of the region
+            size (list[2(H, W)]): frame size
+
+        Returns:
+            tensor[len(frames),h,w]: EP maps
+        """
+        i, j, h, w = region
+
+        missing = [frame for frame in frames if frame not in self.cache]
+        if len(missing) != 0:
+            # rows of the missing frames, [rows,4(frame,id,x,y)]
+            missing_idx = np.asarray(missing)
+            start = self.offsets[missing_idx]
+            count = self.offsets[missing_idx + 1] - start
+            rows = np.arange(count.sum()) + np.repeat(start - (np.cumsum(count) - count), count)
+            point = self.points[torch.from_numpy(rows)]
+            frame_idx = torch.from_numpy(np.repeat(np.arange(len(missing)), count))
+
+            coord = torch.stack([frame_idx.float(), point[:, 2].float(), point[:, 3].float()], dim=-1)
+            EP = gaussian_splat(coord, len(missing), size, sigma=self.sigma, radius=self.radius)
+
+            for frame, image in zip(missing, EP):
+                self.cache[frame] = image
+
+        # the max of Gaussians is local, a crop of the frame is the render of the region
+        EP = []
+        for frame in frames:
+            self.cache.move_to_end(frame)
+            EP.append(self.cache[frame][i:i + h, j:j + w])
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return torch.stack(EP, dim=0)
+
+
+class EP_Target():
+    def __init__(self, renderer, frames, size):
+        """Lazy EP label of a window. Crop and flip only move the region, render() draws it.
+
+        Args:
+            renderer (EP_Renderer): EP renderer
+            frames (list[int]): frame index of the window
+            size (list[2(H, W)]): frame size
+        """
+        self.renderer = renderer
+        self.frames = frames
+        self.size = size
+        # region in the frame coordinate [top,left,height,width]
+        self.region = [0, 0, *size]
+        self.is_hflip = False
+        self.is_vflip = False
+
+    @property
+    def shape(self):
+        return (len(self.frames), self.region[2], self.region[3])
+
+    def crop(self, top, left, height, width):
+        # crop position in the frame coordinate
+        if self.is_hflip:
+            left = self.region[3] - left - width
+        if self.is_vflip:
+            top = self.region[2] - top - height
+        self.region = [self.region[0] + top, self.region[1] + left, height, width]
+        return self
+
+    def hflip(self):
+        self.is_hflip = not self.is_hflip
+        return self
+
+    def vflip(self):
+        self.is_vflip = not self.is_vflip
+        return self
+
+    def render(self):
+        """Render EP maps
+
+        Returns:
+            tensor[length,H,W]: EP maps
+        """
+        EP = self.renderer(self.frames, self.region, self.size)
+        if self.is_hflip:
+            EP = EP.flip(-1)
+        if self.is_vflip:
+            EP = EP.flip(-2)
+        return EP
@@ -40,7 +40,8 @@ class Transformer_to_Track:
         self.MAX_Connect_Number = 100
 
     def update(self, vector, coordinate):
-        vector = F.normalize(vector, dim=-1).flatten(0, 1)
+        # cosine similarity in float32 under autocast
+        vector = F.normalize(vector.float(), dim=-1).flatten(0, 1)
         vector = vector.transpose(0, 1).to('cpu').detach().clone()
         for connect_vector in self.connect_vector:
             # [batch*T,num,dim]
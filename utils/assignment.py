@@ -0,0 +1,115 @@
+#coding: utf-8
+#----- Standard Library -----#
+import math
+
+#----- Public Package -----#
+import torch
+
+#----- Module -----#
+#None
+
+
+def segment_rank(segment, num):
+    """Position of every element in its segment, segment is sorted."""
+    count = torch.bincount(segment, minlength=num)
+    return torch.arange(segment.shape[0], device=segment.device) - (torch.cumsum(count, dim=0) - count)[segment]
+
+
+def neighbour_pairs(coord, valid, overlap_range):
+    """Pairs of detections closer than the overlap range, found on a spatial grid.
+    Detections are hashed to cells of sqrt(overlap_range) and only the 3x3 cells around a
+    detection are compared, O(N*k) for k neighbours instead of O(N^2).
+
+    Args:
+        coord (tensor[batch,num,2(x,y)]): detection coordinate
+        valid (tensor[batch,num]): False at PAD
+        overlap_range (float): squared distance of an overlap
+
+    Returns:
+        tensor[pairs]: flat index (batch*num + idx) of a detection
+        tensor[pairs]: flat index of its neighbour, every pair appears in both directions
+    """
+    node = torch.nonzero(valid.flatten(), as_tuple=True)[0]
+    if node.shape[0] == 0:
+        return node, node
+
+    xy = coord.flatten(0, 1)[node].long()
+    batch = node // coord.shape[1]
+    cell_size = max(int(math.ceil(math.sqrt(overlap_range))), 1)
+    # +1 so that the cells around every detection have a non-negative index
+    cell = torch.div(xy, cell_size, rounding_mode="floor") + 1
+    grid_x, grid_y = int(cell[:, 0].max()) + 2, int(cell[:, 1].max()) + 2
+
+    def cell_key(dx, dy):
+        return (batch * grid_y + cell[:, 1] + dy) * grid_x + cell[:, 0] + dx
+
+    order = torch.argsort(cell_key(0, 0))
+    sorted_key = cell_key(0, 0)[order]
+
+    src, dst = [], []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            key = cell_key(dx, dy)
+            start = torch.searchsorted(sorted_key, key)
+            count = torch.searchsorted(sorted_key, key, right=True) - start
+            # every detection against every detection of the cell
+            owner = torch.repeat_interleave(torch.arange(node.shape[0], device=node.device), count)
+            src.append(owner)
+            dst.append(order[start[owner] + segment_rank(owner, node.shape[0])])
+    src, dst = torch.cat(src), torch.cat(dst)
+
+    distance = ((xy[src] - xy[dst]) ** 2).sum(dim=-1)
+    keep = (src != dst) & (distance <= overlap_range)
+    return node[src[keep]], node[dst[keep]]
+
+
+def assign_features(coord, valid, feature_num, overlap_range):
+    """Random feature index of every detection, different from every detection in its overlap range.
+    Indices are drawn at random, then conflicts are repaired by greedy graph colouring on the
+    neighbour graph: in every round an independent set of conflicting detections (the highest
+    random priority among their conflicting neighbours) takes the first index after a random
+    start that no neighbour uses. The result is conflict free whenever a detection has fewer than
+    feature_num neighbours.
+
+    Args:
+        coord (tensor[batch,num,2(x,y)]): detection coordinate
+        valid (tensor[batch,num]): False at PAD
+        feature_num (int): number of feature vectors
+        overlap_range (float): squared distance of an overlap
+
+    Returns:
+        tensor[batch,num]: feature index, random at PAD
+    """
+    feature_idx = torch.randint(feature_num, coord.shape[:2], device=coord.device)
+    src, dst = neighbour_pairs(coord, valid, overlap_range)
+    if src.shape[0] == 0:
+        return feature_idx
+
+    color = feature_idx.flatten()
+    num = color.shape[0]
+    priority = torch.randperm(num, device=coord.device)
+    # detections with more than feature_num - 1 neighbours can not always be repaired
+    active = torch.ones(num, dtype=torch.bool, device=coord.device)
+
+    while True:
+        conflict = (color[src] == color[dst]) & active[src]
+        conflicted = torch.bincount(src[conflict], minlength=num) > 0
+        if not conflicted.any():
+            break
+
+        # a conflicting detection waits when a conflicting neighbour has a higher priority
+        wait = conflicted[src] & conflicted[dst] & active[dst] & (priority[dst] > priority[src])
+        selected = conflicted & ~(torch.bincount(src[wait], minlength=num) > 0)
+
+        # first index after a random start that no neighbour uses, the mex of the shifted neighbour indices
+        start = torch.randint(feature_num, [num], device=coord.device)
+        edge = selected[src]
+        used = torch.unique(src[edge] * feature_num + (color[dst[edge]] - start[src[edge]]) % feature_num)
+        used_node, used_shift = torch.div(used, feature_num, rounding_mode="floor"), used % feature_num
+        # used shifts are unique and sorted, they match their rank until the first free shift
+        free = torch.bincount(used_node[used_shift == segment_rank(used_node, num)], minlength=num)
+
+        color = torch.where(selected & (free < feature_num), (start + free) % feature_num, color)
+        active &= ~(selected & (free >= feature_num))
+
+    return color.view(feature_idx.shape)
@@ -4,6 +4,7 @@ import re
 import os
 import random
 import glob
+from collections import OrderedDict
 
 #----- Public Package -----#
 import h5py
@@ -14,73 +15,473 @@ import torch.utils.data as data
 from PIL import Image
 
 #----- Module -----#
-#None
+from utils.EP_map import EP_Renderer, EP_Target
+from utils.transforms import split_crop, crop_points
+from utils.storage import load_video, load_tiff_stack, read_annotation, source_fingerprint, save_cache, load_cache, load_meta, hdf5_file
+from utils.utils import move_statistics
 
 PAD_ID = -1
+# sequences and splits of the OIST GFP data, the same as config/dataset/GFP.yaml
+OIST_REGISTRY = {
+    "sequences": {
+        "Density_Mid_GFP1": {"path": "Density_Mid_GFP1/video", "frames": [0, 100]},
+        "Density_Mid_GFP2": {"path": "Density_Mid_GFP2/video", "frames": [0, 100]},
+        "Density_Low_GFP1": {"path": "Density_Low_GFP1/video", "frames": [0, 100]}},
+    "splits": [
+        {"train": ["Density_Mid_GFP1", "Density_Mid_GFP2"], "val": ["Density_Mid_GFP2"], "test": ["Density_Low_GFP1"]}]}
+# bump when the cached arrays change
+CACHE_VERSION = 4
+
+
+def share_array(array):
+    """Copy array into shared memory. Forked workers read it without copying pages.
+
+    Args:
+        array (np.ndarray): array
+
+    Returns:
+        np.ndarray: array backed by shared memory
+    """
+    return torch.from_numpy(np.ascontiguousarray(array)).share_memory_().numpy()
+
+
+def take_window(array, frame, region=None):
+    """Window of a sequence array. Consecutive frames are returned as a view.
+
+    Args:
+        array (np.ndarray[frame,H,W] or h5py.Dataset[frame,H,W]): sequence array
+        frame (np.ndarray[length]): frame index in the sequence
+        region (list[4(i,j,h,w)], optional): only this region of the frames is read. Defaults to None.
+
+    Returns:
+        np.ndarray[length,H,W]: window
+    """
+    rows = cols = slice(None)
+    if region is not None:
+        i, j, h, w = region
+        rows, cols = slice(i, i + h), slice(j, j + w)
+
+    if frame[-1] - frame[0] == len(frame) - 1:
+        return array[frame[0]: frame[-1] + 1, rows, cols]
+    if isinstance(array, h5py.Dataset):
+        # h5py takes only increasing indexes without repeats
+        return array[frame.min(): frame.max() + 1, rows, cols][frame - frame.min()]
+    return array[frame, rows, cols]
+
+
+def video_sources(use_paths, video="png"):
+    """Source files of the used sequences.
+
+    Args:
+        use_paths (list[str]): PNG directory of every used sequence
+        video (str, optional): png (PNG directory, cached as uint8 video.npy) or
+            tiff (uncompressed multi-page video.tif next to the PNG directory, read in place). Defaults to "png".
+
+    Returns:
+        list[list[str]]: source files of every sequence
+    """
+    if video == "png":
+        return [sorted(glob.glob(path + "/*.png")) for path in use_paths]
+    elif video == "tiff":
+        return [[os.path.join(os.path.dirname(path), "video.tif")] for path in use_paths]
+    raise ValueError("video has values other than png and tiff.")
+
+
+def open_video(use_path, img_paths, video="png"):
+    """Memory mapped [frame,H,W] video of a sequence.
+
+    Args:
+        use_path (str): PNG directory of the sequence
+        img_paths (list[str]): source files of the sequence, see video_sources
+        video (str, optional): png or tiff, see video_sources. Defaults to "png".
+
+    Returns:
+        np.ndarray[frame,H,W]: video, uint8 for png and the native bit depth for tiff
+    """
+    if video == "png":
+        # uint8 [frame,H,W] memory map, built from the PNGs on first use
+        return load_video(img_paths, os.path.join(os.path.dirname(use_path), "video.npy"))
+    # native bit depth, normalized per window in __getitem__ of the dataset
+    return load_tiff_stack(img_paths[0])
+
+
+class Video_Store(object):
+    def __init__(self, use_paths, use_frames, video="png", max_open=0):
+        """Memory mapped videos of the used sequences, indexed by sequence.
+        A video is mapped on first use and at most max_open stay mapped in a process, the least
+        recently used is unmapped first. With shard ordered sampling only the videos of a shard are mapped.
+
+        Args:
+            use_paths (list[str]): PNG directory of every used sequence
+            use_frames (list[list[2(start,stop)]]): used frames of every sequence
+            video (str, optional): png or tiff, see video_sources. Defaults to "png".
+            max_open (int, optional): videos mapped at once per process. Defaults to 0, no limit.
+        """
+        self.use_paths = use_paths
+        self.use_frames = use_frames
+        self.video = video
+        self.max_open = max_open
+        self.img_paths = video_sources(use_paths, video)
+        self.opened = OrderedDict()
+
+        # [frame,H,W] of every sequence. PNG videos are converted to video.npy here on first use
+        self.shapes = [self[seq].shape for seq in range(len(use_paths))]
+
+    def __getitem__(self, seq):
+        if seq in self.opened:
+            self.opened.move_to_end(seq)
+            return self.opened[seq]
+
+        video = open_video(self.use_paths[seq], self.img_paths[seq], self.video)
+        start, stop = self.use_frames[seq]
+        self.opened[seq] = video[start: stop]
+
+        if self.max_open and len(self.opened) > self.max_open:
+            # unmapped when the last window using it is released
+            self.opened.popitem(last=False)
+        return self.opened[seq]
 
+    def __len__(self):
+        return len(self.use_paths)
 
-##### OIST dataset #####
-class OISTLoader(data.Dataset):
-    def __init__(self, mode="train", split=0, length=16, transform=None):
-        # split can be used only when 0
-        root_dir = [path for path in os.path.dirname(__file__).split("/")[:-1]]
-        root_dir = os.path.join(*root_dir, "data")
-
-        use_data_list = {
-                        "GFP":
-                            ["Density_Mid_GFP1/video",
-                            "Density_Mid_GFP2/video",
-                            "Density_Low_GFP1/video"]}
-
-        use_frame_list = {
-            "GFP": [[0, 100], [0, 100], [0, 100]]}
-        
-        split_list = [{"train": [0,1], "val": [1], "test": [2]}]
 
-        self.length = length
+def normalize_window(image, mode="percentile"):
+    """float32 [0,1] window of a 16-bit video, scaled with its own intensity range.
+
+    Args:
+        image (np.ndarray[length,H,W]): 16-bit window
+        mode (str, optional): bit (full range of the dtype), minmax (window min and max) or
+            percentile (0.1 and 99.9 percentile of the window, clipped). Defaults to "percentile".
 
-        use_paths = ["/" + os.path.join(root_dir, use_data_list["GFP"][idx]) for idx in split_list[split][mode]]
-        
-        use_frames = [use_frame_list["GFP"][idx] for idx in split_list[split][mode]]
-        
-        img_paths = []
-        EP_paths = []
-        for path, frame in zip(use_paths, use_frames):
-            img_paths.append(sorted(glob.glob(path + "/*.png"))[frame[0] : frame[1]])
-            EP_paths.append(path.split("/")[-2])
-        
-        # normalized, size => [1,H,W]
-        self.images = [np.array(Image.open(path).convert("L"))[None] / 255 for paths in img_paths for path in paths]
-        
-        # get EP map
-        EP_images = [h5py.File(f"/{root_dir}/Molecule_EP.hdf5", mode='r')[path] for path in EP_paths]
-        EP_images = [list(EP.values())[frame[0] : frame[1]] for EP, frame in zip(EP_images, use_frames)]
-        
-        # The last image is not chosen.
-        delete_index = [len(EP) for EP in EP_images]
-        delete_index = [sum(delete_index[: idx + 1]) - delete for idx in range(len(delete_index)) for delete in range(length - 1, 0, -1)]
-
-        self.EP_images = [image[...] for EP in EP_images for image in EP]
-        
-        CP_data = [h5py.File(f"/{root_dir}/Cell_Point_Annotation.hdf5", mode='r')[path][...] for path in EP_paths]
+    Returns:
+        np.ndarray[length,H,W]: normalized window
+    """
+    dtype_max = np.iinfo(image.dtype).max
+    image = image.astype(np.float32)
+    if mode == "bit":
+        return image / dtype_max
+    elif mode == "minmax":
+        low, high = image.min(), image.max()
+    elif mode == "percentile":
+        # every 4th pixel is enough for the range
+        low, high = np.percentile(image[:, ::4, ::4], [0.1, 99.9])
+    else:
+        raise ValueError("normalize has values other than bit, minmax and percentile.")
+
+    return np.clip((image - low) / max(high - low, 1.), 0., 1.)
+
+
+def pack_frames(tracks, indexes, use_frames):
+    """Packed annotation of every used frame.
+
+    Args:
+        tracks (list[tensor[rows,4(frame,id,x,y)]]): annotation sorted at frame per sequence
+        indexes (list[dict]): index of every sequence made by utils.utils.annotation_index
+        use_frames (list[list[2(start,stop)]]): used frames of every sequence
+
+    Returns:
+        tensor[rows,4(frame,id,x,y)]: annotation rows of the used frames
+        np.ndarray[frame+1]: rows of frame index f are offsets[f]:offsets[f+1]
+    """
+    # rows of frame start..stop-1 are offset[0]:offset[-1]
+    offsets = [index["frame_offsets"][np.minimum(np.arange(start, stop + 1), len(index["frame_offsets"]) - 1)]
+                for index, (start, stop) in zip(indexes, use_frames)]
+    count = np.concatenate([np.diff(offset) for offset in offsets])
+    rows = torch.cat([track[offset[0]: offset[-1]] for track, offset in zip(tracks, offsets)], dim=0)
+
+    return rows, np.concatenate([[0], np.cumsum(count)]).astype(np.int64)
+
+
+def read_EP(EP, start, stop):
+    """Read EP maps of a sequence.
+
+    Args:
+        EP (h5py.Dataset or h5py.Group): [frame,H,W] dataset, or a group of [1,H,W] datasets per frame (old layout)
+        start (int): first frame
+        stop (int): last frame + 1
+
+    Returns:
+        np.ndarray[frame,H,W]: EP maps
+    """
+    if isinstance(EP, h5py.Group):
+        return np.concatenate([image[...] for image in list(EP.values())[start: stop]], axis=0)
+    return EP[start: stop]
+
+
+def lazy_EP_frames(EP, start, stop):
+    """Number of EP maps read_EP returns, without reading them. Only the [frame,H,W] layout can be read lazily.
+
+    Args:
+        EP (h5py.Dataset): [frame,H,W] dataset
+        start (int): first frame
+        stop (int): last frame + 1
+
+    Returns:
+        int: number of EP maps
+    """
+    if isinstance(EP, h5py.Group):
+        raise ValueError("EP_mode lazy needs one [frame,H,W] dataset per sequence. Run generator_EP.py --migrate.")
+    return len(range(EP.shape[0])[start: stop])
+
+
+def data_dir():
+    # data/ of the repository, without the leading /
+    root_dir = [path for path in os.path.dirname(__file__).split("/")[:-1]]
+    return os.path.join(*root_dir, "data")
+
+
+def registry_videos(registry=None):
+    """Videos of a dataset registry, one per key of the hdf5 files.
+
+    Args:
+        registry (dict, optional): registry, see oist_sources. Defaults to OIST_REGISTRY.
+
+    Returns:
+        str: data directory
+        list[str]: key of the hdf5 files
+        list[str]: PNG directory of every key
+    """
+    registry = OIST_REGISTRY if registry is None else registry
+    root_dir = data_dir()
+
+    # frame ranges of one video registered under several names share the key
+    videos = {}
+    for name, sequence in registry["sequences"].items():
+        videos.setdefault(sequence.get("key", name), "/" + os.path.join(root_dir, sequence["path"]))
+    return root_dir, list(videos.keys()), list(videos.values())
+
+
+def oist_sources(mode="train", split=0, registry=None):
+    """Sequences and frames used by a split of a dataset registry.
+
+    Args:
+        mode (str, optional): train, val or test. Defaults to "train".
+        split (int, optional): index of registry["splits"]. Defaults to 0.
+        registry (dict, optional): "sequences" (name => path of the PNG directory under data/, frames [start,stop)
+            and key of the hdf5 files, the name when omitted) and "splits" (list of mode => sequence names),
+            config/dataset/*.yaml. Defaults to OIST_REGISTRY.
+
+    Returns:
+        str: data directory
+        list[str]: PNG directory of every used sequence
+        list[list[2(start,stop)]]: used frames of every sequence
+        list[str]: sequence name, the key of the hdf5 files
+    """
+    registry = OIST_REGISTRY if registry is None else registry
+    root_dir = data_dir()
+
+    if not 0 <= split < len(registry["splits"]):
+        raise ValueError(f"split has values other than 0 to {len(registry['splits']) - 1}.")
+    names = list(registry["splits"][split][mode])
+    unknown = [name for name in names if name not in registry["sequences"]]
+    if len(unknown) != 0:
+        raise ValueError(f"sequences {unknown} of split {split} are not in the registry.")
+
+    use_paths = ["/" + os.path.join(root_dir, registry["sequences"][name]["path"]) for name in names]
+    use_frames = [[int(frame) for frame in registry["sequences"][name]["frames"]] for name in names]
+    # frame ranges of one video can be registered under several names
+    keys = [registry["sequences"][name].get("key", name) for name in names]
+    return root_dir, use_paths, use_frames, keys
+
+
+def dataset_cache_dir(name, root_dir, img_paths, use_frames, mode, split, length, EP_mode, video):
+    """Cache directory of a prepared dataset, data/cache/<name>_<mode>_<split>_<length>_<EP_mode>_<video>_<fingerprint>.
+    The fingerprint changes with the videos, the annotation, the EP file and the parameters.
+    Caches of other settings have another prefix and are not evicted by save_cache.
+
+    Args:
+        name (str): dataset class name
+        root_dir (str): data directory
+        img_paths (list[list[str]]): video files of every used sequence
+        use_frames (list[list[2(start,stop)]]): used frames of every sequence
+
+    Returns:
+        str: cache directory
+    """
+    source = [path for paths in img_paths for path in paths]
+    source.append(f"/{root_dir}/Cell_Point_Annotation.hdf5")
+    if EP_mode in ["hdf5", "lazy"]:
+        source.append(f"/{root_dir}/Molecule_EP.hdf5")
+
+    fingerprint = source_fingerprint(source, CACHE_VERSION, name, mode, split, length, EP_mode, use_frames)
+    return os.path.join(f"/{root_dir}", "cache", f"{name}_{mode}_{split}_{length}_{EP_mode}_{video}_{fingerprint[:16]}")
+
+
+def save_dataset_cache(dataset, cache_dir):
+    """Save the prepared arrays and the motion statistics of a dataset."""
+    arrays = {"frame_seq": dataset.frame_seq,
+            "frame_local": dataset.frame_local,
+            "idx_transfer": dataset.idx_transfer,
+            "CP_rows": dataset.CP_rows.numpy(),
+            "CP_offsets": dataset.CP_offsets,
+            "CP_data": dataset.CP_data.numpy()}
+    for idx, (track, index) in enumerate(zip(dataset.CP_data_per_data, dataset.CP_index)):
+        arrays[f"CP_data_{idx}"] = track.numpy()
+        for key, value in index.items():
+            arrays[f"CP_index_{idx}_{key}"] = value
+    if dataset.EP_images is not None:
+        for idx, EP in enumerate(dataset.EP_images):
+            arrays[f"EP_{idx}"] = EP
+
+    meta = {"sequences": len(dataset.CP_data_per_data),
+            "index_keys": list(dataset.CP_index[0].keys()),
+            "move_stats": dataset.move_stats}
+    save_cache(cache_dir, arrays, meta)
+
+
+def load_dataset_cache(dataset, cache_dir):
+    """Restore the prepared arrays of a dataset as memory maps.
+
+    Returns:
+        bool: False when the cache does not exist
+    """
+    arrays, meta = load_cache(cache_dir)
+    if arrays is None:
+        return False
+
+    seq_num = meta["sequences"]
+    dataset.frame_seq = arrays["frame_seq"]
+    dataset.frame_local = arrays["frame_local"]
+    dataset.idx_transfer = arrays["idx_transfer"]
+    dataset.CP_index = [{key: arrays[f"CP_index_{idx}_{key}"] for key in meta["index_keys"]} for idx in range(seq_num)]
+    dataset.CP_data_per_data = [torch.from_numpy(arrays[f"CP_data_{idx}"]) for idx in range(seq_num)]
+    dataset.CP_rows = torch.from_numpy(arrays["CP_rows"])
+    dataset.CP_offsets = arrays["CP_offsets"]
+    dataset.CP_data = torch.from_numpy(arrays["CP_data"])
+    dataset.EP_images = [arrays[f"EP_{idx}"] for idx in range(seq_num)] if dataset.EP_mode == "hdf5" else None
+    dataset.move_stats = meta["move_stats"]
+    return True
+
+
+def read_move_statistics(mode="train", split=0, length=16, EP_mode="hdf5", video="png", registry=None):
+    """Motion statistics of an OISTLoader split without building the dataset.
+    They are read from the dataset cache, or computed from the annotation alone.
+
+    Returns:
+        dict: statistics made by utils.utils.move_statistics
+    """
+    root_dir, use_paths, use_frames, names = oist_sources(mode, split, registry)
+    img_paths = video_sources(use_paths, video)
+    meta = load_meta(dataset_cache_dir("OISTLoader", root_dir, img_paths, use_frames, mode, split, length, EP_mode, video))
+    if meta is not None:
+        return meta["move_stats"]
+
+    with h5py.File(f"/{root_dir}/Cell_Point_Annotation.hdf5", mode='r') as CP_file:
+        CP_data = [read_annotation(CP_file, name) for name in names]
+    return move_statistics([torch.from_numpy(track) for track, _ in CP_data], indexes=[index for _, index in CP_data])
+
+
+def window_starts(frame_num, length, stride=1):
+    """First frame index of the windows that stay in their sequence, every stride-th frame from the
+    start of a sequence.
+
+    Args:
+        frame_num (list[int]): frames of every sequence, in frame index order
+        length (int): window length
+        stride (int, optional): frames between windows. Defaults to 1.
+
+    Returns:
+        np.ndarray[windows]: frame index
+    """
+    offsets = np.concatenate([[0], np.cumsum(frame_num)]).astype(np.int64)
+    return np.concatenate([np.zeros(0, dtype=np.int64)] +
+                            [offset + np.arange(0, max(num - length + 1, 0), stride) for offset, num in zip(offsets, frame_num)])
 
-        self.CP_data_per_data = [torch.tensor(data) for data in CP_data]
 
-        self.CP_data = [sample_data[sample_data[:, 0] == frame] for sample_data in self.CP_data_per_data for frame in torch.unique(sample_data[:, 0])]
-        self.CP_batch_data = torch.nn.utils.rnn.pad_sequence(self.CP_data, batch_first=True, padding_value=PAD_ID)
-        self.CP_data = torch.cat(self.CP_data, dim=0)
+##### OIST dataset #####
+class OIST_Base(data.Dataset):
+    def __init__(self, mode="train", split=0, length=16, transform=None, EP_mode="hdf5", EP_cache=256, sigma=2., cache=True,
+                video="png", normalize="percentile", registry=None, max_videos=0):
+        """Windows of length consecutive frames of a split. The videos, the annotation and the EP maps
+        are prepared here, the subclasses choose the windows in make_windows.
+        """
+        # sequences and frames of the split, OIST GFP data when registry is None
+        root_dir, use_paths, use_frames, EP_paths = oist_sources(mode, split, registry)
 
-        self.idx_transfer = list(range(len(self.EP_images)))
+        self.length = length
+        self.EP_mode = EP_mode
+        # EP_mode lazy: EP windows are read from here in __getitem__, frame of the dataset = local frame + start
+        self.EP_path = f"/{root_dir}/Molecule_EP.hdf5"
+        self.EP_keys = EP_paths
+        self.EP_start = [frame[0] for frame in use_frames]
+        # a leading RandomCrop is drawn in __getitem__ before the window is read
+        self.crop, self.transform = split_crop(transform)
         
-        for idx in delete_index[::-1]:
-            self.idx_transfer.pop(idx)
-
-        # 1iter => 0,1,2,3, 2iter => 4,5,6,7,...
-        if mode == "val" or mode == "test":
-            self.idx_transfer = [idx for idx in self.idx_transfer if idx%(length) == 0]
-
-        # transform
-        self.transform = transform
+        # 16-bit windows are normalized in __getitem__
+        self.normalize = normalize
+        # at most max_videos videos are mapped at once per worker
+        videos = Video_Store(use_paths, use_frames, video, max_open=max_videos)
+        img_paths = videos.img_paths
+        
+        # prepared arrays are cached with the fingerprint of the source files
+        cache_dir = dataset_cache_dir(type(self).__name__, root_dir, img_paths, use_frames, mode, split, length, EP_mode, video) if cache else None
+        if cache_dir is not None and load_dataset_cache(self, cache_dir):
+            self.videos = videos
+            if EP_mode == "render":
+                self.EP_renderer = EP_Renderer(self.CP_rows, self.CP_offsets, sigma=sigma, cache_size=EP_cache)
+            return
+
+        # uint8 or 16-bit [frame,H,W] per sequence. normalized in __getitem__
+        self.videos = videos
+        # sequence and frame in the sequence of every frame index
+        self.frame_seq = np.concatenate([np.full(shape[0], idx) for idx, shape in enumerate(videos.shapes)])
+        self.frame_local = np.concatenate([np.arange(shape[0]) for shape in videos.shapes])
+        
+        # EP map is read from Molecule_EP.hdf5 at once (hdf5) or per window in __getitem__ (lazy),
+        # or rendered from the annotation in __getitem__ (render)
+        if EP_mode == "hdf5":
+            # get EP map, [frame,H,W] per sequence
+            with h5py.File(f"/{root_dir}/Molecule_EP.hdf5", mode='r') as EP_file:
+                EP_images = [read_EP(EP_file[path], *frame) for path, frame in zip(EP_paths, use_frames)]
+
+            # [frame,H,W] per sequence in shared memory
+            self.EP_images = [share_array(EP) for EP in EP_images]
+            frame_num = [len(EP) for EP in EP_images]
+        elif EP_mode == "lazy":
+            # out-of-core, only the shape is read here
+            self.EP_images = None
+            with h5py.File(self.EP_path, mode='r') as EP_file:
+                frame_num = [lazy_EP_frames(EP_file[path], *frame) for path, frame in zip(EP_paths, use_frames)]
+        elif EP_mode == "render":
+            self.EP_images = None
+            frame_num = [shape[0] for shape in videos.shapes]
+        else:
+            raise ValueError("EP_mode has values other than hdf5, lazy and render.")
+
+        # annotation sorted at frame and its frame/id offset index
+        with h5py.File(f"/{root_dir}/Cell_Point_Annotation.hdf5", mode='r') as CP_file:
+            CP_data = [read_annotation(CP_file, path) for path in EP_paths]
+        self.CP_index = [index for _, index in CP_data]
+
+        self.CP_data_per_data = [torch.from_numpy(data) for data, _ in CP_data]
+        # points of every frame index, packed
+        self.CP_rows, self.CP_offsets = pack_frames(self.CP_data_per_data, self.CP_index, use_frames)
+        self.CP_data = torch.cat(self.CP_data_per_data, dim=0)
+
+        # numpy array of index, a list of int is copied page by page in forked workers
+        self.idx_transfer = self.make_windows(mode, frame_num)
+
+        self.CP_rows.share_memory_()
+
+        # displacement statistics of delay 1, 2 and 3
+        self.move_stats = move_statistics(self.CP_data_per_data, indexes=self.CP_index)
+        if cache_dir is not None:
+            save_dataset_cache(self, cache_dir)
+
+        if EP_mode == "render":
+            self.EP_renderer = EP_Renderer(self.CP_rows, self.CP_offsets, sigma=sigma, cache_size=EP_cache)
+
+    def make_windows(self, mode, frame_num):
+        """First frame index of every window.
+
+        Args:
+            mode (str): train, val or test
+            frame_num (list[int]): frames of every sequence
+
+        Returns:
+            np.ndarray[windows]: frame index
+        """
+        raise NotImplementedError
 
     # 画像&ラベル読み込み
     def __getitem__(self, index):
@@ -88,139 +489,245 @@ class OISTLoader(data.Dataset):
         
         # image.size() => [length,H,W]
         # label.size() => [length,H,W]
-        # point.size() => [length,mol_max_number,4(frame,id,x,y)]image = np.concatenate([self.images[data_index + length] for length in range(self.length)], axis=0)
-        image = np.concatenate([self.images[data_index + length] for length in range(self.length)], axis=0)
-        label = np.concatenate([self.EP_images[data_index + length] for length in range(self.length)], axis=0)
-        point = torch.stack([self.CP_batch_data[data_index + length] for length in range(self.length)], dim=0)
+        # point.size() => [num,4(frame,id,x,y)], packed points. frame is the frame in the window
+        seq = self.frame_seq[data_index]
+        frame = self.frame_local[data_index: data_index + self.length]
+
+        # crop first, only the region is read from the image and EP stores
+        size = self.videos.shapes[seq][1:]
+        region = self.crop.get_region(size, self.crop.size) if self.crop is not None else None
+
+        # uint8 window, normalized by the transform
+        image = take_window(self.videos[seq], frame, region)
+        if image.dtype != np.uint8:
+            # 16-bit window, float32 [0,1] with its own intensity range
+            image = normalize_window(image, self.normalize)
+        # transforms modify point in place
+        start, stop = self.CP_offsets[data_index], self.CP_offsets[data_index + self.length]
+        point = self.CP_rows[start: stop].clone()
+        point[:, 0] = torch.from_numpy(np.repeat(np.arange(self.length), np.diff(self.CP_offsets[data_index: data_index + self.length + 1])))
+        if region is not None:
+            point = crop_points(point, *region)
+        if self.EP_mode == "hdf5":
+            label = take_window(self.EP_images[seq], frame, region)
+        elif self.EP_mode == "lazy":
+            # one handle per file in every worker, closed when the worker exits
+            EP = hdf5_file(self.EP_path)[self.EP_keys[seq]]
+            label = take_window(EP, frame + self.EP_start[seq], region)
+        else:
+            label = EP_Target(self.EP_renderer, list(range(data_index, data_index + self.length)), size)
+            if region is not None:
+                label.crop(*region)
 
         if self.transform:
             image, label, point = self.transform(image, label, point)
+        else:
+            # raw uint8 window (normalized float32 for 16-bit videos) for the batch augmentation
+            image = torch.from_numpy(np.array(image))
+            if not isinstance(label, EP_Target):
+                label = torch.from_numpy(label)
+
+        # only the cropped region is rendered
+        if isinstance(label, EP_Target):
+            label = label.render()
 
         return image[None], label, point
 
     def __len__(self):
         return len(self.idx_transfer)
 
+
+class OISTLoader(OIST_Base):
+    def make_windows(self, mode, frame_num):
+        # The last image is not chosen. val/test: 1iter => 0,1,2,3, 2iter => 4,5,6,7,...
+        stride = self.length if mode == "val" or mode == "test" else 1
+        return window_starts(frame_num, self.length, stride)
+
     def get_track(self):
         return self.CP_data_per_data
 
-##### OIST dataset #####
-class OISTLoader_add(data.Dataset):
-    def __init__(self, mode="train", split=0, length=16, transform=None):
-        # split can be used only when 0
-        root_dir = [path for path in os.path.dirname(__file__).split("/")[:-1]]
-        root_dir = os.path.join(*root_dir, "data")
-
-        use_data_list = {
-                        "GFP":
-                            ["Density_Mid_GFP1/video",
-                            "Density_Mid_GFP2/video",
-                            "Density_Low_GFP1/video"]}
-
-        use_frame_list = {
-            "GFP": [[0, 100], [0, 100], [0, 100]]}
-        
-        split_list = [{"train": [0,1], "val": [1], "test": [2]}]
 
+class OISTLoader_add(OIST_Base):
+    def make_windows(self, mode, frame_num):
+        length = self.length
+        if mode == "train":
+            return window_starts(frame_num, length)
 
-        self.length = length
+        # windows overlap by one frame and are chained into tracks of one video
+        if len(frame_num) != 1:
+            raise ValueError(f"{mode} of OISTLoader_add has {len(frame_num)} sequences, tracking is evaluated on one.")
 
-        use_paths = ["/" + os.path.join(root_dir, use_data_list["GFP"][idx]) for idx in split_list[split][mode]]
-        use_frames = [use_frame_list["GFP"][idx] for idx in split_list[split][mode]]
+        # number of data % (length - 1) = 1, the last frame is repeated
+        append_num = (1 - len(self.frame_seq)) % (length - 1)
+        self.frame_seq = np.concatenate([self.frame_seq, np.full(append_num, self.frame_seq[-1])])
+        self.frame_local = np.concatenate([self.frame_local, np.full(append_num, self.frame_local[-1])])
+        last_frame_data = self.CP_rows[self.CP_offsets[-2]:]
+        append_data = [last_frame_data.clone() for _ in range(append_num)]
+        for idx, data in enumerate(append_data):
+            data[:, 0] += idx + 1
+        self.CP_rows = torch.cat([self.CP_rows, *append_data], dim=0)
+        self.CP_offsets = np.concatenate([self.CP_offsets, self.CP_offsets[-1] + len(last_frame_data) * np.arange(1, append_num + 1)])
 
-        img_paths = []
-        EP_paths = []
-        for path, frame in zip(use_paths, use_frames):
-            img_paths.append(sorted(glob.glob(path + "/*.png"))[frame[0] : frame[1]])
-            EP_paths.append(path.split("/")[-2])
-        
-        CP_data = [h5py.File(f"/{root_dir}/Cell_Point_Annotation.hdf5", mode='r')[path][...] for path in EP_paths]
+        # 1iter => 0,1,2,...,15, 2iter => 15,16,...
+        return window_starts([len(self.frame_seq)], length, length - 1)
 
-        self.CP_data_per_data = [torch.tensor(data) for data in CP_data]
-        self.CP_data = torch.tensor(CP_data)
+    def get_track(self):
+        return self.CP_data
 
-        self.CP_data = [sample_data[sample_data[:, 0] == frame] for sample_data in self.CP_data_per_data for frame in torch.unique(sample_data[:, 0])]
-        self.CP_batch_data = torch.nn.utils.rnn.pad_sequence(self.CP_data, batch_first=True, padding_value=PAD_ID)
-        self.CP_data = torch.cat(self.CP_data, dim=0)
 
-        # normalized, size => [1,H,W]
-        self.images = [np.array(Image.open(path).convert("L"))[None] / 255 for paths in img_paths for path in paths]
+def window_density(dataset, crop_size=None):
+    """Particle number of every window, the max over its frames, which sets the padded width of a batch.
 
-        # get EP map
-        EP_images = [h5py.File(f"/{root_dir}/Molecule_EP.hdf5", mode='r')[path] for path in EP_paths]
-        EP_images = [list(EP.values())[frame[0] : frame[1]] for EP, frame in zip(EP_images, use_frames)]
-        
-        # The last image is not chosen.
-        delete_index = [len(EP) for EP in EP_images]
-        delete_index = [sum(delete_index[: idx + 1]) - delete for idx in range(len(delete_index)) for delete in range(length - 1, 0, -1)]
+    Args:
+        dataset (OISTLoader or OISTLoader_add): dataset
+        crop_size (list[2(H,W)], optional): crop applied after reading. The number is scaled by the
+            cropped area. Defaults to the crop drawn by the dataset.
 
-        self.EP_images = [image[...] for EP in EP_images for image in EP]
-        
-        
-        self.idx_transfer = list(range(len(self.EP_images)))
-        for idx in delete_index[::-1]:
-            self.idx_transfer.pop(idx)
-        
-        if mode == "val" or mode == "test":
-            # number of data % (length - 1) = 1
-            over = len(self.images) % (length - 1)
-            if over == 0:
-                append_num = 1
-            elif over == 1:
-                append_num = 0
-            else:
-                append_num = 16 - over
-            
-            for _ in range(append_num):
-                self.images.append(self.images[-1])
-                self.EP_images.append(self.EP_images[-1])
-                last_frame_data = self.CP_batch_data[-1:]
-                last_frame_data[:, 0] += 1
-                self.CP_batch_data = torch.cat([self.CP_batch_data, last_frame_data], dim=0)
-            
-            self.idx_transfer = list(range(len(self.EP_images)))[: -(length - 1)]
-
-            # 1iter => 0,1,2,3, 2iter => 4,5,6,7,...
-            self.idx_transfer = [idx for idx in self.idx_transfer if idx % (length - 1) == 0]
-
-        # transform
-        self.transform = transform
+    Returns:
+        np.ndarray[len(dataset)]: (expected) particle number of every window
+    """
+    count = np.diff(dataset.CP_offsets)
+    density = np.lib.stride_tricks.sliding_window_view(count, dataset.length).max(axis=1)[dataset.idx_transfer]
+    density = density.astype(np.float64)
 
-    def __getitem__(self, index):
-        data_index = self.idx_transfer[index]
-        
-        # image.size() => [length,H,W]
-        # label.size() => [length,H,W]
-        # point.size() => [length,mol_max_number,4(frame,id,x,y)]
-        image = np.concatenate([self.images[data_index + length] for length in range(self.length)], axis=0)
-        label = np.concatenate([self.EP_images[data_index + length] for length in range(self.length)], axis=0)
-        point = torch.stack([self.CP_batch_data[data_index + length] for length in range(self.length)], dim=0)
+    if crop_size is None and dataset.crop is not None:
+        crop_size = dataset.crop.size
+    if crop_size is not None:
+        # particles are spread uniformly on average
+        frame_area = np.array([shape[1] * shape[2] for shape in dataset.videos.shapes], dtype=np.float64)
+        density *= crop_size[0] * crop_size[1] / frame_area[dataset.frame_seq[dataset.idx_transfer]]
+    return density
 
-        if self.transform:
-            image, label, point = self.transform(image, label, point)
 
-        return image[None], label, point
+def shard_order(window_seq, shard_size=0):
+    """Random order of windows, shard by shard. Sequences are shuffled and cut into shards of
+    shard_size sequences. The windows of a shard are shuffled and come one after another, so only
+    the videos and EP chunks of one shard are read at a time.
 
-    def __len__(self):
-        return len(self.idx_transfer)
+    Args:
+        window_seq (np.ndarray[windows]): sequence of every window
+        shard_size (int, optional): sequences per shard. Defaults to 0, one shard.
 
-    def get_track(self):
-        return self.CP_data
+    Returns:
+        list[np.ndarray]: window order of every shard
+    """
+    seq_num = int(window_seq.max()) + 1 if len(window_seq) != 0 else 0
+    seq_shard = np.zeros(seq_num, dtype=np.int64)
+    if shard_size:
+        seq_shard[torch.randperm(seq_num).numpy()] = np.arange(seq_num) // shard_size
+    window_shard = seq_shard[window_seq]
+
+    order = torch.randperm(len(window_seq)).numpy()
+    order = order[np.argsort(window_shard[order], kind="stable")]
+    return np.split(order, np.flatnonzero(np.diff(window_shard[order])) + 1)
+
+
+class Shard_Sampler(data.Sampler):
+    def __init__(self, dataset, shard_size=0):
+        """Shuffled windows, shard by shard, see shard_order. One shard is a plain shuffle.
 
+        Args:
+            dataset (OISTLoader or OISTLoader_add): dataset
+            shard_size (int, optional): sequences per shard. Defaults to 0, one shard.
+        """
+        self.window_seq = dataset.frame_seq[dataset.idx_transfer]
+        self.shard_size = shard_size
+
+    def __iter__(self):
+        return iter(np.concatenate(shard_order(self.window_seq, self.shard_size)).tolist())
+
+    def __len__(self):
+        return len(self.window_seq)
+
+
+class Density_BatchSampler(data.Sampler):
+    def __init__(self, dataset, batch_size, max_tokens=None, crop_size=None, pool_batches=16, drop_last=True, shard_size=0):
+        """Batches of windows with similar particle number, so that little of a dense block is padding.
+        Every epoch the windows are shuffled, cut into pools of pool_batches batches and sorted by
+        particle number in a pool. The batch order is shuffled again. With shard_size, windows and
+        batches are shuffled in a shard and the shards come one after another, see shard_order.
+
+        Args:
+            dataset (OISTLoader or OISTLoader_add): dataset
+            batch_size (int): batch size. The maximum batch size when max_tokens is given.
+            max_tokens (int, optional): padded points of a batch, batch * length * max particle number.
+                Defaults to None, fixed batch size.
+            crop_size (list[2(H,W)], optional): crop applied after reading, see window_density. Defaults to None.
+            pool_batches (int, optional): number of batches sorted together. Defaults to 16.
+            drop_last (bool, optional): drop the last batch smaller than batch_size. Defaults to True.
+            shard_size (int, optional): sequences per shard. Defaults to 0, one shard.
+        """
+        self.length = dataset.length
+        self.window_seq = dataset.frame_seq[dataset.idx_transfer]
+        self.shard_size = shard_size
+        self.density = window_density(dataset, crop_size)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_batches = pool_batches
+        self.drop_last = drop_last
+        self.batches = None
+
+    def make_batches(self):
+        pool_size = self.batch_size * self.pool_batches
+
+        all_batches = []
+        for order in shard_order(self.window_seq, self.shard_size):
+            batches = []
+            for start in range(0, len(order), pool_size):
+                pool = order[start: start + pool_size]
+                pool = pool[np.argsort(self.density[pool], kind="stable")]
+
+                batch = []
+                for idx in pool:
+                    # pool is sorted, the new window is the densest of the batch
+                    tokens = (len(batch) + 1) * self.length * max(self.density[idx], 1.)
+                    if len(batch) == self.batch_size or (self.max_tokens and len(batch) != 0 and tokens > self.max_tokens):
+                        batches.append(batch)
+                        batch = []
+                    batch.append(int(idx))
+                if len(batch) != 0:
+                    batches.append(batch)
+
+            if self.drop_last and not self.max_tokens:
+                batches = [batch for batch in batches if len(batch) == self.batch_size]
+
+            # batch order is shuffled in the shard
+            all_batches.extend(batches[idx] for idx in torch.randperm(len(batches)).tolist())
+
+        return all_batches
+
+    def __iter__(self):
+        # batches of the epoch are planned once, __len__ and __iter__ see the same ones
+        if self.batches is None:
+            self.batches = self.make_batches()
+        batches, self.batches = self.batches, None
+        return iter(batches)
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
+        return len(self.batches)
 
 
 def collate_delete_PAD(batch):
+    """Stack images and labels, and pack the points of a batch without padding.
+    utils.utils.pad_windows pads every window to its own max for the attention and the losses,
+    utils.utils.pad_points makes a dense block of the batch where a kernel needs one.
+
+    Returns:
+        tensor[batch,1,length,H,W]: images
+        tensor[batch,length,H,W]: EP maps
+        tensor[num,4(frame,id,x,y)]: packed points sorted at frame. frame = batch index * length + frame in the window
+    """
     image, label, point = list(zip(*batch))
 
     image = torch.stack(image)
     label = torch.stack(label)
-    point = torch.stack(point)
 
-    # Make PAD as low as possible.
-    sorted_idx = torch.argsort(point[:, :, :, 0], dim=2, descending=True)
-    point = torch.take_along_dim(point, sorted_idx[:, :, :, None], dim=2)
-    max_point_num = (point[:, :, :, 0] != -1).sum(dim=-1).max()
-    point = point[:, :, :max_point_num]
+    length = image.shape[2]
+    point = [data.clone() for data in point]
+    for idx, data in enumerate(point):
+        data[:, 0] += idx * length
+    point = torch.cat(point, dim=0)
 
     return image, label, point
-
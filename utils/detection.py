@@ -0,0 +1,136 @@
+#coding: utf-8
+#----- Standard Library -----#
+#None
+
+#----- Public Package -----#
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+#----- Module -----#
+#None
+
+PAD = -1
+
+
+def gaussian_kernel1d(kernel_size, sigma):
+    """1D Gaussian kernel, the same as torchvision.transforms.GaussianBlur uses for each axis."""
+    half = (kernel_size - 1) * 0.5
+    x = torch.linspace(-half, half, steps=kernel_size)
+    pdf = torch.exp(-0.5 * (x / sigma) ** 2)
+    return pdf / pdf.sum()
+
+
+def window_max(h, size, dim):
+    """Maximum over a centered window of odd size along dim, padded with -inf like max pool.
+    Windows are doubled, so it takes log2(size) elementwise maxima instead of size per element.
+    """
+    pad = size // 2
+    shape = list(h.shape)
+    shape[dim] = pad
+    fill = h.new_full(shape, float("-inf"))
+    h_max = torch.cat([fill, h, fill], dim=dim)
+
+    # h_max[i] = max of the padded h[i: i + width]
+    width = 1
+    while width * 2 <= size:
+        num = h_max.shape[dim] - width
+        h_max = torch.maximum(h_max.narrow(dim, 0, num), h_max.narrow(dim, width, num))
+        width *= 2
+
+    length = h.shape[dim]
+    return torch.maximum(h_max.narrow(dim, 0, length), h_max.narrow(dim, size - width, length))
+
+
+class Peak_Detector(nn.Module):
+    def __init__(self, pool_range=11, kernel_size=13, sigma=3., rounds=3, subpixel=False):
+        """Local maxima of probability maps, all frames in one batched pass.
+        A pixel over the threshold and maximum in its pool_range window is a candidate. Then
+        rounds times the candidate map is blurred and only its local maxima are kept, which merges
+        candidates closer than the blur. The local maximum is taken along x then y.
+
+        Args:
+            pool_range (int, optional): window of the local maximum. Defaults to 11.
+            kernel_size (int, optional): Gaussian kernel size, 4*sigma+0.5. Defaults to 13.
+            sigma (float, optional): Gaussian sigma. Defaults to 3..
+            rounds (int, optional): blur and suppression rounds. Defaults to 3.
+            subpixel (bool, optional): refine the peaks with a 3 point Gaussian fit of the
+                probability map, float coordinates. Defaults to False, pixel coordinates.
+        """
+        super().__init__()
+        self.pool_range = pool_range
+        self.rounds = rounds
+        self.subpixel = subpixel
+        # not saved, checkpoints stay the same
+        self.register_buffer("kernel", gaussian_kernel1d(kernel_size, sigma), persistent=False)
+
+    def blur(self, h):
+        # frames as channels of one depthwise convolution, the same sums as GaussianBlur so that
+        # ties of the suppression do not change
+        pad = self.kernel.shape[0] // 2
+        kernel = torch.mm(self.kernel[:, None], self.kernel[None, :]).to(h.dtype)
+        kernel = kernel.expand(h.shape[1], 1, *kernel.shape)
+        return F.conv2d(F.pad(h, [pad, pad, pad, pad], mode="reflect"), kernel, groups=h.shape[1])
+
+    def local_max(self, h):
+        return window_max(window_max(h, self.pool_range, -1), self.pool_range, -2)
+
+    def peak_map(self, prob, threshold=0.5):
+        """Peak mask.
+
+        Args:
+            prob (tensor[frame,H,W]): probability map [0,1]
+            threshold (float, optional): detection threshold. Defaults to 0.5.
+
+        Returns:
+            tensor[frame,H,W]: True at peaks
+        """
+        # [1,frame,H,W]
+        h = prob[None].float()
+        h = ((h >= threshold) & (h == self.local_max(h))).float()
+        for _ in range(self.rounds):
+            h = self.blur(h)
+            h = ((h != 0) & (h == self.local_max(h))).float()
+        return h[0] != 0
+
+    def refine(self, prob, frame, x, y):
+        # vertex of the parabola through the log probability of the peak and its neighbours
+        H, W = prob.shape[-2:]
+
+        def log_prob(dx, dy):
+            return prob[frame, (y + dy).clamp(0, H - 1), (x + dx).clamp(0, W - 1)].float().clamp_min(1e-6).log()
+
+        center = log_prob(0, 0)
+
+        def offset(minus, plus):
+            curvature = minus - 2 * center + plus
+            return torch.where(curvature < 0, 0.5 * (minus - plus) / curvature.clamp_max(-1e-6), torch.zeros_like(curvature)).clamp(-0.5, 0.5)
+
+        return torch.stack([x + offset(log_prob(-1, 0), log_prob(1, 0)),
+                            y + offset(log_prob(0, -1), log_prob(0, 1))], dim=-1)
+
+    def forward(self, prob, threshold=0.5):
+        """Detection coordinates of every frame, padded to the max detection number.
+
+        Args:
+            prob (tensor[...,H,W]): probability map [0,1], any number of leading dimensions
+            threshold (float, optional): detection threshold. Defaults to 0.5.
+
+        Returns:
+            tensor[...,num,2(x,y)]: detection coordinate, PAD=-1. long, float with subpixel
+        """
+        frames = prob.reshape(-1, *prob.shape[-2:])
+        frame, y, x = torch.nonzero(self.peak_map(frames, threshold), as_tuple=True)
+
+        if self.subpixel:
+            coord = self.refine(frames, frame, x, y)
+        else:
+            coord = torch.stack([x, y], dim=-1)
+
+        # rank of every detection in its frame, nonzero is sorted at frame
+        count = torch.bincount(frame, minlength=frames.shape[0])
+        rank = torch.arange(frame.shape[0], device=frame.device) - (torch.cumsum(count, dim=0) - count)[frame]
+
+        dense = coord.new_full([frames.shape[0], int(count.max()) if count.shape[0] != 0 else 0, 2], PAD)
+        dense[frame, rank] = coord
+        return dense.view(*prob.shape[:-2], -1, 2)
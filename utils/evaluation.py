@@ -14,13 +14,14 @@ import torch.nn.functional as F
 import motmetrics as mm
 
 #----- Module -----#
-# None
+from utils.detection import Peak_Detector
 
 
 class Object_Detection():
     def __init__(self, right_range=10.,
                 noise_strength=0.5,
-                pool_range=11):
+                pool_range=11,
+                subpixel=False):
         self.FP = 0
         self.FN = 0
         self.TP = 0
@@ -29,53 +30,20 @@ class Object_Detection():
 
         self.coordinater = self.coordinater_maximul
         #kernel_size = 4*sigma+0.5
-        self.gaussian_filter = torchvision.transforms.GaussianBlur((13, 13), sigma=3)
-        self.maxpool = nn.MaxPool2d(pool_range, stride=1, padding=(pool_range - 1) // 2)
+        self.detector = Peak_Detector(pool_range=pool_range, kernel_size=13, sigma=3., subpixel=subpixel)
         self.noise_strength = noise_strength
 
     def coordinater_maximul(self, out):
         """ Function to return the detected position of an object from a probability map.
 
         Args:
-            out (tensor[batch,1,H,W]): The probability map section is [0,1].
+            out (tensor[batch,1,...,H,W]): The probability map section is [0,1]. Any number of frames.
 
         Returns:
-            tensor[batch,2(x,y)]: detection coordinate.
+            tensor[batch,...,num,2(x,y)]: detection coordinate. PAD=-1
         """
-        h = out.squeeze(1)
-        h = (h >= self.noise_strength) * (h == self.maxpool(h)) * 1.0
-        for _ in range(3):
-            h = self.gaussian_filter(h)
-            h = (h != 0) * (h == self.maxpool(h)) * 1.0
-
-        coordinate = torch.nonzero(h)  # [detection number, 3(batch,y,x)]
-        if coordinate.size(0) == 0:
-            return coordinate
-        coordinate = self.coordinate_batch_convert(coordinate, out.size(0))
-        return coordinate  # [num_cell,3] 1dim=[batch_num,y,x]
-
-    def coordinate_batch_convert(self, coord, batch_size):
-        batch_num = torch.cat([coord[:, 0], torch.arange(
-            batch_size, device=coord.device)], dim=0)
-
-        _, count = torch.unique(batch_num, sorted=True, return_counts=True)
-        count -= 1
-
-        max_count = torch.max(count)
-        batch_idx = coord.new_ones(coord.shape[0])
-        batch_idx[0] = 0
-
-        for idx, value in zip(torch.cumsum(count[:-1], dim=0), max_count - count[:-1]):
-            try:
-                batch_idx[idx] += value
-            except IndexError:
-                pass
-        batch_idx = torch.cumsum(batch_idx, dim=0)
-
-        batch_coord = -torch.ones([batch_size * max_count, 2],dtype=torch.long, device=coord.device)
-        batch_coord[batch_idx] = coord[:, [2, 1]]  # [y,x] => [x,y]
-        batch_coord = batch_coord.view(batch_size, max_count, 2)
-        return batch_coord
+        self.detector.to(out.device)
+        return self.detector(out[:, 0], self.noise_strength)
 
     def _reset(self):
         self.FP = 0
@@ -158,6 +126,13 @@ class Object_Tracking():
             label (tensor[label_track_num,4(frame,id,x,y)]): label track
         """
         
+        predict = predict.cpu().detach().float()
+        label = label.cpu().detach().float()
+
+        # sort at frame once, rows of a frame are a slice
+        predict = predict[predict[:, 0].sort()[1]]
+        label = label[label[:, 0].sort()[1]]
+
         pre_min_f = predict[:, 0].min()
         pre_max_f = predict[:, 0].max()
         label_min_f = label[:, 0].min()
@@ -171,16 +146,18 @@ class Object_Tracking():
         because the video is longer depending on the data loader.
         """
         label_max_f = label_max_f - label_min_f
+        frames = torch.arange(int(label_max_f.item()) + 1, dtype=torch.float)
+        pre_offsets = torch.searchsorted(predict[:, 0].contiguous(), frames).tolist()
+        lab_offsets = torch.searchsorted(label[:, 0].contiguous(), frames).tolist()
+
         for frame in range(int(label_max_f.item())):
             
-            pre = predict[predict[:, 0] == frame][:, [1, 2, 3]]
-            lab = label[label[:, 0] == frame][:, [1, 2, 3]]
+            pre = predict[pre_offsets[frame]: pre_offsets[frame + 1]][:, [1, 2, 3]]
+            lab = label[lab_offsets[frame]: lab_offsets[frame + 1]][:, [1, 2, 3]]
 
             # delete PAD
-            pre = pre[pre[:, 1] >= 0].cpu().detach().float()
-            lab = lab[lab[:, 1] >= 0].cpu().detach().float()
-            if pre is None:
-                continue
+            pre = pre[pre[:, 1] >= 0]
+            lab = lab[lab[:, 1] >= 0]
 
             dist_matrix = self.distance_calculate(pre, lab)
 
@@ -11,7 +11,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 
 #----- Module -----#
-#None
+from utils.utils import pad_windows
 
 PAD_ID = -1
 NONE_TOKEN_ID = -2
@@ -24,13 +24,23 @@ class Contrastive_Loss(nn.Module):
         self.mse_fnc = nn.MSELoss()
 
     def Contrastive_loss_calc(self, feature, pre_coord, label_id):
+        """Squared errors of the similarity in one window, frame t against t, t+1, t+2 and t+3.
+
+        Args:
+            feature (tensor[1,channel,length,H,W]): feature map of the window
+            pre_coord (tensor[1,length,num,2(x,y)]): 正解検出, PAD=-1
+            label_id (tensor[1,length,num]): 正解検出のid
+
+        Yields:
+            tensor[pairs]: squared error of the pairs in the overlap range
+        """
         #検出位置の特徴量を取得
         idx = torch.arange(pre_coord.size(0) * pre_coord.size(1) * pre_coord.size(2), device=pre_coord.device).view(pre_coord.shape[:3])
         batch_idx = idx // (pre_coord.size(1) * pre_coord.size(2))
-        length_idx = idx % pre_coord.size(1)
+        length_idx = idx // pre_coord.size(2) % pre_coord.size(1)
 
-        #[batch,length,num,channel]
-        selected_feature = feature[batch_idx, :, length_idx, pre_coord[:, :, :, 1], pre_coord[:, :, :, 0]]
+        #[batch,length,num,channel], float32 under autocast
+        selected_feature = feature[batch_idx, :, length_idx, pre_coord[:, :, :, 1], pre_coord[:, :, :, 0]].float()
 
         selected_feature = F.normalize(selected_feature, dim=-1)
 
@@ -53,7 +63,7 @@ class Contrastive_Loss(nn.Module):
 
         #ラベル番号一致flag [batch,length,num,num]
         label_match_flag = (label_id[:, :, :, None] == label_id[:, :, None]) * 1.0
-        loss = ((similar[distance] - label_match_flag[distance]) ** 2).mean()
+        yield (similar[distance] - label_match_flag[distance]) ** 2
 
         for l in range(1, 4):
             #類似度計算
@@ -71,15 +81,28 @@ class Contrastive_Loss(nn.Module):
             #ラベル番号一致flag [batch,length,num,num]
             label_match_flag = (label_id[:, :-l, :, None] == label_id[:, l:, None]) * 1.0
             
-            loss = loss + ((similar[distance] - label_match_flag[distance]) ** 2).mean()
+            yield (similar[distance] - label_match_flag[distance]) ** 2
 
+    def forward(self, predicts, feature, point, targets):
+        """MSE of the EP map and contrastive loss of the features at the labels.
 
-        return loss / 4
+        Args:
+            predicts (tensor[batch,1,length,H,W]): EP map of model output
+            feature (tensor[batch,channel,length,H,W]): feature map of model output
+            point (tesor[rows,4(frame,id,x,y)]): 正解検出, packed points. frame = batch index * length + frame in the window
+            targets (tensor[batch,length,H,W]): EP map label
 
-    def forward(self, predicts, feature, pre_coord, targets, label_id):
-        
-        mse_loss = self.mse_fnc(predicts.squeeze(1), targets)
-        contrastive_loss = self.Contrastive_loss_calc(feature, pre_coord, label_id)
+        Returns:
+            tensor[1]: loss
+        """
+        mse_loss = self.mse_fnc(predicts.squeeze(1).float(), targets)
+
+        # window by window, every window padded to its own max. the mean of every delay is taken over the batch
+        errors = [[] for _ in range(4)]
+        for idx, block in enumerate(pad_windows(point, feature.shape[0], feature.shape[2])):
+            for l, error in enumerate(self.Contrastive_loss_calc(feature[idx:idx + 1], block[:, :, :, 2:], block[:, :, :, 1])):
+                errors[l].append(error)
+        contrastive_loss = sum(torch.cat(error).mean() for error in errors) / 4
         return mse_loss+contrastive_loss
 
 
@@ -108,7 +131,8 @@ class connected_loss(nn.Module):
         #vector.size() => [batch,length,num,dim]
         #ベクトルの大きさを1にする
         #ゼロベクトルは0のまま
-        vector = F.normalize(vector, dim=-1)
+        # float32 under autocast, the softmax at temperature 0.001 needs it
+        vector = F.normalize(vector.float(), dim=-1)
         for delay in range(1, 4):
             #内積計算(ノルム1なのでCos類似度)
             similar = (vector[:, :-delay, :, None] * vector[:, delay:, None]).sum(dim=-1)
@@ -128,24 +152,29 @@ class connected_loss(nn.Module):
             
             yield F.softmax(similar / 0.001, dim=-1), F.softmax(similar / 0.001, dim=-2)  #現在に対しての未来をsoftmax,未来に対しての現在をsoftmax
 
-    def forward(self, vector, label_id, coord):
+    def forward(self, vector, point, coord):
         """tとt+iの関連性マップのCross Entropy Loss関数
 
         Args:
-            vector (tensor[batch,length,num+1,dim]): vector of  model output
-            label_id (tesor[batch,length,num]): 正解検出のid
-            coord (tesor[batch,length,num,2(x,y)]): 正解検出のid
+            vector (list[tensor[1,length,num+1,dim]]): vector of  model output, every window
+            point (tesor[rows,4(frame,id,x,y)]): 正解検出, packed points. frame = batch index * length + frame in the window
+            coord (list[tensor[1,length,num+1,2(x,y)]]): 正解検出の座標, every window
 
         Returns:
             tensor[1]: 関連性マップのcross Entropy Loss
         """
-
-        present_loss = 0
-        next_loss = 0
-
-        for idx, ((pre_pre_map, pre_nxt_map), (lab_pre_map, lab_nxt_map)) in enumerate(zip(self.delayed_predict_connection(vector, coord), self.delayed_id_connection(label_id))):
-            present_loss = present_loss + torch.log(torch.clamp(pre_pre_map[lab_pre_map], min=1e-7)).mean()
-            next_loss = next_loss + torch.log(torch.clamp(pre_nxt_map[lab_nxt_map], min=1e-7)).mean()
+        # the same blocks as the model input, every window padded to its own max
+        label_id = [block[:, :, :, 1] for block in pad_windows(point, len(vector), vector[0].shape[1])]
+
+        # log likelihood of every delay, the mean is taken over the batch
+        present_loss = [[] for _ in range(3)]
+        next_loss = [[] for _ in range(3)]
+
+        for window_vector, window_coord, window_id in zip(vector, coord, label_id):
+            for idx, ((pre_pre_map, pre_nxt_map), (lab_pre_map, lab_nxt_map)) in enumerate(zip(self.delayed_predict_connection(window_vector, window_coord), self.delayed_id_connection(window_id))):
+                present_loss[idx].append(torch.log(torch.clamp(pre_pre_map[lab_pre_map], min=1e-7)))
+                next_loss[idx].append(torch.log(torch.clamp(pre_nxt_map[lab_nxt_map], min=1e-7)))
+        present_loss = sum(torch.cat(log_prob).mean() for log_prob in present_loss)
+        next_loss = sum(torch.cat(log_prob).mean() for log_prob in next_loss)
         loss = present_loss + next_loss
         return - loss / idx
-
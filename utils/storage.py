@@ -0,0 +1,301 @@
+#coding: utf-8
+#----- Standard Library -----#
+import os
+import glob
+import json
+import shutil
+import hashlib
+import multiprocessing.util
+
+#----- Public Package -----#
+import h5py
+import numpy as np
+from PIL import Image
+
+#----- Module -----#
+from utils.utils import annotation_index
+
+# read handles of this process, path => h5py.File
+_hdf5_handles = {}
+_hdf5_pid = None
+
+
+def load_video(img_paths, cache_path):
+    """uint8 video of a PNG sequence as a memory map.
+    The [frame,H,W] .npy file is built on first use and rebuilt when a PNG is newer.
+
+    Args:
+        img_paths (list[str]): sorted PNG paths of the sequence
+        cache_path (str): path of the .npy file
+
+    Returns:
+        np.memmap[frame,H,W]: uint8 video
+    """
+    if os.path.exists(cache_path):
+        video = np.load(cache_path, mmap_mode='r')
+        newest = max(os.path.getmtime(path) for path in img_paths)
+        if video.shape[0] == len(img_paths) and os.path.getmtime(cache_path) >= newest:
+            return video
+        del video
+
+    width, height = Image.open(img_paths[0]).size
+
+    # write to a temporary file so that other processes never see a half written video
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    video = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(img_paths), height, width))
+    for idx, path in enumerate(img_paths):
+        video[idx] = np.array(Image.open(path).convert("L"))
+    video.flush()
+    del video
+    os.replace(tmp_path, cache_path)
+
+    return np.load(cache_path, mmap_mode='r')
+
+
+# TIFF tag => name, only the tags needed to locate uncompressed pages
+TIFF_TAGS = {256: "width", 257: "height", 258: "bits", 259: "compression", 270: "description",
+            273: "strip_offsets", 277: "samples", 279: "strip_bytes", 322: "tile_width", 339: "sample_format"}
+# TIFF field type => numpy dtype
+TIFF_TYPES = {1: "u1", 2: "u1", 3: "u2", 4: "u4", 6: "i1", 7: "u1", 8: "i2", 9: "i4", 16: "u8", 17: "i8"}
+
+
+def read_tiff_pages(raw, order):
+    """Tags of every page (IFD) of a TIFF or BigTIFF file.
+
+    Args:
+        raw (np.memmap): bytes of the file
+        order (str): byte order, "<" or ">"
+
+    Returns:
+        list[dict]: tags of every page, named by TIFF_TAGS
+    """
+    def read(offset, dtype, count=1):
+        return raw[offset: offset + np.dtype(dtype).itemsize * count].view(order + dtype)
+
+    bigtiff = int(read(2, "u2")[0]) == 43
+    # classic: 2 byte entry number, 12 byte entries, 4 byte offsets. BigTIFF: 8, 20, 8
+    count_type, entry_size, offset_type = ("u8", 20, "u8") if bigtiff else ("u2", 12, "u4")
+
+    pages = []
+    offset = int(read(8 if bigtiff else 4, offset_type)[0])
+    while offset != 0:
+        entry_num = int(read(offset, count_type)[0])
+        entries = offset + np.dtype(count_type).itemsize
+        tags = {}
+        for idx in range(entry_num):
+            entry = entries + idx * entry_size
+            tag, field = (int(value) for value in read(entry, "u2", 2))
+            if tag not in TIFF_TAGS or field not in TIFF_TYPES:
+                continue
+            count = int(read(entry + 4, offset_type)[0])
+            value_offset = entry + 4 + np.dtype(offset_type).itemsize
+            # values that do not fit in the entry are stored at an offset
+            if np.dtype(TIFF_TYPES[field]).itemsize * count > np.dtype(offset_type).itemsize:
+                value_offset = int(read(value_offset, offset_type)[0])
+            values = read(value_offset, TIFF_TYPES[field], count)
+            tags[TIFF_TAGS[tag]] = values.tobytes().decode("latin-1") if field == 2 else values.astype(np.int64)
+        pages.append(tags)
+        offset = int(read(entries + entry_num * entry_size, offset_type)[0])
+    return pages
+
+
+def load_tiff_stack(path):
+    """Uncompressed multi-page TIFF stack as a memory map, in its own bit depth.
+    Pages must be single channel, uncompressed and evenly spaced in the file, as written by
+    ImageJ, tifffile and most acquisition software. ImageJ stacks over 4GB have only one IFD
+    and images=<frame> in the description, their pages follow each other.
+
+    Args:
+        path (str): .tif file
+
+    Returns:
+        np.ndarray[frame,H,W]: memory mapped video, uint8 or (u)int16
+    """
+    raw = np.memmap(path, dtype=np.uint8, mode='r')
+    if raw[:2].tobytes() not in [b"II", b"MM"]:
+        raise ValueError(f"{path} is not a TIFF file.")
+    order = "<" if raw[:2].tobytes() == b"II" else ">"
+
+    pages = read_tiff_pages(raw, order)
+    first = pages[0]
+    height, width = int(first["height"][0]), int(first["width"][0])
+    bits = int(first.get("bits", [1])[0])
+    dtype = np.dtype(order + ("i" if int(first.get("sample_format", [1])[0]) == 2 else "u") + str(bits // 8))
+    page_bytes = height * width * dtype.itemsize
+
+    for tags in pages:
+        if int(tags.get("compression", [1])[0]) != 1 or "tile_width" in tags or int(tags.get("samples", [1])[0]) != 1 \
+                or bits not in [8, 16] or (int(tags["height"][0]), int(tags["width"][0])) != (height, width):
+            raise ValueError(f"{path} has pages other than uncompressed single channel 8/16-bit strips of the same size.")
+        # strips of a page follow each other
+        offsets, sizes = tags["strip_offsets"], tags["strip_bytes"]
+        if np.any(offsets[1:] != offsets[:-1] + sizes[:-1]) or sizes.sum() < page_bytes:
+            raise ValueError(f"{path} has a page whose strips are not contiguous.")
+
+    page_offsets = np.array([int(tags["strip_offsets"][0]) for tags in pages], dtype=np.int64)
+    frame_num = len(pages)
+    description = first.get("description", "")
+    if frame_num == 1 and description.startswith("ImageJ") and "images=" in description:
+        frame_num = int(description.split("images=")[1].split()[0])
+        page_offsets = page_offsets[0] + page_bytes * np.arange(frame_num)
+
+    stride = int(page_offsets[1] - page_offsets[0]) if frame_num > 1 else page_bytes
+    if np.any(np.diff(page_offsets) != stride):
+        raise ValueError(f"{path} has pages that are not evenly spaced.")
+    if page_offsets[0] + stride * (frame_num - 1) + page_bytes > raw.shape[0]:
+        raise ValueError(f"{path} is shorter than its pages.")
+
+    return np.ndarray((frame_num, height, width), dtype=dtype, buffer=raw, offset=int(page_offsets[0]),
+                        strides=(stride, width * dtype.itemsize, dtype.itemsize))
+
+
+def read_annotation(f, name):
+    """Annotation table of a sequence and its CSR index.
+    Files written before the index was stored are sorted and indexed here.
+
+    Args:
+        f (h5py.File): Cell_Point_Annotation.hdf5
+        name (str): sequence name
+
+    Returns:
+        np.ndarray[rows,4(frame,id,x,y)]: annotation sorted at frame
+        dict: index made by utils.utils.annotation_index
+    """
+    track = f[name][...]
+    if "index" in f and name in f["index"]:
+        index = {key: value[...] for key, value in f["index"][name].items()}
+        if index["frame_offsets"][-1] == track.shape[0]:
+            return track, index
+
+    track = track[np.argsort(track[:, 0], kind="stable")]
+    return track, annotation_index(track)
+
+
+def write_annotation_index(f, name, index):
+    """Save the CSR index of a sequence next to its table as index/<name>/*.
+
+    Args:
+        f (h5py.File): Cell_Point_Annotation.hdf5
+        name (str): sequence name
+        index (dict): index made by utils.utils.annotation_index
+    """
+    group = f.require_group("index")
+    if name in group:
+        del group[name]
+    group = group.create_group(name)
+    for key, value in index.items():
+        group.create_dataset(name=key, data=value)
+
+
+def source_fingerprint(paths, *params):
+    """Fingerprint of source files (path, size, mtime) and parameters.
+
+    Args:
+        paths (list[str]): source files
+        *params: parameters the prepared data depends on
+
+    Returns:
+        str: sha1 hex digest
+    """
+    sha = hashlib.sha1()
+    for param in params:
+        sha.update(f"{param}\n".encode())
+    for path in paths:
+        stat = os.stat(path)
+        sha.update(f"{path}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return sha.hexdigest()
+
+
+def save_cache(cache_dir, arrays, meta):
+    """Save prepared arrays as .npy files and meta as meta.json in cache_dir.
+    Older caches with the same prefix (cache_dir without the fingerprint) are removed.
+
+    Args:
+        cache_dir (str): <prefix>_<fingerprint>
+        arrays (dict[str, np.ndarray]): arrays saved as <name>.npy
+        meta (dict): json serializable metadata
+    """
+    # build in a temporary directory so that other processes never see a half written cache
+    tmp_dir = f"{cache_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), np.ascontiguousarray(array))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # built by another process at the same time
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    prefix = cache_dir.rsplit("_", 1)[0]
+    for old_dir in glob.glob(glob.escape(prefix) + "_*"):
+        # same prefix and a fingerprint, other processes' temporary directories are kept
+        if old_dir != cache_dir and not old_dir.endswith(".tmp") \
+                and os.path.basename(old_dir).count("_") == os.path.basename(cache_dir).count("_"):
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def load_meta(cache_dir):
+    """meta.json of a cache, None when the cache does not exist."""
+    path = os.path.join(cache_dir, "meta.json")
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_cache(cache_dir):
+    """Arrays of a cache as copy-on-write memory maps.
+
+    Args:
+        cache_dir (str): directory made by save_cache
+
+    Returns:
+        dict[str, np.memmap]: arrays, None when the cache does not exist
+        dict: metadata
+    """
+    meta = load_meta(cache_dir)
+    if meta is None:
+        return None, None
+
+    # copy-on-write: writable for torch.from_numpy, pages stay shared between workers
+    arrays = {os.path.basename(path)[:-4]: np.load(path, mmap_mode='c')
+                for path in glob.glob(os.path.join(cache_dir, "*.npy"))}
+    return arrays, meta
+
+
+def hdf5_file(path, chunk_cache=64 * 1024 ** 2):
+    """Read handle of an HDF5 file, opened on first use and reused in the process.
+    Handles inherited through fork are dropped, so every DataLoader worker opens its own.
+
+    Args:
+        path (str): HDF5 file
+        chunk_cache (int, optional): bytes of decompressed chunks kept per dataset, the overlapping
+            windows of a sequence reuse them. Defaults to 64MB.
+
+    Returns:
+        h5py.File: read handle
+    """
+    global _hdf5_pid
+    if _hdf5_pid != os.getpid():
+        # HDF5 handles are not fork safe, the parent keeps its own
+        _hdf5_handles.clear()
+        _hdf5_pid = os.getpid()
+        # run at the exit of the main process and of multiprocessing workers
+        multiprocessing.util.Finalize(None, close_hdf5, exitpriority=10)
+
+    if path not in _hdf5_handles:
+        _hdf5_handles[path] = h5py.File(path, mode='r', rdcc_nbytes=chunk_cache)
+    return _hdf5_handles[path]
+
+
+def close_hdf5():
+    """Close the HDF5 handles opened by this process."""
+    if _hdf5_pid != os.getpid():
+        return
+    for f in _hdf5_handles.values():
+        f.close()
+    _hdf5_handles.clear()
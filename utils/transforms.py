@@ -12,7 +12,7 @@ import torchvision.transforms.functional as F
 from PIL import Image
 
 #----- Module -----#
-#None
+from utils.EP_map import EP_Target
 
 PAD_ID = -1
 
@@ -22,10 +22,15 @@ class ToTensor(object):
         pass
 
     def __call__(self, image, label):
+        # uint8 windows are normalized here
+        if image.dtype == np.uint8:
+            image = image.astype(np.float32) / 255
         tensor = torch.from_numpy(image)
         tensor = tensor.float()
 
-        label = torch.from_numpy(label)
+        # EP_Target is rendered after the transforms
+        if not isinstance(label, EP_Target):
+            label = torch.from_numpy(label)
 
         return tensor, label
 
@@ -51,10 +56,11 @@ class RandomHorizontalFlip(object):
         if random.random() < self.p:
             #x flip img=>[2,H,W]
             center = (img.shape[2] - 1) / 2
-            point[:, :, 2] = 2 * center - point[:, :, 2]
+            point[:, 2] = 2 * center - point[:, 2]
             
-            point[point[:, :, 2] >= img.shape[2]] = PAD_ID
-            return F.hflip(img), F.hflip(label), point
+            point = point[point[:, 2] < img.shape[2]]
+            label = label.hflip() if isinstance(label, EP_Target) else F.hflip(label)
+            return F.hflip(img), label, point
         return img, label, point
 
 #random vertical flip
@@ -66,12 +72,50 @@ class RandomVerticalFlip(object):
         if random.random() < self.p:
             #y flip img=>[2,H,W]
             center = (img.shape[1] - 1) / 2
-            point[:, :, 3] = 2 * center - point[:, :, 3]
+            point[:, 3] = 2 * center - point[:, 3]
             
-            point[point[:, :, 3] >= img.shape[1]] = PAD_ID
-            return F.vflip(img), F.vflip(label), point
+            point = point[point[:, 3] < img.shape[1]]
+            label = label.vflip() if isinstance(label, EP_Target) else F.vflip(label)
+            return F.vflip(img), label, point
         return img, label, point
 
+def crop_points(point, i, j, h, w):
+    """Shift packed points into a crop and remove the rows outside it.
+
+    Args:
+        point (tensor[num,4(frame,id,x,y)]): packed points
+        i, j, h, w (int): top, left, height and width of the crop
+
+    Returns:
+        tensor[num',4(frame,id,x,y)]: points in the crop
+    """
+    #x crop
+    point[:, 2] -= j
+    #y crpo
+    point[:, 3] -= i
+    return point[(point[:, 2] >= 0) & (point[:, 2] < w) & (point[:, 3] >= 0) & (point[:, 3] < h)]
+
+
+def split_crop(transform):
+    """Take a leading RandomCrop without padding out of a Compose.
+    The dataset draws the crop before reading and reads only that region.
+
+    Args:
+        transform (Compose): transform of the dataset
+
+    Returns:
+        RandomCrop: crop drawn by the dataset, None when the first transform is not a plain RandomCrop
+        Compose: the other transforms
+    """
+    if not isinstance(transform, Compose) or len(transform.transforms) == 0:
+        return None, transform
+
+    crop = transform.transforms[0]
+    if isinstance(crop, RandomCrop) and crop.padding == 0 and not crop.pad_if_needed:
+        return crop, Compose(transform.transforms[1:])
+    return None, transform
+
+
 # random crop
 class RandomCrop(object):
     def __init__(self, size, padding=0, pad_if_needed=False):
@@ -91,7 +135,12 @@ class RandomCrop(object):
 
     @staticmethod
     def get_params(img, output_size):
-        h, w = img.shape[1:]
+        return RandomCrop.get_region(img.shape[1:], output_size)
+
+    @staticmethod
+    def get_region(size, output_size):
+        # crop drawn from the frame size only, before the window is read
+        h, w = size
         th, tw = output_size
         if w == tw and h == th:
             return 0, 0, h, w
@@ -104,6 +153,9 @@ class RandomCrop(object):
 
         assert img.shape[1:] == label.shape[1:], 'size of img and label should be the same. %s, %s' % (
             img.shape[1:], label.shape[1:])
+        if isinstance(label, EP_Target) and (self.padding > 0 or self.pad_if_needed):
+            label = label.render()
+
         if self.padding > 0:
             img = F.pad(img, self.padding)
             label = F.pad(label, self.padding)
@@ -119,11 +171,100 @@ class RandomCrop(object):
             label = F.pad(label, padding=int((1 + self.size[0] - label.shape[1]) / 2))
 
         i, j, h, w = self.get_params(img, self.size)
-        #x crop
-        point[:, :, 2] -= j
-        point[(point[:, :, 2] < 0) | (point[:, :, 2] >= w)] = PAD_ID
-        #y crpo
-        point[:, :, 3] -= i
-        point[(point[:, :, 3] < 0) | (point[:, :, 3] >= h)] = PAD_ID
-
-        return F.crop(img, i, j, h, w), F.crop(label, i, j, h, w), point
+        # packed points, rows outside the crop are removed
+        point = crop_points(point, i, j, h, w)
+
+        label = label.crop(i, j, h, w) if isinstance(label, EP_Target) else F.crop(label, i, j, h, w)
+        return F.crop(img, i, j, h, w), label, point
+
+
+##### batch augmentation #####
+# image=>[batch,1,T,H,W], label=>[batch,T,H,W] or None, point=>[num,4(frame,id,x,y)] packed, frame = batch index * T + frame in the window
+# They run after collate on the device of the batch, every sample draws its own parameters.
+
+# compose
+class Batch_Compose(object):
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, img, label, point):
+        for t in self.transforms:
+            img, label, point = t(img, label, point)
+        # raw uint8 windows from the workers, normalized after the crop
+        if img.dtype == torch.uint8:
+            img = img.float() / 255
+        return img, label, point
+
+
+# random horizontal flip
+class Batch_RandomHorizontalFlip(object):
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, img, label, point):
+        flag = torch.rand(img.shape[0]) < self.p
+        # in place, the batch is owned by the training loop
+        img[flag] = img[flag].flip(-1)
+        if label is not None:
+            label[flag] = label[flag].flip(-1)
+
+        # x flip of the rows in flipped samples
+        row_flag = flag.to(point.device)[point[:, 0].long() // img.shape[2]]
+        point[:, 2] = torch.where(row_flag, (img.shape[-1] - 1) - point[:, 2], point[:, 2])
+        point = point[point[:, 2] < img.shape[-1]]
+        return img, label, point
+
+#random vertical flip
+class Batch_RandomVerticalFlip(object):
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, img, label, point):
+        flag = torch.rand(img.shape[0]) < self.p
+        # in place, the batch is owned by the training loop
+        img[flag] = img[flag].flip(-2)
+        if label is not None:
+            label[flag] = label[flag].flip(-2)
+
+        # y flip of the rows in flipped samples
+        row_flag = flag.to(point.device)[point[:, 0].long() // img.shape[2]]
+        point[:, 3] = torch.where(row_flag, (img.shape[-2] - 1) - point[:, 3], point[:, 3])
+        point = point[point[:, 3] < img.shape[-2]]
+        return img, label, point
+
+# random crop
+class Batch_RandomCrop(object):
+    def __init__(self, size):
+        """Randam Crop of every sample in one gather
+
+        Args:
+            size (list): Crop size[H,W]
+        """
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+
+    def __call__(self, img, label, point):
+        B, C, T, H, W = img.shape
+        th, tw = self.size
+        if H == th and W == tw:
+            return img, label, point
+
+        i = torch.randint(0, H - th + 1, (B,))
+        j = torch.randint(0, W - tw + 1, (B,))
+
+        # flat pixel index of every crop, [B,th*tw]
+        index = (i[:, None, None] + torch.arange(th)[None, :, None]) * W + j[:, None, None] + torch.arange(tw)[None, None, :]
+        index = index.flatten(1).to(img.device)
+
+        img = torch.gather(img.flatten(-2), -1, index[:, None, None].expand(B, C, T, -1)).view(B, C, T, th, tw)
+        if label is not None:
+            label = torch.gather(label.flatten(-2), -1, index[:, None].expand(B, T, -1)).view(B, T, th, tw)
+
+        # packed points, rows outside the crop are removed
+        batch_idx = point[:, 0].long() // T
+        point[:, 2] -= j.to(point)[batch_idx]
+        point[:, 3] -= i.to(point)[batch_idx]
+        point = point[(point[:, 2] >= 0) & (point[:, 2] < tw) & (point[:, 3] >= 0) & (point[:, 3] < th)]
+        return img, label, point
@@ -1,41 +1,282 @@
 #coding: utf-8
 #----- Standard Library -----#
-#None
+import contextlib
+import copy
+import inspect
+import time
 
 #----- Public Package -----#
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 
 #----- Module -----#
 #None
 
+PAD_ID = -1
+# config precision => autocast dtype
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
 
-def get_movelimit(dataset, factor=1.1):
-    all_tracks = dataset.get_track()
 
-    move_max_list = [[], [], []]
-    cash_move_append = [move_list.append for move_list in move_max_list]
+def annotation_index(track):
+    """CSR index of an annotation table sorted at frame.
+
+    Args:
+        track (np.ndarray[rows,4(frame,id,x,y)]): annotation sorted at frame
+
+    Returns:
+        dict: "frame_offsets" (np.ndarray[frame+1]): rows of frame f are frame_offsets[f]:frame_offsets[f+1]
+              "ids" (np.ndarray[id_num]): sorted track id
+              "id_order" (np.ndarray[rows]): row index sorted at (id, frame)
+              "id_offsets" (np.ndarray[id_num+1]): rows of ids[k] are id_order[id_offsets[k]:id_offsets[k+1]]
+    """
+    frame = np.round(track[:, 0]).astype(np.int64)
+    frame_num = frame.max() + 1 if frame.shape[0] != 0 else 0
+    frame_offsets = np.searchsorted(frame, np.arange(frame_num + 1), side="left")
+
+    id_order = np.lexsort((track[:, 0], track[:, 1]))
+    ids, id_count = np.unique(track[id_order, 1], return_counts=True)
+    id_offsets = np.concatenate([[0], np.cumsum(id_count)])
+
+    return {"frame_offsets": frame_offsets,
+            "ids": ids,
+            "id_order": id_order,
+            "id_offsets": id_offsets}
+
+
+def pad_points(point, batch, length, pad=PAD_ID):
+    """Dense block of packed points for kernels that need one. Frames are padded to the max particle number.
+
+    Args:
+        point (tensor[rows,C(frame,...)]): packed points sorted at frame. frame = batch index * length + frame in the window
+        batch (int): batch size
+        length (int): window length
+        pad (int, optional): padding value. Defaults to PAD_ID.
+
+    Returns:
+        tensor[batch,length,num,C]: padded points
+    """
+    frame = point[:, 0].long()
+    count = torch.bincount(frame, minlength=batch * length)
+    # rank of every row in its frame
+    rank = torch.arange(point.shape[0], device=point.device) - (torch.cumsum(count, dim=0) - count)[frame]
+
+    dense = point.new_full([batch * length, int(count.max()) if count.shape[0] != 0 else 0, point.shape[1]], pad)
+    dense[frame, rank] = point
+    return dense.view(batch, length, -1, point.shape[1])
+
 
-    for track in all_tracks:
-        # frame sort
-        sort_idx = track[:, 0].sort()[1]
-        track = track[sort_idx]
-        zero_point = track[track[:, 0] == 0]
-        aa = torch.unique(zero_point[:, 1], return_counts=True)
+def pad_windows(point, batch, length, pad=PAD_ID):
+    """Dense block of every window, padded to the max particle number of that window only.
+    The attention and the losses run window by window, the PAD up to denser windows of the batch is not computed.
 
-        #frame,id,x,y
-        unique_id = torch.unique(track[:, 1])
-        for target_id in unique_id:
-            for i in range(1, 4):
-                target_track = track[track[:, 1] == target_id][:, [2, 3]]
-                move = target_track[:-i] - target_track[i:]
-                move = torch.sqrt((move ** 2).sum(dim=-1))
+    Args:
+        point (tensor[rows,C(frame,...)]): packed points sorted at frame. frame = batch index * length + frame in the window
+        batch (int): batch size
+        length (int): window length
+        pad (int, optional): padding value. Defaults to PAD_ID.
+
+    Returns:
+        list[tensor[1,length,num,C]]: padded points of every window, frame is the frame in the window
+    """
+    count = torch.bincount(point[:, 0].long() // length, minlength=batch)
+    blocks = []
+    for idx, rows in enumerate(torch.split(point, count.tolist())):
+        rows = rows.clone()
+        rows[:, 0] -= idx * length
+        blocks.append(pad_points(rows, 1, length, pad))
+    return blocks
+
+
+def move_statistics(all_tracks, percentiles=(50., 90., 99.), indexes=None):
+    """Displacement statistics of tracks for delay 1, 2 and 3.
+    Rows are taken in (id, frame) order, and the displacements of every delay are taken in bulk
+    between rows that are delay apart in the same track.
+
+    Args:
+        all_tracks (list[tensor[rows,4(frame,id,x,y)]]): annotation of every sequence
+        percentiles (tuple[float], optional): percentiles of the displacement. Defaults to (50., 90., 99.).
+        indexes (list[dict], optional): index of every sequence made by annotation_index, its id_order
+            and id_offsets are used instead of sorting. Defaults to None.
+
+    Returns:
+        dict: "max" (list[3]): maximum displacement of every delay
+              "percentile" (dict[str, list[3]]): displacement percentiles of every delay
+    """
+    if torch.is_tensor(all_tracks):
+        all_tracks = [all_tracks]
+    if indexes is None:
+        indexes = [None] * len(all_tracks)
+    elif isinstance(indexes, dict):
+        indexes = [indexes]
+
+    moves = [[], [], []]
+    for track, index in zip(all_tracks, indexes):
+        track = torch.as_tensor(track)
+        if index is None:
+            index = annotation_index(track.numpy())
+        # (id, frame) order, rows of the k-th track are id_offsets[k]:id_offsets[k+1]
+        track_id = torch.from_numpy(np.repeat(np.arange(len(index["ids"])), np.diff(index["id_offsets"])))
+        coord = track[torch.from_numpy(index["id_order"])][:, [2, 3]]
+
+        for delay in range(1, 4):
+            same = track_id[:-delay] == track_id[delay:]
+            move = coord[:-delay][same] - coord[delay:][same]
+            moves[delay - 1].append(torch.sqrt((move ** 2).sum(dim=-1)))
+
+    moves = [torch.cat(move).numpy() for move in moves]
+
+    return {"max": [float(move.max()) if move.shape[0] != 0 else 0. for move in moves],
+            "percentile": {f"{q:g}": [float(np.percentile(move, q)) if move.shape[0] != 0 else 0. for move in moves]
+                            for q in percentiles}}
+
+
+def get_movelimit(dataset, factor=1.1):
+    """Move limit of delay 1, 2 and 3, factor times the maximum displacement.
 
-                if move.shape[0] != 0:
-                    cash_move_append[i - 1](move.max())
+    Args:
+        dataset (data.Dataset or dict): dataset, or statistics made by move_statistics
+        factor (float, optional): margin. Defaults to 1.1.
 
-    del cash_move_append
+    Returns:
+        list[3]: move limit
+    """
+    # statistics prepared with the dataset
+    move_stats = dataset if isinstance(dataset, dict) else getattr(dataset, "move_stats", None)
+    if move_stats is None:
+        move_stats = move_statistics(dataset.get_track())
 
-    move_limit = [factor * max(move) for move in move_max_list]
+    move_limit = [factor * move for move in move_stats["max"]]
     return move_limit
+
+
+def autocast(device, precision="fp32"):
+    """Autocast context of the backbone and the transformer.
+    Losses and the tracker cast their inputs back to float32.
+
+    Args:
+        device (torch.device): device of the model
+        precision (str, optional): fp32, bf16 or fp16. fp16 needs a GPU, bf16 torch>=1.10. Defaults to "fp32".
+
+    Returns:
+        context manager: autocast, nothing for fp32
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("precision has values other than fp32, bf16 and fp16.")
+    if precision == "fp16" and device.type == "cpu":
+        raise ValueError("precision fp16 needs a GPU, use bf16 on CPU.")
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    if not hasattr(torch, "autocast"):
+        # torch<1.10 has only the float16 autocast of CUDA
+        if precision != "fp16":
+            raise ValueError(f"precision {precision} needs torch>=1.10, use fp16 on a GPU.")
+        return torch.cuda.amp.autocast()
+    return torch.autocast(device_type=device.type, dtype=PRECISIONS[precision])
+
+
+def grad_scaler(precision="fp32"):
+    """Loss scaler of a precision. Only fp16 gradients underflow, otherwise it does nothing."""
+    return torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+
+
+def checkpoint(module, *inputs, function=None):
+    """Activation checkpointing: the activations of module are recomputed in the backward pass
+    instead of being kept. BatchNorm running statistics are updated once, by the forward pass.
+
+    Args:
+        module (nn.Module): checkpointed module
+        *inputs: inputs of function
+        function (callable, optional): runs module on the inputs. Defaults to module.
+
+    Returns:
+        outputs of function
+    """
+    function = module if function is None else function
+    batchnorms = [m for m in module.modules()
+                    if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.running_mean is not None]
+    calls = []
+
+    def run(*inputs):
+        calls.append(None)
+        if len(calls) == 1 or not batchnorms:
+            return function(*inputs)
+        # recomputation, momentum 0 keeps the running statistics
+        state = [(m.momentum, m.num_batches_tracked.clone()) for m in batchnorms]
+        for m in batchnorms:
+            m.momentum = 0.
+        try:
+            return function(*inputs)
+        finally:
+            for m, (momentum, tracked) in zip(batchnorms, state):
+                m.momentum = momentum
+                m.num_batches_tracked.copy_(tracked)
+
+    # non-reentrant where torch has it, outputs then need no input with a gradient
+    if "use_reentrant" in inspect.signature(torch.utils.checkpoint.checkpoint).parameters:
+        return torch.utils.checkpoint.checkpoint(run, *inputs, use_reentrant=False)
+
+    # torch<1.11: reentrant checkpointing differentiates only through its inputs,
+    # a block on inputs without a gradient would leave its parameters without one
+    if not any(isinstance(x, torch.Tensor) and x.requires_grad for x in inputs):
+        inputs = [x.detach().requires_grad_() if isinstance(x, torch.Tensor) and x.is_floating_point() else x for x in inputs]
+    return torch.utils.checkpoint.checkpoint(run, *inputs)
+
+
+def peak_memory(function, device):
+    """Peak memory of a call above the memory before it, in bytes.
+    CPU has no allocator statistics, there the allocations of the profiled operators are summed
+    in order, which is exact up to the operator granularity.
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        before = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        function()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - before
+
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        function()
+    events = sorted(prof.events(), key=lambda event: event.time_range.start)
+    return int(np.cumsum([0] + [event.self_cpu_memory_usage for event in events]).max())
+
+
+def checkpoint_report(model, step, device, repeat=3, seed=0):
+    """Peak memory and time of a training step without and with activation checkpointing.
+    The steps run on a copy of the model, its gradients and BatchNorm statistics do not change.
+
+    Args:
+        model (nn.Module): model with checkpoint switches (UNet_3D, UNet_3D_FA, TransformerEncoder)
+        step (callable): forward and backward of one batch, takes the model
+        device (torch.device): device of the model
+        repeat (int, optional): timed steps. Defaults to 3.
+        seed (int, optional): random seed of every step. Defaults to 0.
+
+    Returns:
+        dict: "off" and "on" => peak memory [byte], seconds per step
+    """
+    model = copy.deepcopy(model).train()
+    switches = [module for module in model.modules() if isinstance(getattr(module, "checkpoint", None), bool)]
+
+    report = {}
+    with torch.random.fork_rng():
+        for mode in ["off", "on"]:
+            for module in switches:
+                module.checkpoint = mode == "on"
+
+            # the first step is the warm-up
+            torch.manual_seed(seed)
+            memory = peak_memory(lambda: step(model), device)
+            model.zero_grad(set_to_none=True)
+
+            start = time.time()
+            for _ in range(repeat):
+                torch.manual_seed(seed)
+                step(model)
+                model.zero_grad(set_to_none=True)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            report[mode] = (memory, (time.time() - start) / repeat)
+    return report